@@ -1,5 +1,8 @@
+import time
+from collections import deque
 from contextlib import contextmanager
-from typing import Generator, List
+from threading import Condition, Thread
+from typing import Deque, Generator, Optional, Tuple
 
 from pychromecast import Chromecast, get_listed_chromecasts  # type: ignore
 from pychromecast.controllers.media import (  # type: ignore
@@ -9,10 +12,21 @@ from pychromecast.controllers.media import (  # type: ignore
 )
 
 from castme.config import Config
+from castme.loudness import Normalizer, Volume
 from castme.messages import debug as msg_debug
 from castme.messages import error
-from castme.player import Backend, NoSongsToPlayException
+from castme.player import Backend, NoSongsToPlayException, PlaybackObserver
+from castme.relay import AudioCache, Relay, local_address_towards
+from castme.resilience import LatencyTracker, ResilientHttp
 from castme.song import Song
+from castme.song_queue import SongQueue
+
+# Number of songs downloaded in advance by the relay
+PREFETCH_SONGS = 2
+# Status updates waiting for the dispatcher, the oldest ones are dropped first
+MAX_PENDING_STATUSES = 32
+# Time after which a song sent to the device is considered lost
+LOAD_TIMEOUT = 30.0
 
 
 def debug(msg: str):
@@ -20,22 +34,54 @@ def debug(msg: str):
 
 
 class ChromecastBackend(Backend):
-    def __init__(self, config: Config, songs: List[Song]):
+    def __init__(
+        self,
+        config: Config,
+        songs: SongQueue,
+        observer: PlaybackObserver,
+        chromecast: Optional[Chromecast] = None,
+        normalizer: Optional[Normalizer] = None,
+    ):
+        """The Chromecast is looked up by its name if it is not given"""
         self.chromecast_friendly_name = config.chromecast_friendly_name
         self.songs = songs
-        self.chromecast = find_chromecast(self.chromecast_friendly_name)
+        self.observer = observer
+        self.chromecast = chromecast or find_chromecast(self.chromecast_friendly_name)
         self.mediacontroller = self.chromecast.media_controller
         self.chromecast.wait()
+        self.relay: Optional[Relay] = None
+        if config.relay_enabled:
+            cache = AudioCache(
+                config.cache_dir,
+                config.cache_max_mb * 1024 * 1024,
+                ResilientHttp(),
+                config.prewarm_disk_mb * 1024 * 1024,
+            )
+            address = config.relay_address or local_address_towards(
+                self.chromecast.cast_info.host
+            )
+            self.relay = Relay(cache, address, config.relay_port)
+        self.volume = Volume(
+            normalizer or Normalizer(), self.device_volume, self.set_device_volume
+        )
+        self.dispatcher = StatusDispatcher(
+            songs, self.mediacontroller, observer, self.volume, self.relay
+        )
         self.mediacontroller.register_status_listener(
-            MyChromecastListener(songs, self.mediacontroller)
+            MyChromecastListener(self.dispatcher)
         )
 
-    def force_play(self):
-        debug("Force play")
-        if self.songs:
-            play_on_chromecast(self.songs[0], self.mediacontroller)
-        else:
+    def force_play(self, start: float = 0):
+        debug(f"Force play from {start}")
+        if not self.songs:
             raise NoSongsToPlayException()
+        self.dispatcher.submit_play(start)
+
+    def position(self) -> Optional[float]:
+        status = self.mediacontroller.status
+        if status.player_is_idle:
+            return None
+        return status.adjusted_current_time
 
     def rewind(self):
         debug("Rewind")
@@ -50,16 +96,20 @@ class ChromecastBackend(Backend):
         elif self.mediacontroller.status.player_is_playing:
             self.mediacontroller.pause()
 
+    def device_volume(self) -> float:
+        status = self.chromecast.status
+        return status.volume_level if status else 1.0
+
+    def set_device_volume(self, value: float):
+        self.chromecast.set_volume(value)
+
     def volume_set(self, value: float):
         debug(f"volume set {value}")
-        self.chromecast.set_volume(value)
+        self.volume.set(value)
 
     def volume_delta(self, value: float):
         debug(f"volume delta {value}")
-        if value > 0:
-            self.chromecast.volume_up(value)
-        else:
-            self.chromecast.volume_down(-value)
+        self.volume.delta(value)
 
     def stop(self):
         debug("stop")
@@ -69,6 +119,9 @@ class ChromecastBackend(Backend):
     def close(self):
         debug("close")
         self.stop()
+        self.dispatcher.close()
+        if self.relay:
+            self.relay.close()
 
 
 class ChromecastNotFoundException(Exception):
@@ -79,21 +132,144 @@ class ChromecastNotFoundException(Exception):
         return f"Chromecast named {self.keyword} not found"
 
 
-class MyChromecastListener(MediaStatusListener):
-    def __init__(self, songs: List[Song], media_controller: MediaController):
+class StatusDispatcher:
+    """Owns the advancement of the queue for the Chromecast backend.
+
+    The status updates arrive on the socket thread of pychromecast, which must not
+    be blocked, and the play requests on the CLI thread. Both are handed over to a
+    dedicated thread, through a bounded buffer: the oldest status updates are
+    dropped when it is full. The FINISHED updates that are duplicates, or that were
+    made stale by a new song being loaded, are ignored.
+    """
+
+    def __init__(  # noqa: PLR0913, PLR0917
+        self,
+        songs: SongQueue,
+        media_controller: MediaController,
+        observer: PlaybackObserver,
+        volume: Volume,
+        relay: Optional[Relay] = None,
+        max_pending: int = MAX_PENDING_STATUSES,
+    ):
         self.songs = songs
         self.media_controller = media_controller
+        self.observer = observer
+        self.volume = volume
+        self.relay = relay
+        self.condition = Condition()
+        # (time received, status)
+        self.statuses: Deque[Tuple[float, MediaStatus]] = deque(maxlen=max_pending)
+        self.dropped = 0
+        # (time requested, start position) of the last play request
+        self.play_request: Optional[Tuple[float, float]] = None
+        self.closing = False
+        # Set when a song is sent to the device, until it reports it is not idle
+        self.loading_since: Optional[float] = None
+        self.finished_session: Optional[int] = None
+        # From the FINISHED status to the next song sent to the device
+        self.latencies = LatencyTracker()
+        self.thread = Thread(target=self.loop, name="chromecast-status")
+        self.thread.start()
+
+    def submit_status(self, status: MediaStatus):
+        with self.condition:
+            if len(self.statuses) == self.statuses.maxlen:
+                self.dropped += 1
+            self.statuses.append((time.monotonic(), status))
+            self.condition.notify()
+
+    def submit_play(self, start: float):
+        """Only the last request is kept, e.g. for several `next` in a row"""
+        with self.condition:
+            self.play_request = (time.monotonic(), start)
+            self.condition.notify()
+
+    def load_failed(self):
+        with self.condition:
+            self.loading_since = None
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while not (self.statuses or self.play_request or self.closing):
+                    self.condition.wait()
+                if self.closing:
+                    return
+                statuses = list(self.statuses)
+                self.statuses.clear()
+                play_request, self.play_request = self.play_request, None
+            try:
+                if play_request is not None:
+                    # The user asked for a song: the FINISHED of the previous one
+                    # must not advance the queue
+                    self.play(start=play_request[1])
+                else:
+                    for received, status in statuses:
+                        self.handle(received, status)
+            except NoSongsToPlayException:
+                error("None of the songs in the queue could be loaded")
+            except Exception as e:
+                # e.g. the server or the device cannot be reached. The thread must
+                # survive it, or the queue would never advance again.
+                error(f"Could not play the next song: {e}")
+                self.load_failed()
+
+    def handle(self, received: float, status: MediaStatus):
+        if not status.player_is_idle:
+            self.loading_since = None
+            return
+        if status.idle_reason != "FINISHED":
+            return
+        if self.loading_since is not None:
+            if time.monotonic() - self.loading_since < LOAD_TIMEOUT:
+                debug("Ignoring a stale FINISHED status")
+                return
+            debug("The device never reported the song as loaded")
+        if status.media_session_id == self.finished_session:
+            debug("Ignoring a duplicate FINISHED status")
+            return
+        self.finished_session = status.media_session_id
+
+        if self.songs:
+            self.observer.finished(self.songs[0])
+            self.songs.pop(0)
+        if self.songs:
+            self.play()
+            latency = time.monotonic() - received
+            self.latencies.add(latency)
+            debug(
+                f"Next song sent {latency * 1000:.1f}ms after the end of the last one"
+            )
+
+    def play(self, start: float = 0):
+        self.loading_since = time.monotonic()
+        song = self.songs.head()
+        # Before the song starts, the previous one has ended or is interrupted
+        self.volume.song_changed(song)
+        play_head(self.songs, self.media_controller, self.observer, self.relay, start)
+        self.volume.normalizer.prepare([song, *self.songs.upcoming(PREFETCH_SONGS)])
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
+
+
+class MyChromecastListener(MediaStatusListener):
+    """Called from the socket thread of pychromecast, the work is left to the
+    dispatcher"""
+
+    def __init__(self, dispatcher: StatusDispatcher):
+        self.dispatcher = dispatcher
 
     def new_media_status(self, status: MediaStatus):
-        if status.player_is_idle and status.idle_reason == "FINISHED":
-            if self.songs:
-                self.songs.pop(0)
-            if self.songs:
-                play_on_chromecast(self.songs[0], self.media_controller)
+        self.dispatcher.submit_status(status)
 
     def load_media_failed(self, item: int, error_code: int):
         """Called when load media failed."""
         error(f"Error loading media, error code: {error_code}")
+        self.dispatcher.load_failed()
 
 
 def find_chromecast(label: str) -> Chromecast:
@@ -104,7 +280,27 @@ def find_chromecast(label: str) -> Chromecast:
     return chromecasts[0]
 
 
-def play_on_chromecast(song: Song, controller: MediaController):
+def play_head(
+    songs: SongQueue,
+    controller: MediaController,
+    observer: PlaybackObserver,
+    relay: Optional[Relay],
+    start: float = 0,
+):
+    """Play the first song of the queue, and have the relay download the next ones"""
+    song = songs.head()
+    play_on_chromecast(song, controller, start, relay)
+    observer.started(song)
+    if relay:
+        relay.prefetch(songs.upcoming(PREFETCH_SONGS))
+
+
+def play_on_chromecast(
+    song: Song,
+    controller: MediaController,
+    start: float = 0,
+    relay: Optional[Relay] = None,
+):
     metadata = dict(
         # 3 is the magic number for MusicTrackMediaMetadata
         # see https://developers.google.com/cast/docs/media/messages
@@ -113,19 +309,26 @@ def play_on_chromecast(song: Song, controller: MediaController):
         title=song.title,
         artist=song.artist,
     )
-    debug(f"Playing {song.title} @ {song.url}")
+    url = relay.audio_url(song) if relay else song.url
+    debug(f"Playing {song.title} @ {url}")
     controller.play_media(
-        song.url,
+        url,
         content_type=song.content_type,
         title=song.title,
         media_info=metadata,
-        thumb=song.album_art,
+        thumb=relay.art_url(song) if relay else song.album_art,
+        current_time=start or None,
     )
 
 
 @contextmanager
-def backend(config: Config, songs: List[Song]) -> Generator[Backend, None, None]:
-    chromecast = ChromecastBackend(config, songs)
+def backend(
+    config: Config,
+    songs: SongQueue,
+    observer: PlaybackObserver,
+    normalizer: Normalizer,
+) -> Generator[ChromecastBackend, None, None]:
+    chromecast = ChromecastBackend(config, songs, observer, normalizer=normalizer)
     try:
         yield chromecast
     finally:
@@ -1,37 +1,59 @@
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
 from contextlib import contextmanager, redirect_stdout
 from dataclasses import dataclass
 from enum import Enum
 from io import BytesIO
 from queue import Empty, Queue
 from threading import Thread
-from typing import Any, BinaryIO, Generator, List
+from typing import Any, Generator, Optional, Tuple
 from urllib.error import URLError
 
-import requests as r
 from requests.exceptions import RequestException
 
 # Feeling bad about it, but pygame always display a welcome
 # message which is completely out of place on a CLI music player.
 with redirect_stdout(None):
     from pygame import event, NOEVENT
+    from pygame import error as PygameError
     from pygame.locals import USEREVENT
     from pygame.display import init as display_init
-    from pygame.mixer import music
+    from pygame.mixer import music, Sound, get_init
     from pygame.mixer import init as mixer_init
 
 from castme.config import Config
+from castme.loudness import SAMPLE_WIDTH, Normalizer, Volume
 from castme.messages import debug as msg_debug
 from castme.messages import error
-from castme.player import Backend, NoSongsToPlayException
+from castme.player import Backend, NoSongsToPlayException, PlaybackObserver
+from castme.resilience import ResilientHttp
 from castme.song import Song
+from castme.song_queue import SongQueue
 
 STOP_EVENT = USEREVENT + 1
+# Maximum time for the pygame thread to decode a song, see LocalBackendImpl.decode
+DECODE_TIMEOUT = 30.0
 
+_http = ResilientHttp()
 
-def get_song(song: Song) -> BinaryIO:
-    response = r.get(song.url, timeout=10)
+
+def download(song: Song) -> bytes:
+    # Streaming so that the retries and hedging only consider the time to the first
+    # byte, not the full download
+    response = _http.get(song.url, timeout=(3.05, 10), stream=True)
     response.raise_for_status()
-    return BytesIO(response.content)
+    return response.content
+
+
+def decode(content: bytes) -> Optional[bytes]:
+    """See loudness.Decoder, must be called from the pygame thread"""
+    mixer = get_init()
+    if mixer is None or abs(mixer[1]) != SAMPLE_WIDTH:
+        return None
+    try:
+        return Sound(file=BytesIO(content)).get_raw()
+    except PygameError as e:
+        debug(f"Could not decode: {e}")
+        return None
 
 
 def debug(msg):
@@ -48,6 +70,7 @@ class Message:
         STOP = 5
         EXIT = 6
         PLAY = 7
+        DECODE = 8
 
     @staticmethod
     def playpause():
@@ -62,8 +85,8 @@ class Message:
         return Message(Message.Type.EXIT, None)
 
     @staticmethod
-    def force_play():
-        return Message(Message.Type.FORCE_PLAY, None)
+    def force_play(start: float = 0):
+        return Message(Message.Type.FORCE_PLAY, start)
 
     type: Type
     # This is ugly but it will do for now. Poor man's tagged union
@@ -76,24 +99,91 @@ class State(Enum):
     STOPPED = 3
 
 
-def play_next(songs: List[Song]) -> bool:
+@dataclass
+class PlaybackStatus:
+    """Updated by the pygame thread, read by the others"""
+
+    position: Optional[float] = None
+
+
+class Preloader:
+    """Download the song following the head of the queue in the background, so that
+    it can be given to music.queue() and played without any gap"""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preload")
+        self.song: Optional[Song] = None
+        self.future: Optional[Future[bytes]] = None
+
+    def poll(self, songs: SongQueue) -> Optional[Tuple[Song, bytes]]:
+        """Return the next song and its content once downloaded. The download starts
+        when the next song changes, and only once it is resolved: the resolution is
+        left to the queue, it is not done on the pygame thread."""
+        entry = songs.peek(1)
+        if not isinstance(entry, Song):
+            return None
+        if entry is not self.song:
+            debug(f"Preloading {entry.title}")
+            self.song = entry
+            self.future = self.executor.submit(download, entry)
+        if self.future is None or not self.future.done():
+            return None
+        try:
+            return entry, self.future.result()
+        except (RequestException, URLError) as e:
+            # Not retried, the song is loaded again once it is the head
+            error(f"Could not preload {entry.title}: {e}")
+            self.future = None
+            return None
+
+    def cached(self, song: Song) -> Optional[bytes]:
+        """The content of `song` if it was preloaded, e.g. before a `next`"""
+        future = self.future
+        if song is not self.song or future is None or not future.done():
+            return None
+        return None if future.exception() else future.result()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def play_next(
+    songs: SongQueue,
+    observer: PlaybackObserver,
+    preloader: Preloader,
+    volume: Volume,
+    start: float = 0,
+) -> bool:
     """returns True if it was successful, False otherwise.
     It is not great to not provide feedback upstream, but realistically
     there is nothing that it can do anyway for now. Good candidate for a
     refactoring.
     """
     try:
-        if songs:
-            debug(f"Playing {songs[0].title}")
-            music.load(get_song(songs[0]))
-            music.play()
-            return True
+        song = songs.head()
+        debug(f"Playing {song.title}")
+        content = preloader.cached(song) or download(song)
+        music.load(BytesIO(content))
+        volume.song_changed(song)
+        music.play(start=start)
+        volume.normalizer.prepare([song], content)
+    except NoSongsToPlayException:
+        debug("Nothing to play")
     except (RequestException, URLError) as e:
         error(str(e))
+    else:
+        observer.started(song)
+        return True
     return False
 
 
-def pygame_loop(queue: Queue[Message], songs: List[Song]):  # noqa: PLR0912
+def pygame_loop(  # noqa: PLR0912, PLR0915
+    queue: Queue[Message],
+    songs: SongQueue,
+    status: PlaybackStatus,
+    observer: PlaybackObserver,
+    normalizer: Normalizer,
+):
     """Pygame is not thread-safe. All the api calls needs to be done on the
     same thread, expecially the event management code."""
     mixer_init()
@@ -101,6 +191,13 @@ def pygame_loop(queue: Queue[Message], songs: List[Song]):  # noqa: PLR0912
     music.set_endevent(STOP_EVENT)
 
     state = State.STOPPED
+    # music.get_pos() ignores the starting position given to music.play()
+    start_offset = 0.0
+    preloader = Preloader()
+    volume = Volume(normalizer, music.get_volume, music.set_volume)
+    # Song given to music.queue(), pygame plays it as soon as the current one ends.
+    # Loading or stopping the music discards it.
+    queued: Optional[Song] = None
 
     while True:
         try:
@@ -108,16 +205,19 @@ def pygame_loop(queue: Queue[Message], songs: List[Song]):  # noqa: PLR0912
             debug(f"loop - Received message {message}")
             match message.type:
                 case Message.Type.VOLUME_SET:
-                    music.set_volume(message.payload)
+                    volume.set(message.payload)
                 case Message.Type.VOLUME_DELTA:
-                    music.set_volume(music.get_volume() + message.payload)
+                    volume.delta(message.payload)
                 case Message.Type.STOP:
                     state = State.STOPPED
+                    queued = None
                     music.stop()
                 case Message.Type.PLAY_PAUSE:
                     if state == State.STOPPED:
-                        if play_next(songs):
+                        queued = None
+                        if play_next(songs, observer, preloader, volume):
                             state = State.PLAYING
+                            start_offset = 0
                     elif state == State.PAUSED:
                         music.unpause()
                         state = State.PLAYING
@@ -125,9 +225,16 @@ def pygame_loop(queue: Queue[Message], songs: List[Song]):  # noqa: PLR0912
                         music.pause()
                         state = State.PAUSED
                 case Message.Type.FORCE_PLAY:
-                    if play_next(songs):
+                    queued = None
+                    if play_next(songs, observer, preloader, volume, message.payload):
                         state = State.PLAYING
+                        start_offset = message.payload
+                case Message.Type.DECODE:
+                    content, future = message.payload
+                    if future.set_running_or_notify_cancel():
+                        future.set_result(decode(content))
                 case Message.Type.EXIT:
+                    preloader.close()
                     return
         except Empty:
             pass
@@ -139,33 +246,74 @@ def pygame_loop(queue: Queue[Message], songs: List[Song]):  # noqa: PLR0912
                     # The channel have stopped _and_ we are now playing the queued song. It is time
                     # to move on to the next song
                     if songs:
+                        observer.finished(songs[0])
                         songs.pop(0)
 
-                    if songs and play_next(songs):
+                    if queued is not None and songs.peek(0) is queued:
+                        debug(f"Queued song {queued.title} is now playing")
+                        # No way to change the volume exactly at the transition
+                        volume.song_changed(queued)
+                        observer.started(queued)
+                        start_offset = 0
+                    elif songs and play_next(songs, observer, preloader, volume):
                         debug("Channel was not busy, played the next song")
                         state = State.PLAYING
+                        start_offset = 0
                     else:
                         debug("Channel was not busy, nothing to play")
                         state = State.STOPPED
+                        # The queued song may have started, the queue changed since
+                        music.stop()
+                    queued = None
+
+        if state != State.STOPPED and queued is not songs.peek(1):
+            if ready := preloader.poll(songs):
+                queued, content = ready
+                debug(f"Queueing {queued.title}")
+                music.queue(BytesIO(content))
+                # Measured from the content already downloaded
+                normalizer.prepare([queued], content)
+
+        if state == State.STOPPED:
+            status.position = None
+        else:
+            status.position = start_offset + music.get_pos() / 1000
 
 
 class LocalBackendImpl(Backend):
-    def __init__(self, songs: List[Song]):
+    def __init__(
+        self,
+        songs: SongQueue,
+        observer: PlaybackObserver,
+        normalizer: Optional[Normalizer] = None,
+    ):
         self.songs = songs
         self.queue: Queue[Message] = Queue()
+        self.status = PlaybackStatus()
+        self.normalizer = normalizer or Normalizer()
+        self.normalizer.set_decoder(self.decode)
         self.pygame_thread = Thread(
             target=pygame_loop,
-            args=(
-                self.queue,
-                self.songs,
-            ),
+            args=(self.queue, self.songs, self.status, observer, self.normalizer),
         )
         self.pygame_thread.start()
 
-    def force_play(self):
+    def decode(self, content: bytes) -> Optional[bytes]:
+        """See loudness.Decoder. Called from the loudness worker, the decoding is
+        done by the pygame thread."""
+        if not self.pygame_thread.is_alive():
+            raise CancelledError()
+        future: Future[Optional[bytes]] = Future()
+        self.queue.put(Message(Message.Type.DECODE, (content, future)))
+        return future.result(timeout=DECODE_TIMEOUT)
+
+    def force_play(self, start: float = 0):
         if not self.songs:
             raise NoSongsToPlayException()
-        self.queue.put(Message.force_play())
+        self.queue.put(Message.force_play(start))
+
+    def position(self) -> Optional[float]:
+        return self.status.position
 
     def rewind(self):
         if not self.songs:
@@ -178,6 +326,11 @@ class LocalBackendImpl(Backend):
     def close(self):
         self.queue.put(Message.exit())
         self.pygame_thread.join()
+        # Nothing decodes the songs anymore
+        while not self.queue.empty():
+            message = self.queue.get_nowait()
+            if message.type == Message.Type.DECODE:
+                message.payload[1].cancel()
 
     def volume_set(self, value: float):
         self.queue.put(Message(Message.Type.VOLUME_SET, value))
@@ -190,8 +343,13 @@ class LocalBackendImpl(Backend):
 
 
 @contextmanager
-def backend(_config: Config, songs: List[Song]) -> Generator[Backend, None, None]:
-    local = LocalBackendImpl(songs)
+def backend(
+    _config: Config,
+    songs: SongQueue,
+    observer: PlaybackObserver,
+    normalizer: Normalizer,
+) -> Generator[Backend, None, None]:
+    local = LocalBackendImpl(songs, observer, normalizer)
     try:
         yield local
     finally:
@@ -0,0 +1,76 @@
+import unicodedata
+from bisect import bisect_left
+from typing import Iterable, List
+
+
+def normalize(text: str) -> str:
+    """Case and accent insensitive form of the text, used for the comparisons"""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+class Completer:
+    """Names sorted by their normalized form, so that all the names starting with a
+    prefix are found with a binary search and are contiguous."""
+
+    def __init__(self, names: Iterable[str] = ()):
+        self.keys: List[str] = []
+        self.names: List[str] = []
+        self.update(names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str):
+        key = normalize(name)
+        index = bisect_left(self.keys, key)
+        self.keys.insert(index, key)
+        self.names.insert(index, name)
+
+    def remove(self, name: str):
+        key = normalize(name)
+        index = bisect_left(self.keys, key)
+        while index < len(self.keys) and self.keys[index] == key:
+            if self.names[index] == name:
+                del self.keys[index]
+                del self.names[index]
+                return
+            index += 1
+
+    def update(self, names: Iterable[str]):
+        """Replace the content with `names`, only touching what changed. A full
+        rebuild is cheaper when most of the names changed."""
+        new_names = set(names)
+        current = set(self.names)
+        added = new_names - current
+        removed = current - new_names
+        if len(added) + len(removed) > len(self.names) // 10:
+            entries = sorted((normalize(n), n) for n in new_names)
+            self.keys = [key for key, _ in entries]
+            self.names = [name for _, name in entries]
+            return
+        for name in removed:
+            self.remove(name)
+        for name in added:
+            self.add(name)
+
+    def complete(self, prefix: str, limit: int = 100) -> List[str]:
+        key = normalize(prefix)
+        index = bisect_left(self.keys, key)
+        matches: List[str] = []
+        while (
+            index < len(self.keys)
+            and len(matches) < limit
+            and self.keys[index].startswith(key)
+        ):
+            matches.append(self.names[index])
+            index += 1
+        return matches
+
+
+def readline_matches(matches: List[str], argument: str, text: str) -> List[str]:
+    """readline only replaces the last word of the line (`text`), while the names
+    are matched against the whole argument, which can contain spaces. The part of
+    the argument already typed is removed from the matches."""
+    already_typed = len(argument) - len(text)
+    return [m[already_typed:] for m in matches]
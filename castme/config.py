@@ -1,8 +1,8 @@
 import os.path
 import tomllib
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import PurePath
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
 from castme.messages import debug
 
@@ -11,13 +11,70 @@ class ConfigNotFoundException(Exception):
     pass
 
 
+class NoServerConfigured(Exception):
+    def __str__(self):
+        return "No subsonic server configured, set subsonic_server or add [[servers]]"
+
+
 @dataclass
-class Config:
+class ServerConfig:
+    name: str
     user: str
     password: str
     subsonic_server: str
+
+
+@dataclass
+class Config:
     chromecast_friendly_name: str
     default_backend: str
+    # The main server. More can be added in the servers list
+    user: str = ""
+    password: str = ""
+    subsonic_server: str = ""
+    servers: List[Dict[str, Any]] = field(default_factory=list)
+    # Maximum time to wait for the answer of a server when there are several
+    server_deadline: float = 10.0
+    # Number of songs the radio mode keeps in the queue ahead of the current one
+    radio_lookahead: int = 10
+    # Where the queue and the playback position are saved between runs
+    session_file: str = "~/.local/state/castme/session.log"
+    # Report the songs played to the server
+    scrobble: bool = True
+    # Plays not reported yet, while the server is unreachable
+    scrobble_file: str = "~/.local/state/castme/scrobbles.json"
+    # Serve the songs to the chromecast from a local caching relay
+    relay_enabled: bool = False
+    relay_port: int = 8765
+    # Address of this computer as seen by the chromecast, detected if empty
+    relay_address: str = ""
+    cache_dir: str = "~/.cache/castme"
+    cache_max_mb: int = 2048
+    # Even out the loudness of the songs with their ReplayGain: "album", "track" or
+    # "off". The songs without ReplayGain are measured, see loudness_file
+    replaygain: str = "album"
+    # Added to the gains, the songs that need to be louder are limited by the volume
+    replaygain_preamp: float = -6.0
+    loudness_file: str = "~/.cache/castme/loudness.json"
+    # Albums loaded in advance, predicted from the albums queued before. 0 disables it
+    prewarm_albums: int = 3
+    prewarm_file: str = "~/.local/state/castme/albums.json"
+    # With the relay, download the start of the first song of these albums, within
+    # a bandwidth and a disk budget. 0 disables it
+    prewarm_head_kb: int = 0
+    prewarm_kbps: int = 256
+    prewarm_disk_mb: int = 64
+
+    def all_servers(self) -> List[ServerConfig]:
+        servers = [ServerConfig(**s) for s in self.servers]
+        if self.subsonic_server:
+            servers.insert(
+                0,
+                ServerConfig("main", self.user, self.password, self.subsonic_server),
+            )
+        if not servers:
+            raise NoServerConfigured()
+        return servers
 
     @classmethod
     def load(cls, file_path: Optional[PurePath | str] = None) -> "Config":
@@ -0,0 +1,225 @@
+import difflib
+import random
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from requests.exceptions import RequestException, Timeout
+
+from castme.messages import debug as msg_debug
+from castme.messages import error
+from castme.song import Song
+from castme.song_queue import UnresolvedSongs
+from castme.subsonic import (
+    AlbumNotFoundException,
+    PlaylistNotFoundException,
+    SubSonic,
+    SubsonicApiError,
+)
+
+T = TypeVar("T")
+
+# Calls running at the same time on a server. A server with that many calls still
+# running is skipped, so that a stalled server does not pile them up.
+MAX_IN_FLIGHT = 4
+
+# Errors from a server that should not prevent using the others
+SERVER_ERRORS = (
+    SubsonicApiError,
+    RequestException,
+    AlbumNotFoundException,
+    PlaylistNotFoundException,
+)
+
+
+def debug(msg: str):
+    msg_debug("federation", msg)
+
+
+def qualify(server: SubSonic, song_id: str) -> str:
+    return f"{server.name}/{song_id}"
+
+
+def similarity(keyword: str, name: str) -> float:
+    # Same truncation as the fuzzy search of a single server
+    return difflib.SequenceMatcher(None, keyword, name[: len(keyword) + 3]).ratio()
+
+
+def unique_songs(songs: List[Song]) -> List[Song]:
+    """Remove the songs present on several servers, keeping the first one"""
+    seen = set()
+    unique: List[Song] = []
+    for song in songs:
+        key = (
+            song.title.casefold(),
+            song.artist.casefold(),
+            song.album_name.casefold(),
+        )
+        if key not in seen:
+            seen.add(key)
+            unique.append(song)
+    return unique
+
+
+class FederatedSubSonic:
+    """Query several Subsonic servers at the same time and merge their answers.
+
+    Each server gets `deadline` seconds to answer, the slow or failing ones are
+    ignored so that they don't block the others. Every server has its own threads,
+    the calls still running on a slow server never delay the calls to the others.
+    The song ids given to the queue are prefixed by the name of their server, see
+    get_playlist_song_ids.
+    """
+
+    def __init__(self, servers: List[SubSonic], deadline: float = 10.0):
+        self.servers = servers
+        self.by_name = {s.name: s for s in servers}
+        self.deadline = deadline
+        self.executors = {
+            s.name: ThreadPoolExecutor(
+                max_workers=MAX_IN_FLIGHT, thread_name_prefix=f"federation-{s.name}"
+            )
+            for s in servers
+        }
+        self.lock = Lock()
+        self.in_flight: Counter[str] = Counter()
+
+    def gather(self, call: Callable[[SubSonic], T]) -> List[Tuple[SubSonic, T]]:
+        """Run `call` on all the servers at once, and return the successful answers
+        received before the deadline, in the order of the servers. The first error
+        is raised if no server answered successfully, a Timeout if they were all too
+        slow."""
+        return self.gather_on(self.servers, call)
+
+    def gather_on(
+        self, servers: List[SubSonic], call: Callable[[SubSonic], T]
+    ) -> List[Tuple[SubSonic, T]]:
+        results, failures = self.gather_all(servers, call)
+        if not results and failures:
+            raise next(iter(failures.values()))
+        return results
+
+    def gather_all(
+        self, servers: List[SubSonic], call: Callable[[SubSonic], T]
+    ) -> Tuple[List[Tuple[SubSonic, T]], Dict[str, Exception]]:
+        """Same as gather_on, without raising: also returns why each of the other
+        servers gave no answer, by server name. The servers too slow or still busy
+        fail with a Timeout."""
+        futures = []
+        failures: Dict[str, Exception] = {}
+        for server in servers:
+            with self.lock:
+                if self.in_flight[server.name] >= MAX_IN_FLIGHT:
+                    debug(f"Server {server.name} is still busy, skipped")
+                    failures[server.name] = Timeout(f"Server {server.name} is busy")
+                    continue
+                self.in_flight[server.name] += 1
+            future = self.executors[server.name].submit(call, server)
+            future.add_done_callback(partial(self.call_done, server.name))
+            futures.append((server, future))
+        _, not_done = wait([f for _, f in futures], timeout=self.deadline)
+        results: List[Tuple[SubSonic, T]] = []
+        for server, future in futures:
+            if future in not_done:
+                message = f"Server {server.name} did not answer in {self.deadline}s"
+                error(message)
+                failures[server.name] = Timeout(message)
+                continue
+            try:
+                results.append((server, future.result()))
+            except SERVER_ERRORS as e:
+                debug(f"Server {server.name} failed: {e}")
+                failures[server.name] = e
+        return results, failures
+
+    def server(self, name: str) -> Optional[SubSonic]:
+        """None if the server was removed from the configuration"""
+        return self.by_name.get(name)
+
+    def call_done(self, server_name: str, _future: Future):
+        with self.lock:
+            self.in_flight[server_name] -= 1
+
+    def get_album_list(self) -> List[Dict[str, str]]:
+        albums: Dict[Tuple[str, str], Dict[str, str]] = {}
+        for _, server_albums in self.gather(lambda s: s.get_album_list()):
+            for album in server_albums:
+                key = (album["title"].casefold(), album["artist"].casefold())
+                albums.setdefault(key, album)
+        return sorted(albums.values(), key=lambda a: a["title"].casefold())
+
+    def get_all_albums(self) -> List[str]:
+        return [a["title"] for a in self.get_album_list()]
+
+    def get_songs_for_album(self, album_name: str) -> Tuple[str, List[Song]]:
+        """The best match from all the servers is picked"""
+        results = self.gather(lambda s: s.get_songs_for_album(album_name))
+        if not results:
+            raise AlbumNotFoundException(album_name)
+        # max() keeps the first of the best matches, following the servers order
+        _, best = max(results, key=lambda r: similarity(album_name, r[1][0]))
+        return best
+
+    def get_playlists(self) -> List[Dict[str, Any]]:
+        playlists: List[Dict[str, Any]] = []
+        for server, server_playlists in self.gather(lambda s: s.get_playlists()):
+            playlists.extend(p | {"server": server.name} for p in server_playlists)
+        return playlists
+
+    def get_playlist_song_ids(self, playlist_name: str) -> Tuple[str, List[str]]:
+        results = self.gather(lambda s: s.get_playlist_song_ids(playlist_name))
+        if not results:
+            raise PlaylistNotFoundException(playlist_name)
+        server, (name, song_ids) = max(
+            results, key=lambda r: similarity(playlist_name, r[1][0])
+        )
+        return name, [qualify(server, i) for i in song_ids]
+
+    def get_songs_by_id(self, song_ids: List[str]) -> Dict[str, Song]:
+        """Takes the ids returned by get_playlist_song_ids. Raises UnresolvedSongs
+        with the songs found if some servers did not answer: their songs are not
+        missing, they must be asked again later."""
+        ids_per_server: Dict[str, List[str]] = {}
+        for song_id in song_ids:
+            server_name, _, server_id = song_id.partition("/")
+            ids_per_server.setdefault(server_name, []).append(server_id)
+        # Unknown servers were removed from the configuration, their songs are lost
+        servers = [self.by_name[n] for n in ids_per_server if n in self.by_name]
+        results, failures = self.gather_all(
+            servers, lambda s: s.get_songs_by_id(ids_per_server[s.name])
+        )
+        songs: Dict[str, Song] = {}
+        for server, server_songs in results:
+            songs.update({qualify(server, i): s for i, s in server_songs.items()})
+        if failures:
+            unanswered = {i for i in song_ids if i.partition("/")[0] in failures}
+            raise UnresolvedSongs(songs, unanswered)
+        return songs
+
+    def get_random_songs(self, count: int) -> List[Song]:
+        per_server = -(-count // len(self.servers))
+        songs = [
+            song
+            for _, server_songs in self.gather(lambda s: s.get_random_songs(per_server))
+            for song in server_songs
+        ]
+        random.shuffle(songs)
+        return songs[:count]
+
+    def get_similar_songs(self, song: Song, count: int) -> List[Song]:
+        """Only the server of the song knows about it"""
+        server = self.by_name.get(song.server, self.servers[0])
+        results = self.gather_on(
+            [server], lambda s: s.get_similar_songs(song.id, count)
+        )
+        return results[0][1] if results else []
+
+    def get_top_songs(self, artist: str, count: int) -> List[Song]:
+        songs = [
+            song
+            for _, server_songs in self.gather(lambda s: s.get_top_songs(artist, count))
+            for song in server_songs
+        ]
+        return unique_songs(songs)[:count]
@@ -0,0 +1,93 @@
+import json
+import re
+from codecs import getincrementaldecoder
+from typing import Any, Iterable, Iterator
+
+WHITESPACE = " \t\n\r"
+
+
+class ArrayNotFoundError(Exception):
+    """Raised when the whole document was read without finding the array. The
+    document is expected to be small in that case (e.g. an error message from the
+    server), so it is parsed and attached to the exception."""
+
+    def __init__(self, key: str, document: Any):
+        self.key = key
+        self.document = document
+
+    def __str__(self):
+        return f"No array found for key {self.key}"
+
+
+class UnterminatedArrayError(json.JSONDecodeError):
+    def __init__(self, key: str):
+        super().__init__(f"The array {key} is not terminated", "", 0)
+
+
+def skip_chars(text: str, pos: int, chars: str) -> int:
+    """Index of the first character from `pos` that is not in `chars`"""
+    while pos < len(text) and text[pos] in chars:
+        pos += 1
+    return pos
+
+
+def iter_array(chunks: Iterable[bytes], key: str) -> Iterator[Any]:
+    """Incrementally parse a JSON document and yield the items of the first array
+    stored under `key`, as soon as they are fully received.
+
+    Only the current item is kept in memory, so the peak memory usage does not
+    depend on the number of items in the array. Everything after the array is
+    ignored.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = getincrementaldecoder("utf-8")()
+    chunks_iter = iter(chunks)
+    pattern = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+    buffer = ""
+    # Start of what is not parsed yet. The buffer is only trimmed when a chunk is
+    # read, not after every item.
+    pos = 0
+    eof = False
+
+    def read_more() -> bool:
+        nonlocal buffer, pos, eof
+        if eof:
+            return False
+        try:
+            text = text_decoder.decode(next(chunks_iter))
+        except StopIteration:
+            text = text_decoder.decode(b"", final=True)
+            eof = True
+        buffer = buffer[pos:] + text
+        pos = 0
+        return True
+
+    # Everything before the array is kept, but that's only a handful of fields
+    while not (match := pattern.search(buffer)):
+        if not read_more():
+            raise ArrayNotFoundError(key, json.loads(buffer))
+    pos = match.end()
+
+    while True:
+        pos = skip_chars(buffer, pos, WHITESPACE + ",")
+        if pos == len(buffer):
+            if not read_more():
+                raise UnterminatedArrayError(key)
+            continue
+        if buffer[pos] == "]":
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Most likely the item is not fully received yet
+            if not read_more():
+                raise
+            continue
+        following = skip_chars(buffer, end, WHITESPACE)
+        if (following == len(buffer) or buffer[following] not in ",]") and read_more():
+            # A truncated scalar can still be valid ("3" out of "3.25"), the item
+            # is only complete once we see the separator that follows it
+            continue
+        pos = end
+        yield item
@@ -0,0 +1,253 @@
+import json
+import math
+import os
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from contextlib import contextmanager
+from enum import Enum
+from threading import Lock
+from typing import Callable, Dict, Generator, Iterable, Optional, Set
+
+from requests.exceptions import RequestException
+
+from castme.config import Config
+from castme.messages import debug as msg_debug
+from castme.messages import error
+from castme.resilience import ResilientHttp
+from castme.song import Song
+
+# Loudness the gains bring the songs to, the same as ReplayGain 2
+REFERENCE_DBFS = -18.0
+# Only one sample out of ANALYSIS_STRIDE is measured, which is plenty for music
+ANALYSIS_STRIDE = 16
+SAMPLE_WIDTH = 16
+# Difference between the volume set and the one read back, due to rounding
+VOLUME_TOLERANCE = 0.02
+
+# Decodes a song into its raw samples, signed SAMPLE_WIDTH bits. Returns None if the
+# song cannot be decoded, raises if it cannot be decoded for now.
+Decoder = Callable[[bytes], Optional[bytes]]
+
+
+def debug(msg: str):
+    msg_debug("loudness", msg)
+
+
+class InvalidGainMode(Exception):
+    def __init__(self, mode: str):
+        self.mode = mode
+
+    def __str__(self):
+        return f"Invalid replaygain mode {self.mode}, expected one of: {', '.join(m.value for m in GainMode)}"
+
+
+class GainMode(Enum):
+    ALBUM = "album"
+    TRACK = "track"
+    OFF = "off"
+
+
+def measure_gain(samples: bytes) -> Optional[float]:
+    """Gain bringing the song to REFERENCE_DBFS, from the RMS of its samples. It is
+    not the ReplayGain algorithm, but close enough to even out the songs without
+    metadata. None for a silent song."""
+    width = SAMPLE_WIDTH // 8
+    measured = memoryview(samples[: len(samples) // width * width]).cast("h")
+    measured = measured[::ANALYSIS_STRIDE]
+    if not measured:
+        return None
+    rms = math.sqrt(sum(s * s for s in measured) / len(measured))
+    if rms == 0:
+        return None
+    return REFERENCE_DBFS - 20 * math.log10(rms / 2 ** (SAMPLE_WIDTH - 1))
+
+
+class Normalizer:
+    """Gain to apply to each song so that they all play as loud, from the ReplayGain
+    metadata of the server.
+
+    The songs without metadata are measured once by a background worker, and the
+    result is kept in a file. The backends ask for the songs to come to be measured
+    in advance, a song not measured yet is played without gain. Decoding the songs
+    is left to the local backend, see set_decoder: nothing is measured without it.
+    """
+
+    def __init__(
+        self,
+        mode: GainMode = GainMode.OFF,
+        preamp: float = 0.0,
+        path: Optional[str] = None,
+    ):
+        self.mode = mode
+        self.preamp = preamp
+        self.path = path
+        self.lock = Lock()
+        # Gains measured, by server and song id. None if the song could not be
+        # decoded, it is not attempted again.
+        self.measured: Dict[str, Optional[float]] = self.load()
+        self.scheduled: Set[str] = set()
+        # Could not be downloaded, attempted again in the next sessions only
+        self.failed: Set[str] = set()
+        self.decoder: Optional[Decoder] = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="loudness")
+        self.http = ResilientHttp()
+
+    @staticmethod
+    def key(song: Song) -> str:
+        return f"{song.server}/{song.id}"
+
+    def set_decoder(self, decoder: Decoder):
+        self.decoder = decoder
+
+    def load(self) -> Dict[str, Optional[float]]:
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding="utf-8") as fd:
+                return json.load(fd)
+        except json.JSONDecodeError as e:
+            error(f"Ignoring the corrupted loudness file {self.path}: {e}")
+            return {}
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            measured = dict(self.measured)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fd:
+            json.dump(measured, fd)
+        os.replace(tmp_path, self.path)
+
+    def gain(self, song: Song) -> Optional[float]:
+        """In dB, None if unknown"""
+        if self.mode == GainMode.ALBUM and song.album_gain is not None:
+            return song.album_gain
+        if song.track_gain is not None:
+            return song.track_gain
+        with self.lock:
+            return self.measured.get(self.key(song))
+
+    def factor(self, song: Song) -> float:
+        """Factor to apply to the volume for `song`, at most 1"""
+        if self.mode == GainMode.OFF:
+            return 1.0
+        gain = self.gain(song)
+        if gain is None:
+            debug(f"No gain known for {song.title}")
+            gain = 0.0
+        return min(1.0, 10 ** ((gain + self.preamp) / 20))
+
+    def prepare(self, songs: Iterable[Song], content: Optional[bytes] = None):
+        """Measure the songs without metadata in the background. The content can
+        be given when already downloaded, for a single song."""
+        if self.mode == GainMode.OFF or self.decoder is None:
+            return
+        for song in songs:
+            if self.gain(song) is not None:
+                continue
+            key = self.key(song)
+            with self.lock:
+                if key in self.measured or key in self.failed or key in self.scheduled:
+                    continue
+                self.scheduled.add(key)
+            self.executor.submit(self.analyze, song, content)
+
+    def analyze(self, song: Song, content: Optional[bytes]):
+        assert self.decoder is not None
+        key = self.key(song)
+        try:
+            if content is None:
+                response = self.http.get(song.url, timeout=(3.05, 10), stream=True)
+                response.raise_for_status()
+                content = response.content
+            samples = self.decoder(content)
+            gain = measure_gain(samples) if samples is not None else None
+            with self.lock:
+                self.measured[key] = gain
+        except (RequestException, CancelledError, TimeoutError) as e:
+            debug(f"Could not measure {song.title}: {e}")
+            with self.lock:
+                self.failed.add(key)
+            return
+        finally:
+            with self.lock:
+                self.scheduled.discard(key)
+        if gain is None:
+            debug(f"Could not measure {song.title}, it will be played without gain")
+        else:
+            debug(f"Measured {song.title}: {gain:.1f}dB")
+        self.save()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class Volume:
+    """Volume of a backend, combining the volume asked by the user and the factor of
+    the song playing. The volume can also be changed by other means, e.g. from
+    another Cast application: it is read back from the device."""
+
+    def __init__(
+        self,
+        normalizer: Normalizer,
+        get_volume: Callable[[], float],
+        set_volume: Callable[[float], None],
+    ):
+        self.normalizer = normalizer
+        self.get_volume = get_volume
+        self.set_volume = set_volume
+        self.factor = 1.0
+        # Volume asked by the user, and the one given to the device
+        self.user: Optional[float] = None
+        self.applied: Optional[float] = None
+        self.lock = Lock()
+
+    def user_volume(self) -> float:
+        """Must be called with the lock held"""
+        current = self.get_volume()
+        if self.user is not None and self.applied is not None:
+            # The devices round the volume, it must not drift at each song
+            if abs(current - self.applied) < VOLUME_TOLERANCE:
+                return self.user
+        return min(1.0, current / self.factor)
+
+    def apply(self, user: float):
+        """Must be called with the lock held"""
+        self.user = max(0.0, min(1.0, user))
+        self.applied = self.user * self.factor
+        self.set_volume(self.applied)
+
+    def set(self, value: float):
+        with self.lock:
+            self.apply(value)
+
+    def delta(self, value: float):
+        with self.lock:
+            self.apply(self.user_volume() + value)
+
+    def song_changed(self, song: Song):
+        factor = self.normalizer.factor(song)
+        with self.lock:
+            if factor == self.factor:
+                # e.g. the next song of the same album
+                return
+            user = self.user_volume()
+            self.factor = factor
+            debug(f"Volume factor {factor:.2f} for {song.title}")
+            self.apply(user)
+
+
+@contextmanager
+def normalizer(config: Config) -> Generator[Normalizer, None, None]:
+    try:
+        mode = GainMode(config.replaygain)
+    except ValueError:
+        raise InvalidGainMode(config.replaygain) from None
+    the_normalizer = Normalizer(
+        mode, config.replaygain_preamp, os.path.expanduser(config.loudness_file)
+    )
+    try:
+        yield the_normalizer
+    finally:
+        the_normalizer.close()
@@ -2,19 +2,42 @@ import argparse
 import cmd
 import os
 import shutil
+from contextlib import nullcontext
 from importlib.metadata import PackageNotFoundError, version
 from pathlib import Path
 from shutil import get_terminal_size
 from sys import exit as sys_exit
-from typing import Dict, List
+from threading import Lock, Thread
+from typing import Any, Dict, List, Optional
+
+from requests.exceptions import RequestException
 
 from castme.backends.chromecast import backend as chromecast_backend
 from castme.backends.local import backend as local_backend
+from castme.completion import Completer, readline_matches
 from castme.config import Config
-from castme.messages import debug_mode_enabled, enable_debug_mode, error, message
-from castme.player import Backend, NoSongsToPlayException
-from castme.song import Song
-from castme.subsonic import AlbumNotFoundException, SubSonic, SubsonicApiError
+from castme.federation import FederatedSubSonic
+from castme.loudness import normalizer
+from castme.messages import (
+    debug,
+    debug_mode_enabled,
+    enable_debug_mode,
+    error,
+    message,
+)
+from castme.player import Backend, NoSongsToPlayException, PlaybackObserver
+from castme.prewarm import Prewarmer, prewarmer
+from castme.radio import InvalidRadioMode, Radio, RadioMode
+from castme.radio import radio as radio_refiller
+from castme.scrobbler import scrobbler
+from castme.session import Session, session
+from castme.song_queue import QueueEntry, Range, SongQueue
+from castme.subsonic import (
+    AlbumNotFoundException,
+    PlaylistNotFoundException,
+    SubSonic,
+    SubsonicApiError,
+)
 
 
 class InvalidBackend(Exception):
@@ -25,6 +48,33 @@ class InvalidBackend(Exception):
         return f"Invalid backend name {self.invalid_name}"
 
 
+class InvalidRange(Exception):
+    def __init__(self, spec: str):
+        self.spec = spec
+
+    def __str__(self):
+        return f"Invalid range {self.spec!r}"
+
+
+def parse_ranges(spec: str, size: int) -> List[Range]:
+    """Parse ranges of songs like "2 5-8 10-", numbered as displayed by `queue`
+    (from 1, inclusive), into [start, stop) indexes of the queue"""
+    ranges = []
+    for token in spec.replace(",", " ").split():
+        first, dash, last = token.partition("-")
+        try:
+            start = int(first) - 1
+            stop = (int(last) if last else size) if dash else start + 1
+        except ValueError:
+            raise InvalidRange(token) from None
+        if start < 0 or stop <= start:
+            raise InvalidRange(token)
+        ranges.append((start, stop))
+    if not ranges:
+        raise InvalidRange(spec)
+    return ranges
+
+
 def castme_version():
     try:
         return version("castme")
@@ -34,19 +84,50 @@ def castme_version():
 
 SUBSONIC_APP_ID = "castme"
 
+ALIASES = {
+    "pp": "playpause",
+    "pl": "playlist",
+    "ra": "radio",
+    "l": "list",
+    "n": "next",
+    "q": "queue",
+    "v": "volume",
+    "c": "clear",
+    "x": "quit",
+    "s": "switch",
+    "r": "rewind",
+    "rm": "remove",
+    "mv": "move",
+    "EOF": "quit",  # Set by Cmd itself on Ctrl-D
+}
+
 
 class CastMeCli(cmd.Cmd):
-    def __init__(
+    def __init__(  # noqa: PLR0913, PLR0917
         self,
-        subsonic: SubSonic,
+        subsonic: FederatedSubSonic,
         targets: Dict[str, Backend],
         default_backend: str,
-        songs: List[Song],
+        songs: SongQueue,
+        radio: Radio,
+        session: Session,
+        albums: Optional[Prewarmer],
     ):
         super().__init__()
         self.min_column_width = 50
         self.subsonic = subsonic
         self.songs = songs
+        self.radio = radio
+        self.session = session
+        # Source of the songs of the queued albums, loaded in advance when possible
+        self.albums_source = albums or subsonic
+        # Names used for the tab completion, loaded in the background
+        self.albums = Completer()
+        self.artists = Completer()
+        self.playlists = Completer()
+        self.catalog_lock = Lock()
+        self.catalog_loaded = False
+        self.catalog_loader: Optional[Thread] = None
         self.targets = targets
         if default_backend not in targets:
             raise InvalidBackend(default_backend)
@@ -54,6 +135,94 @@ class CastMeCli(cmd.Cmd):
         self.current_target = targets[default_backend]
         message(f"Currently playing on {default_backend}")
         self.update_prompt(default_backend)
+        self.session.set_backend(default_backend)
+        self.session.track_position(self.current_position)
+        self.load_catalog()
+        if self.songs:
+            message(
+                f"{len(self.songs)} songs restored from the previous session, use resume to continue"
+            )
+
+    def refresh_albums(self, albums: List[Dict[str, str]]):
+        with self.catalog_lock:
+            self.albums.update(a["title"] for a in albums)
+            self.artists.update(a["artist"] for a in albums if a["artist"])
+
+    def refresh_playlists(self, playlists: List[Dict[str, Any]]):
+        with self.catalog_lock:
+            self.playlists.update(p["name"] for p in playlists)
+
+    def load_catalog(self):
+        """Load the names used for the completion in a background thread, unless
+        they are already loaded or being loaded. The completion never waits for the
+        servers, it uses the names loaded so far."""
+        with self.catalog_lock:
+            if self.catalog_loaded or (
+                self.catalog_loader is not None and self.catalog_loader.is_alive()
+            ):
+                return
+            # Not joined, quitting must not wait for a slow server
+            self.catalog_loader = Thread(
+                target=self.fetch_catalog, name="catalog", daemon=True
+            )
+            self.catalog_loader.start()
+
+    def fetch_catalog(self):
+        try:
+            albums = self.subsonic.get_album_list()
+            playlists = self.subsonic.get_playlists()
+        except (SubsonicApiError, RequestException) as e:
+            # Attempted again on the next completion
+            debug("cli", f"Could not load the catalog: {e}")
+            return
+        self.refresh_albums(albums)
+        self.refresh_playlists(playlists)
+        with self.catalog_lock:
+            self.catalog_loaded = True
+        debug("cli", f"Catalog loaded, {len(albums)} albums")
+
+    def complete_names(
+        self, completer: Completer, argument: str, text: str
+    ) -> List[str]:
+        self.load_catalog()
+        with self.catalog_lock:
+            matches = completer.complete(argument)
+        return readline_matches(matches, argument, text)
+
+    def complete_queue(self, text: str, line: str, _begidx: int, endidx: int):
+        argument = line[:endidx].partition(" ")[2]
+        return self.complete_names(self.albums, argument, text)
+
+    def complete_playlist(self, text: str, line: str, _begidx: int, endidx: int):
+        argument = line[:endidx].partition(" ")[2]
+        return self.complete_names(self.playlists, argument, text)
+
+    def complete_switch(self, text: str, _line: str, _begidx: int, _endidx: int):
+        return [t for t in self.targets if t.startswith(text)]
+
+    def complete_radio(self, text: str, line: str, _begidx: int, endidx: int):
+        mode, separator, artist = line[:endidx].partition(" ")[2].partition(" ")
+        if not separator:
+            return [
+                m for m in [*(m.value for m in RadioMode), "off"] if m.startswith(text)
+            ]
+        if mode == "top":
+            return self.complete_names(self.artists, artist, text)
+        return []
+
+    def completedefault(self, text: str, line: str, begidx: int, endidx: int):
+        """Complete the aliases like the commands they stand for"""
+        command, _, rest = line.partition(" ")
+        if command in ALIASES:
+            completer = getattr(self, f"complete_{ALIASES[command]}", None)
+            if completer:
+                full_line = f"{ALIASES[command]} {rest}"
+                offset = len(ALIASES[command]) - len(command)
+                return completer(text, full_line, begidx + offset, endidx + offset)
+        return []
+
+    def current_position(self) -> Optional[float]:
+        return self.current_target.position()
 
     def update_prompt(self, label: str):
         self.prompt = f"[{label}] >> "
@@ -65,7 +234,9 @@ class CastMeCli(cmd.Cmd):
         """List all the albums available (alias: l)"""
         try:
             term_cols, term_rows = get_terminal_size()
-            albums = self.subsonic.get_all_albums()
+            album_list = self.subsonic.get_album_list()
+            self.refresh_albums(album_list)
+            albums = [a["title"] for a in album_list]
             number_of_columns = term_cols // self.min_column_width or 1
             # We can get some extra chars by dispatching the remainder characters to
             # each column
@@ -93,7 +264,7 @@ class CastMeCli(cmd.Cmd):
 
                 if albums:
                     input(" .... Press <Enter> to continue ....")
-        except SubsonicApiError as e:
+        except (SubsonicApiError, RequestException) as e:
             error(str(e))
 
     def emptyline(self):
@@ -113,32 +284,167 @@ class CastMeCli(cmd.Cmd):
                 self.current_target.force_play()
 
             self.update_prompt(line)
+            self.session.set_backend(line)
         else:
             error(f"Could not find target {line}")
 
     def do_clear(self, _line: str):
-        """Clear the queue and stop the music (alias: c)"""
+        """Clear the queue, stop the music and the radio (alias: c)"""
+        self.radio.stop()
         self.songs.clear()
         self.current_target.stop()
 
     def do_queue(self, line: str):
         """Queue an album. The argument to that command will be matched against all
         albums on the device and the best matching one will be played (alias: q).
+        Without argument, show the songs following the current one, see view.
         """
         if not line:
-            for idx, s in enumerate(self.songs):
-                message(f"{1 + idx:2} {s}")
+            self.show_queue(1)
             return
         try:
             start_empty = len(self.songs) == 0
-            name, songs = self.subsonic.get_songs_for_album(line)
+            name, songs = self.albums_source.get_songs_for_album(line)
             message(f"Queueing {name}")
             self.songs.extend(songs)
             if start_empty:
                 self.current_target.force_play()
-        except (SubsonicApiError, AlbumNotFoundException) as e:
+        except (SubsonicApiError, AlbumNotFoundException, RequestException) as e:
             error(str(e))
 
+    def do_view(self, line: str):
+        """Show the songs of the queue around the song number N, or following the
+        current one without argument. Only one screen of songs is displayed."""
+        try:
+            self.show_queue(int(line) if line else 1)
+        except ValueError:
+            error("Expected the number of a song")
+
+    def show_queue(self, position: int):
+        """Only the displayed part of the queue is read, it can be huge"""
+        total = len(self.songs)
+        if not total:
+            message("The queue is empty")
+            return
+        page = max(1, get_terminal_size()[1] - 2)
+        # The current song is at the top, the others are centered
+        start = 0 if position <= 1 else max(0, position - 1 - page // 2)
+        start = max(0, min(start, total - page))
+        width = max(2, len(str(total)))
+        entries = self.songs.page(start, page)
+        for index, entry in enumerate(entries, start + 1):
+            message(f"{index:{width}} {entry}")
+        if len(entries) < total:
+            message(
+                f"Songs {start + 1}-{start + len(entries)} of {total}, "
+                "use view N to see the others"
+            )
+
+    def do_remove(self, line: str):
+        """Remove songs from the queue, numbered as shown by queue, e.g.
+        remove 2 5-8 10-: remove the 2nd song, the 5th to 8th and from the 10th
+        (alias: rm)"""
+        try:
+            ranges = parse_ranges(line, len(self.songs))
+        except InvalidRange as e:
+            error(f"{e}, expected e.g. 2 5-8 10-")
+            return
+        head = self.songs.peek(0)
+        removed = self.songs.remove_ranges(ranges)
+        message(f"Removed {removed} songs")
+        self.queue_edited(head)
+
+    def do_move(self, line: str):
+        """Move songs before another one, numbered as shown by queue, e.g.
+        move 5-8 2: move the 5th to 8th songs just after the current one
+        (alias: mv)"""
+        spec, _, destination = line.rpartition(" ")
+        head = self.songs.peek(0)
+        try:
+            ranges = parse_ranges(spec, len(self.songs))
+            if len(ranges) == 1:
+                self.songs.move(*ranges[0], int(destination) - 1)
+        except (InvalidRange, ValueError, IndexError):
+            ranges = []
+        if len(ranges) != 1:
+            error("Invalid songs, expected e.g. move 5-8 2")
+            return
+        self.queue_edited(head)
+
+    def do_dedupe(self, _line: str):
+        """Remove the songs queued several times, the first one is kept"""
+        head = self.songs.peek(0)
+        message(f"Removed {self.songs.dedupe()} songs")
+        self.queue_edited(head)
+
+    def do_shuffle(self, _line: str):
+        """Shuffle the songs following the current one"""
+        self.songs.shuffle()
+
+    def queue_edited(self, head: Optional[QueueEntry]):
+        """Play the new first song if the one playing was removed or moved"""
+        if self.songs.peek(0) is head or self.current_position() is None:
+            return
+        if not self.songs:
+            self.current_target.stop()
+            return
+        try:
+            self.current_target.force_play()
+        except NoSongsToPlayException:
+            error("None of the songs in the queue could be loaded")
+
+    def do_playlist(self, line: str):
+        """Queue a playlist. The argument is matched against the playlists on the
+        server, like for queue. Without argument, list the playlists (alias: pl).
+        """
+        try:
+            if not line:
+                playlists = self.subsonic.get_playlists()
+                self.refresh_playlists(playlists)
+                for p in playlists:
+                    message(f"{p['name']} ({p['songCount']} songs, {p['server']})")
+                return
+            start_empty = len(self.songs) == 0
+            name, song_ids = self.subsonic.get_playlist_song_ids(line)
+            message(f"Queueing {name} ({len(song_ids)} songs)")
+            # The songs themselves are only loaded when they are about to be played
+            self.songs.extend_pending(song_ids)
+            if start_empty and self.songs:
+                self.current_target.force_play()
+        except (SubsonicApiError, PlaylistNotFoundException, RequestException) as e:
+            error(str(e))
+
+    def do_radio(self, line: str):
+        """Keep the queue filled with songs chosen by the server (alias: ra)
+        radio random: random songs
+        radio similar: songs similar to the last one in the queue
+        radio top [ARTIST]: top songs of ARTIST, or of the artist of the last song
+        radio off: stop adding songs
+        """
+        mode, _, artist = line.partition(" ")
+        if mode == "off":
+            self.radio.stop()
+            return
+        try:
+            self.radio.start(mode or "random", artist or None, self.radio_refilled)
+        except InvalidRadioMode as e:
+            error(str(e))
+
+    def radio_refilled(self):
+        """Called from the radio thread when songs are added to an empty queue"""
+        try:
+            self.current_target.force_play()
+        except NoSongsToPlayException:
+            pass
+
+    def do_resume(self, _line: str):
+        """Resume playing the first song in the queue where it was stopped, even
+        in a previous session"""
+        try:
+            self.current_target.force_play(self.session.position)
+        except NoSongsToPlayException:
+            error("No songs in the queue")
+
     def do_playpause(self, _line: str):
         """play/pause the song (alias: pp)"""
         self.current_target.playpause()
@@ -176,20 +482,8 @@ class CastMeCli(cmd.Cmd):
 
     def precmd(self, line: str) -> str:
         potential_alias = line.split(" ")[0]
-        aliases = {
-            "pp": "playpause",
-            "l": "list",
-            "n": "next",
-            "q": "queue",
-            "v": "volume",
-            "c": "clear",
-            "x": "quit",
-            "s": "switch",
-            "r": "rewind",
-            "EOF": "quit",  # Set by Cmd itself on Ctrl-D
-        }
-        if potential_alias in aliases:
-            return line.replace(potential_alias, aliases[potential_alias], 1)
+        if potential_alias in ALIASES:
+            return line.replace(potential_alias, ALIASES[potential_alias], 1)
         else:
             return line
 
@@ -233,22 +527,46 @@ def main():
             sys_exit(0)
 
         config = Config.load(config_path)
-        subsonic = SubSonic(
-            SUBSONIC_APP_ID, config.user, config.password, config.subsonic_server
+        subsonic = FederatedSubSonic(
+            [
+                SubSonic(
+                    SUBSONIC_APP_ID,
+                    server.user,
+                    server.password,
+                    server.subsonic_server,
+                    name=server.name,
+                )
+                for server in config.all_servers()
+            ],
+            config.server_deadline,
         )
 
-        songs_queue: List[Song] = []
+        songs_queue = SongQueue(subsonic.get_songs_by_id)
 
         with (
-            chromecast_backend(config, songs_queue) as chromecast,
-            local_backend(config, songs_queue) as local,
+            session(config.session_file, songs_queue) as the_session,
+            (
+                scrobbler(subsonic, config.scrobble_file)
+                if config.scrobble
+                else nullcontext(PlaybackObserver())
+            ) as observer,
+            normalizer(config) as the_normalizer,
+            chromecast_backend(
+                config, songs_queue, observer, the_normalizer
+            ) as chromecast,
+            local_backend(config, songs_queue, observer, the_normalizer) as local,
+            radio_refiller(subsonic, songs_queue, config.radio_lookahead) as radio,
+            prewarmer(subsonic, config, chromecast.relay) as albums,
         ):
 
             cli = CastMeCli(
                 subsonic,
                 {"chromecast": chromecast, "local": local},
-                args.backend or config.default_backend,
+                args.backend or the_session.backend or config.default_backend,
                 songs_queue,
+                radio,
+                the_session,
+                albums,
             )
             cli.cmdloop()
     except Exception as e:
@@ -1,14 +1,32 @@
 from abc import abstractmethod
+from typing import Optional
+
+from castme.song import Song
 
 
 class NoSongsToPlayException(Exception):
     pass
 
 
+class PlaybackObserver:
+    """Notified by the backends of the songs they play. Called from the playback
+    threads, so the methods must return quickly."""
+
+    def started(self, song: Song):
+        pass
+
+    def finished(self, song: Song):
+        pass
+
+
 class Backend:
     @abstractmethod
-    def force_play(self):
-        """Force playing the first song in the queue"""
+    def force_play(self, start: float = 0):
+        """Force playing the first song in the queue, from `start` seconds"""
+
+    @abstractmethod
+    def position(self) -> Optional[float]:
+        """Position in seconds in the current song, None if nothing is playing"""
 
     @abstractmethod
     def rewind(self):
@@ -0,0 +1,265 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+from typing import Dict, Generator, List, Optional, Tuple
+
+from requests.exceptions import RequestException
+
+from castme.config import Config
+from castme.federation import FederatedSubSonic
+from castme.messages import debug as msg_debug
+from castme.messages import error
+from castme.relay import Relay
+from castme.song import Song
+from castme.subsonic import AlbumNotFoundException, SubsonicApiError
+
+# Albums remembered, the least queued ones are forgotten first
+MAX_ALBUMS = 1000
+# Time without an album queued before loading the predicted ones
+IDLE_DELAY = 5.0
+# The albums loaded in advance are not used after that, they may have changed
+WARM_TTL = 600.0
+
+
+def debug(msg: str):
+    msg_debug("prewarm", msg)
+
+
+class AlbumHistory:
+    """Albums queued, how often, and which one was queued after which one. The
+    keywords typed are kept too, to know which album they resolve to without
+    calling the server."""
+
+    def __init__(self, path: str, max_albums: int = MAX_ALBUMS):
+        self.path = path
+        self.max_albums = max_albums
+        self.counts: Dict[str, int] = {}
+        # Album -> albums queued right after it -> count
+        self.transitions: Dict[str, Dict[str, int]] = {}
+        self.keywords: Dict[str, str] = {}
+        self.last: Optional[str] = None
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as fd:
+                data = json.load(fd)
+        except json.JSONDecodeError as e:
+            error(f"Ignoring the corrupted albums history {self.path}: {e}")
+            return
+        self.counts = data["counts"]
+        self.transitions = data["transitions"]
+        self.keywords = data["keywords"]
+        self.last = data["last"]
+        debug(f"{len(self.counts)} albums in the history")
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fd:
+            json.dump(
+                {
+                    "counts": self.counts,
+                    "transitions": self.transitions,
+                    "keywords": self.keywords,
+                    "last": self.last,
+                },
+                fd,
+            )
+        os.replace(tmp_path, self.path)
+
+    def record(self, keyword: str, album: str):
+        self.keywords[keyword.casefold()] = album
+        self.counts[album] = self.counts.get(album, 0) + 1
+        if self.last is not None and self.last != album:
+            following = self.transitions.setdefault(self.last, {})
+            following[album] = following.get(album, 0) + 1
+        self.last = album
+        if len(self.counts) > self.max_albums:
+            self.prune()
+
+    def resolve(self, keyword: str) -> Optional[str]:
+        return self.keywords.get(keyword.casefold())
+
+    def predict(self, count: int) -> List[str]:
+        """The albums most often queued after the last one, then the most queued"""
+        if count <= 0:
+            return []
+        following = self.transitions.get(self.last, {}) if self.last else {}
+        candidates = [
+            *sorted(following, key=following.__getitem__, reverse=True),
+            *sorted(self.counts, key=self.counts.__getitem__, reverse=True),
+        ]
+        predictions: List[str] = []
+        for album in candidates:
+            if album != self.last and album not in predictions:
+                predictions.append(album)
+            if len(predictions) == count:
+                break
+        return predictions
+
+    def prune(self):
+        """The last album is always kept"""
+        others = [a for a in self.counts if a != self.last]
+        others.sort(key=self.counts.__getitem__, reverse=True)
+        kept = {*others[: self.max_albums - 1], self.last}
+        self.counts = {a: c for a, c in self.counts.items() if a in kept}
+        self.transitions = {
+            a: {n: c for n, c in following.items() if n in kept}
+            for a, following in self.transitions.items()
+            if a in kept
+        }
+        self.keywords = {k: a for k, a in self.keywords.items() if a in kept}
+
+
+class Prewarmer:
+    """Load in advance the albums likely to be queued next, predicted from the
+    history of the albums queued.
+
+    The predicted albums are loaded from a background thread, once no album was
+    queued for IDLE_DELAY seconds. With the relay, the start of their first song
+    can be downloaded too, so that the relay starts playing it without waiting for
+    the server. The hit rate shows whether the predictions are worth it.
+    """
+
+    def __init__(  # noqa: PLR0913, PLR0917
+        self,
+        subsonic: FederatedSubSonic,
+        history: AlbumHistory,
+        albums: int = 3,
+        relay: Optional[Relay] = None,
+        head_bytes: int = 0,
+        rate: int = 256 * 1024,
+    ):
+        self.subsonic = subsonic
+        self.history = history
+        self.albums = albums
+        self.relay = relay
+        self.head_bytes = head_bytes
+        self.rate = rate
+        self.lock = Lock()
+        # Album -> (time loaded, songs)
+        self.warm: Dict[str, Tuple[float, List[Song]]] = {}
+        self.lookups = 0
+        self.hits = 0
+        self.last_activity = time.monotonic()
+        self.wakeup = Event()
+        self.closing = False
+        self.thread = Thread(target=self.loop, name="prewarm")
+        if history.last is not None:
+            # Predictions from the previous sessions
+            self.wakeup.set()
+        self.thread.start()
+
+    def hit_rate(self) -> float:
+        with self.lock:
+            return self.hits / self.lookups if self.lookups else 0.0
+
+    def get_songs_for_album(self, keyword: str) -> Tuple[str, List[Song]]:
+        """Same as FederatedSubSonic.get_songs_for_album, from the albums loaded in
+        advance when possible"""
+        with self.lock:
+            self.last_activity = time.monotonic()
+            album = self.history.resolve(keyword)
+            warm = self.warm.pop(album, None) if album else None
+            hit = warm is not None and time.monotonic() - warm[0] < WARM_TTL
+            self.lookups += 1
+            if hit:
+                self.hits += 1
+            debug(
+                f"{'Hit' if hit else 'Miss'} for {keyword}, "
+                f"hit rate {self.hits / self.lookups:.0%} of {self.lookups}"
+            )
+        if warm is not None and album and hit:
+            name, songs = album, warm[1]
+        else:
+            name, songs = self.subsonic.get_songs_for_album(keyword)
+        with self.lock:
+            self.history.record(keyword, name)
+        self.wakeup.set()
+        return name, songs
+
+    def loop(self):
+        while not self.closing:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if self.wait_idle():
+                self.warm_up()
+            with self.lock:
+                self.history.save()
+
+    def wait_idle(self) -> bool:
+        """Returns False if closing meanwhile"""
+        while not self.closing:
+            with self.lock:
+                remaining = self.last_activity + IDLE_DELAY - time.monotonic()
+            if remaining <= 0:
+                return True
+            self.wakeup.wait(remaining)
+            self.wakeup.clear()
+        return False
+
+    def warm_up(self):
+        now = time.monotonic()
+        with self.lock:
+            predictions = self.history.predict(self.albums)
+            # The albums not predicted anymore are dropped
+            self.warm = {
+                a: w
+                for a, w in self.warm.items()
+                if a in predictions and now - w[0] < WARM_TTL
+            }
+            missing = [a for a in predictions if a not in self.warm]
+        for album in missing:
+            if self.closing or self.last_activity > now:
+                # Stop as soon as the user is back
+                return
+            try:
+                _, songs = self.subsonic.get_songs_for_album(album)
+            except (
+                SubsonicApiError,
+                AlbumNotFoundException,
+                RequestException,
+            ) as e:
+                debug(f"Could not load {album}: {e}")
+                continue
+            debug(f"Loaded {album} in advance")
+            with self.lock:
+                self.warm[album] = (time.monotonic(), songs)
+            if self.relay and self.head_bytes and songs:
+                self.relay.prewarm(songs[0], self.head_bytes, self.rate)
+
+    def close(self):
+        self.closing = True
+        self.wakeup.set()
+        self.thread.join()
+        if self.lookups:
+            self.history.save()
+        debug(f"Hit rate {self.hit_rate():.0%} of {self.lookups}")
+
+
+@contextmanager
+def prewarmer(
+    subsonic: FederatedSubSonic, config: Config, relay: Optional[Relay] = None
+) -> Generator[Optional[Prewarmer], None, None]:
+    """None when disabled"""
+    if config.prewarm_albums <= 0:
+        yield None
+        return
+    history = AlbumHistory(os.path.expanduser(config.prewarm_file))
+    history.load()
+    the_prewarmer = Prewarmer(
+        subsonic,
+        history,
+        config.prewarm_albums,
+        relay,
+        config.prewarm_head_kb * 1024,
+        config.prewarm_kbps * 1024,
+    )
+    try:
+        yield the_prewarmer
+    finally:
+        the_prewarmer.close()
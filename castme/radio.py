@@ -0,0 +1,171 @@
+from collections import deque
+from contextlib import contextmanager
+from enum import Enum
+from threading import Event, Lock, Thread
+from typing import Callable, Deque, Generator, List, Optional, Set
+
+from requests.exceptions import RequestException
+
+from castme.federation import FederatedSubSonic
+from castme.messages import debug as msg_debug
+from castme.messages import error
+from castme.song import Song
+from castme.song_queue import SongQueue
+from castme.subsonic import SubsonicApiError
+
+POLL_INTERVAL = 1.0
+ERROR_BACKOFF = 10.0
+
+
+def debug(msg: str):
+    msg_debug("radio", msg)
+
+
+class InvalidRadioMode(Exception):
+    def __init__(self, mode: str):
+        self.mode = mode
+
+    def __str__(self):
+        return f"Invalid radio mode {self.mode}, expected one of: {', '.join(m.value for m in RadioMode)}"
+
+
+class RadioMode(Enum):
+    RANDOM = "random"
+    SIMILAR = "similar"
+    TOP = "top"
+
+
+class History:
+    """Ids of the last `size` songs queued by the radio, to avoid repeating them"""
+
+    def __init__(self, size: int):
+        self.ids: Deque[str] = deque(maxlen=size)
+        self.known: Set[str] = set()
+
+    def __contains__(self, song_id: str) -> bool:
+        return song_id in self.known
+
+    def add(self, song_id: str):
+        if len(self.ids) == self.ids.maxlen:
+            self.known.discard(self.ids[0])
+        self.ids.append(song_id)
+        self.known.add(song_id)
+
+
+class Radio:
+    """Keep the queue `lookahead` songs ahead of the current one, using songs picked
+    by the server. The refill is done in a background thread, in batches."""
+
+    def __init__(
+        self,
+        subsonic: FederatedSubSonic,
+        songs: SongQueue,
+        lookahead: int = 10,
+        history_size: int = 500,
+    ):
+        self.subsonic = subsonic
+        self.songs = songs
+        self.lookahead = lookahead
+        self.history = History(history_size)
+        self.mode: Optional[RadioMode] = None
+        self.artist: Optional[str] = None
+        self.on_refill: Optional[Callable[[], None]] = None
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.closing = False
+        self.thread = Thread(target=self.loop, name="radio")
+        self.thread.start()
+
+    def start(
+        self,
+        mode: str,
+        artist: Optional[str] = None,
+        on_refill: Optional[Callable[[], None]] = None,
+    ):
+        """on_refill is called from the radio thread when songs were added to an empty
+        queue, so that playback can be started"""
+        try:
+            radio_mode = RadioMode(mode)
+        except ValueError:
+            raise InvalidRadioMode(mode) from None
+        with self.lock:
+            self.mode = radio_mode
+            self.artist = artist
+            self.on_refill = on_refill
+        self.wakeup.set()
+
+    def stop(self):
+        with self.lock:
+            self.mode = None
+
+    def close(self):
+        self.closing = True
+        self.wakeup.set()
+        self.thread.join()
+
+    def loop(self):
+        while not self.closing:
+            self.wakeup.wait(POLL_INTERVAL)
+            self.wakeup.clear()
+            try:
+                self.refill()
+            except (SubsonicApiError, RequestException) as e:
+                error(f"Radio: could not get new songs: {e}")
+                self.wakeup.wait(ERROR_BACKOFF)
+            except Exception as e:
+                # e.g. an unexpected answer, the radio must keep going anyway
+                error(f"Radio: could not add new songs: {e!r}")
+                self.wakeup.wait(ERROR_BACKOFF)
+
+    def refill(self):
+        with self.lock:
+            mode, artist, on_refill = self.mode, self.artist, self.on_refill
+        missing = self.lookahead + 1 - len(self.songs)
+        if mode is None or missing <= 0:
+            return
+
+        # Fetch more than needed, some of them will be filtered out by the history
+        candidates = self.fetch(mode, artist, 2 * missing)
+        new_songs: List[Song] = []
+        for song in candidates:
+            # Ids are only unique within a server
+            key = f"{song.server}/{song.id}"
+            if key not in self.history and len(new_songs) < missing:
+                self.history.add(key)
+                new_songs.append(song)
+        debug(f"Adding {len(new_songs)} songs out of {len(candidates)} candidates")
+        if not new_songs:
+            return
+
+        start_empty = len(self.songs) == 0
+        self.songs.extend(new_songs)
+        if start_empty and on_refill:
+            on_refill()
+
+    def fetch(self, mode: RadioMode, artist: Optional[str], count: int) -> List[Song]:
+        last = self.last_song()
+        if mode == RadioMode.SIMILAR and last is not None:
+            return self.subsonic.get_similar_songs(last, count)
+        if mode == RadioMode.TOP:
+            top_artist = artist or (last.artist if last else None)
+            if top_artist:
+                return self.subsonic.get_top_songs(top_artist, count)
+        # Random, or nothing to base the selection on (yet)
+        return self.subsonic.get_random_songs(count)
+
+    def last_song(self) -> Optional[Song]:
+        for song in reversed(list(self.songs)):
+            if isinstance(song, Song):
+                return song
+        return None
+
+
+@contextmanager
+def radio(
+    subsonic: FederatedSubSonic, songs: SongQueue, lookahead: int
+) -> Generator[Radio, None, None]:
+    the_radio = Radio(subsonic, songs, lookahead)
+    try:
+        yield the_radio
+    finally:
+        the_radio.close()
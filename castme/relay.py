@@ -0,0 +1,504 @@
+import os
+import re
+import shutil
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import sha1
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Lock, Thread, get_ident
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+from requests import Response
+from requests.exceptions import RequestException
+
+from castme.messages import debug as msg_debug
+from castme.messages import error
+from castme.resilience import ResilientHttp
+from castme.song import Song
+
+CHUNK_SIZE = 64 * 1024
+# Start of a file downloaded in advance, see AudioCache.fetch_head
+HEAD_SUFFIX = ".head"
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def debug(msg: str):
+    msg_debug("relay", msg)
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single "Range: bytes=" header into an inclusive (start, end) tuple.
+    Returns None when the whole file should be sent."""
+    if not header or not (match := RANGE_RE.match(header.strip())):
+        return None
+    start_str, end_str = match.groups()
+    if not start_str:
+        # Suffix range: the last N bytes
+        if not end_str:
+            return None
+        start, end = max(0, size - int(end_str)), size - 1
+    else:
+        start = int(start_str)
+        end = min(int(end_str), size - 1) if end_str else size - 1
+    if start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def local_address_towards(host: str) -> str:
+    """Address of the network interface used to reach `host`. No packet is sent,
+    connecting an UDP socket only selects the route."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.connect((host, 9))
+        return sock.getsockname()[0]
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Download:
+    """A file of the cache, possibly still being downloaded. Readers can stream the
+    part already written while the rest is downloading."""
+
+    def __init__(self, path: str, size: Optional[int]):
+        self.path = path
+        # None if the server did not announce it
+        self.size = size
+        self.written = 0
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.condition = Condition()
+
+    @staticmethod
+    def complete(path: str) -> "Download":
+        download = Download(path, os.path.getsize(path))
+        download.written = download.size or 0
+        download.done = True
+        return download
+
+    def open(self) -> BinaryIO:
+        # The path changes when the download completes
+        with self.condition:
+            return open(self.path, "rb")
+
+    def available(self, offset: int) -> int:
+        """Wait until the bytes after `offset` are written, and return how many of
+        them can be read. Returns 0 at the end of the file."""
+        with self.condition:
+            while self.written <= offset and not self.done and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise DownloadError() from self.error
+            return max(0, self.written - offset)
+
+    def wait(self):
+        """Wait for the end of the download"""
+        with self.condition:
+            while not self.done and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise DownloadError() from self.error
+
+
+class AudioCache:
+    """On-disk cache of the files downloaded from the Subsonic server. The least
+    recently used files are removed once the cache is bigger than `max_size`.
+
+    The start of some files can also be downloaded in advance, in `max_head_size`
+    bytes at most. When such a file is requested, its start is served right away
+    while the rest is downloaded."""
+
+    def __init__(
+        self,
+        directory: str,
+        max_size: int,
+        http: ResilientHttp,
+        max_head_size: int = 0,
+    ):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        self.max_head_size = max_head_size
+        self.http = http
+        self.lock = Lock()
+        self.key_locks: Dict[str, Lock] = {}
+        # Downloads in progress, by key
+        self.downloads: Dict[str, Download] = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str, url: str) -> str:
+        """Return the path of the cached file, downloading it first if needed"""
+        self.fetch(key, url).wait()
+        return self.path(key)
+
+    def fetch(self, key: str, url: str) -> Download:
+        """Return the cached file, or start downloading it. Only the headers of the
+        answer are waited for, the body is written to the cache in the background."""
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, Lock())
+        # Concurrent requests for the same file share a single download
+        with key_lock:
+            path = self.path(key)
+            if key in self.downloads:
+                return self.downloads[key]
+            if os.path.exists(path):
+                os.utime(path)
+                return Download.complete(path)
+            if os.path.exists(path + HEAD_SUFFIX):
+                return self.resume(key, url)
+            debug(f"Downloading {url}")
+            response = self.http.get(url, timeout=(3.05, 10), stream=True)
+            try:
+                response.raise_for_status()
+            except RequestException:
+                response.close()
+                raise
+            size = None
+            # With a Content-Encoding, the length is the one of the encoded body
+            if "Content-Encoding" not in response.headers:
+                length = response.headers.get("Content-Length")
+                size = int(length) if length else None
+            download = Download(path + ".part", size)
+            # Created right away, so that the readers can open it
+            fd = open(download.path, "wb")
+            self.downloads[key] = download
+            Thread(
+                target=self.download,
+                args=(key, url, fd, download, response),
+                name="download",
+                daemon=True,
+            ).start()
+            return download
+
+    def resume(self, key: str, url: str) -> Download:
+        """Start from the head downloaded in advance, without waiting for the server.
+        Must be called with the lock of the key held."""
+        path = self.path(key)
+        debug(f"Resuming {url} after its head")
+        download = Download(path + ".part", None)
+        shutil.copyfile(path + HEAD_SUFFIX, download.path)
+        download.written = os.path.getsize(download.path)
+        fd = open(download.path, "ab")
+        self.downloads[key] = download
+        Thread(
+            target=self.download,
+            args=(key, url, fd, download),
+            name="download",
+            daemon=True,
+        ).start()
+        return download
+
+    def request_rest(self, url: str, download: Download) -> Tuple[Response, int]:
+        """Request the bytes not written yet. Returns the response, and the number of
+        bytes to skip at its start when the server ignored the range."""
+        offset = download.written
+        response = self.http.get(
+            url,
+            timeout=(3.05, 10),
+            stream=True,
+            headers={"Range": f"bytes={offset}-"},
+        )
+        try:
+            response.raise_for_status()
+        except RequestException:
+            response.close()
+            raise
+        size = None
+        skip = 0
+        if response.status_code == HTTPStatus.PARTIAL_CONTENT:
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            size = int(total) if total.isdigit() else None
+        else:
+            skip = offset
+            if "Content-Encoding" not in response.headers:
+                length = response.headers.get("Content-Length")
+                size = int(length) if length else None
+        with download.condition:
+            download.size = size
+        return response, skip
+
+    def download(
+        self,
+        key: str,
+        url: str,
+        fd: BinaryIO,
+        download: Download,
+        response: Optional[Response] = None,
+    ):
+        """Without `response`, the download resumes after the bytes in `fd`"""
+        path = self.path(key)
+        try:
+            skip = 0
+            with fd:
+                if response is None:
+                    response, skip = self.request_rest(url, download)
+                # read1 returns what was received so far, where iter_content waits
+                # for a full chunk: the readers get the first bytes sooner
+                read = partial(response.raw.read1, CHUNK_SIZE, decode_content=True)
+                for received in iter(read, b""):
+                    chunk = received[skip:]
+                    skip = max(0, skip - len(received))
+                    if not chunk:
+                        continue
+                    fd.write(chunk)
+                    fd.flush()
+                    with download.condition:
+                        download.written += len(chunk)
+                        download.condition.notify_all()
+            with download.condition:
+                os.replace(download.path, path)
+                download.path = path
+            with self.lock:
+                if os.path.exists(path + HEAD_SUFFIX):
+                    os.remove(path + HEAD_SUFFIX)
+            self.evict()
+            with download.condition:
+                download.size = download.written
+                download.done = True
+                download.condition.notify_all()
+        except Exception as e:
+            # Reported to the readers
+            debug(f"Could not download {url}: {e}")
+            with download.condition:
+                download.error = e
+                download.condition.notify_all()
+            if os.path.exists(download.path):
+                os.remove(download.path)
+        finally:
+            if response is not None:
+                response.close()
+            with self.lock:
+                del self.downloads[key]
+
+    def fetch_head(self, key: str, url: str, max_bytes: int, rate: int):
+        """Download the first `max_bytes` of the file, at `rate` bytes per second at
+        most, unless it is already cached"""
+        path = self.path(key)
+        if os.path.exists(path) or os.path.exists(path + HEAD_SUFFIX):
+            return
+        if key in self.downloads:
+            return
+        response = self.http.get(
+            url,
+            timeout=(3.05, 10),
+            stream=True,
+            headers={"Range": f"bytes=0-{max_bytes - 1}"},
+        )
+        # Written aside, a download of the whole file may start meanwhile
+        tmp_path = f"{path}{HEAD_SUFFIX}.{get_ident()}.part"
+        start = time.monotonic()
+        written = 0
+        with response, open(tmp_path, "wb") as fd:
+            response.raise_for_status()
+            read = partial(response.raw.read1, CHUNK_SIZE, decode_content=True)
+            while written < max_bytes and (chunk := read()):
+                chunk = chunk[: max_bytes - written]
+                fd.write(chunk)
+                written += len(chunk)
+                # Throttled, not to compete with the songs being played
+                time.sleep(max(0.0, written / rate - (time.monotonic() - start)))
+        with self.lock:
+            if os.path.exists(path) or key in self.downloads:
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, path + HEAD_SUFFIX)
+        debug(f"Downloaded the first {written} bytes of {url}")
+        self.evict()
+
+    def evict(self):
+        """The files and the heads have their own budget"""
+        with self.lock:
+            files: List[os.DirEntry] = []
+            heads: List[os.DirEntry] = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.endswith(".part"):
+                    is_head = entry.name.endswith(HEAD_SUFFIX)
+                    (heads if is_head else files).append(entry)
+            self.evict_entries(files, self.max_size)
+            self.evict_entries(heads, self.max_head_size)
+
+    @staticmethod
+    def evict_entries(entries: List[os.DirEntry], max_size: int):
+        total = sum(e.stat().st_size for e in entries)
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            if total <= max_size:
+                return
+            debug(f"Evicting {entry.name}")
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+class RelayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, relay: "Relay"):
+        super().__init__(("", port), RelayHandler)
+        self.relay = relay
+
+
+class RelayHandler(BaseHTTPRequestHandler):
+    server: RelayServer
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def serve(self, send_body: bool):
+        token = self.path.rsplit("/", 1)[-1]
+        item = self.server.relay.items.get(token)
+        if item is None:
+            self.send_error(404, "Not Found")
+            return
+        url, content_type = item
+        try:
+            download = self.server.relay.cache.fetch(token, url)
+        except RequestException as e:
+            error(f"Relay: could not download {url}: {e}")
+            self.send_error(502, "Bad Gateway")
+            return
+
+        # The ranges can only be honored once the size is known
+        size = download.size
+        try:
+            byte_range = parse_range(self.headers.get("Range"), size) if size else None
+        except RangeNotSatisfiable:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return
+
+        start, end = byte_range or (0, None if size is None else size - 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Type", content_type)
+        if end is not None:
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start + 1))
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not send_body:
+            return
+
+        try:
+            self.copy(download, start, end)
+        except (BrokenPipeError, ConnectionResetError):
+            # The Cast device often drops the connection once it has enough data
+            debug("Client disconnected")
+        except (DownloadError, OSError) as e:
+            # Too late for an error status, the connection is closed instead
+            debug(f"Download failed while streaming: {e}")
+
+    def copy(self, download: Download, start: int, end: Optional[int]):
+        """Send [start, end] (the end of the file if None), as soon as the bytes
+        are downloaded"""
+        with download.open() as fd:
+            fd.seek(start)
+            offset = start
+            while end is None or offset <= end:
+                available = download.available(offset)
+                if not available:
+                    return
+                size = min(CHUNK_SIZE, available)
+                if end is not None:
+                    size = min(size, end - offset + 1)
+                chunk = fd.read(size)
+                self.wfile.write(chunk)
+                offset += len(chunk)
+
+    def log_message(self, format, *args):
+        debug(format % args)
+
+
+class Relay:
+    """Local HTTP server relaying the audio and cover art of the songs from the
+    Subsonic server to the Cast device, through an on-disk cache. Replays do not
+    hit the Subsonic server, and the upcoming songs are downloaded in advance."""
+
+    def __init__(self, cache: AudioCache, address: str, port: int):
+        self.cache = cache
+        # Relay token, also used as the cache key -> (upstream url, content type)
+        self.items: Dict[str, Tuple[str, str]] = {}
+        self.server = RelayServer(port, self)
+        self.address = address
+        self.port = self.server.server_address[1]
+        self.thread = Thread(target=self.server.serve_forever, name="relay")
+        self.thread.start()
+        self.prefetcher = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="prefetch"
+        )
+        # Separate from the prefetcher, its downloads are throttled
+        self.warmer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="warm")
+        debug(f"Relay listening on {self.address}:{self.port}")
+
+    def register(self, kind: str, song: Song, url: str, content_type: str) -> str:
+        """Make the url available through the relay, and return its token"""
+        # The stream urls contain a random salt, only the song id is stable. The ids
+        # are only unique within a server.
+        key = f"{song.server}/{song.id}" if song.id else url
+        token = sha1(f"{kind}:{key}".encode()).hexdigest()
+        self.items[token] = (url, content_type)
+        return token
+
+    def url(self, kind: str, token: str) -> str:
+        return f"http://{self.address}:{self.port}/{kind}/{token}"
+
+    def audio_url(self, song: Song) -> str:
+        return self.url(
+            "audio", self.register("audio", song, song.url, song.content_type)
+        )
+
+    def art_url(self, song: Song) -> str:
+        return self.url("art", self.register("art", song, song.album_art, "image/jpeg"))
+
+    def prefetch(self, songs: Iterable[Song]):
+        for song in songs:
+            self.prefetcher.submit(
+                self.prefetch_one,
+                self.register("audio", song, song.url, song.content_type),
+            )
+            self.prefetcher.submit(
+                self.prefetch_one,
+                self.register("art", song, song.album_art, "image/jpeg"),
+            )
+
+    def prewarm(self, song: Song, max_bytes: int, rate: int):
+        """Download the start of a song that may be played soon"""
+        self.warmer.submit(
+            self.prewarm_one,
+            self.register("audio", song, song.url, song.content_type),
+            max_bytes,
+            rate,
+        )
+
+    def prewarm_one(self, token: str, max_bytes: int, rate: int):
+        url, _ = self.items[token]
+        try:
+            self.cache.fetch_head(token, url, max_bytes, rate)
+        except (RequestException, OSError) as e:
+            debug(f"Could not prewarm {url}: {e}")
+
+    def prefetch_one(self, token: str):
+        url, _ = self.items[token]
+        try:
+            self.cache.get(token, url)
+        except (RequestException, DownloadError) as e:
+            error(f"Relay: could not prefetch {url}: {e}")
+
+    def close(self):
+        self.prefetcher.shutdown(wait=False, cancel_futures=True)
+        self.warmer.shutdown(wait=False, cancel_futures=True)
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
@@ -0,0 +1,219 @@
+import random
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from functools import partial
+from threading import Lock
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import requests
+from requests import exceptions
+
+from castme.messages import debug as msg_debug
+
+# (connect, read) timeout, as understood by requests. The read timeout is the maximum
+# time between two bytes received from the server, not the total download time.
+Timeout = Tuple[float, float]
+
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+
+
+def debug(msg: str):
+    msg_debug("http", msg)
+
+
+class CircuitOpenException(exceptions.RequestException):
+    def __init__(self, retry_in: float):
+        super().__init__()
+        self.retry_in = retry_in
+
+    def __str__(self):
+        return f"The server is unreachable, not trying again for {self.retry_in:.0f}s"
+
+
+@dataclass
+class RetryPolicy:
+    attempts: int = 3
+    base_delay: float = 0.1
+    max_delay: float = 2.0
+
+    def delay(self, attempt: int) -> float:
+        """Exponential backoff with "full jitter", so that several clients (or several
+        threads) don't all hammer the server at the same time when it comes back."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+class CircuitBreaker:
+    """Fail fast once the server failed `failure_threshold` times in a row. After
+    `reset_timeout` seconds, calls are let through again and the first failure
+    opens the circuit again."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.lock = Lock()
+
+    def check(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            elapsed = time.monotonic() - self.opened_at
+            if elapsed < self.reset_timeout:
+                raise CircuitOpenException(self.reset_timeout - elapsed)
+            debug("Circuit half-open, letting calls through")
+            self.opened_at = None
+            self.failures = self.failure_threshold - 1
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold and self.opened_at is None:
+                debug(f"Circuit open after {self.failures} failures")
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Keep the last `size` latencies to compute a p95, which is used to decide when
+    a request is late enough to be worth hedging."""
+
+    def __init__(self, size: int = 100, min_samples: int = 10):
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = Lock()
+
+    def add(self, latency: float):
+        with self.lock:
+            self.samples.append(latency)
+
+    def p95(self) -> Optional[float]:
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+
+class ResilientHttp:
+    """Wrapper around requests.get with retries, hedged requests and a circuit breaker.
+
+    Hedging only applies to idempotent calls: if the first request did not get an
+    answer after the p95 latency, an identical request is sent and the first one to
+    answer wins. This trims the tail latency caused by a single stalled connection.
+    Non-idempotent calls are only retried when the connection could not be opened,
+    as the server may have processed a request that timed out or failed.
+    """
+
+    def __init__(
+        self,
+        retry: Optional[RetryPolicy] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        hedge_delay: float = 1.0,
+        min_hedge_delay: float = 0.05,
+    ):
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = LatencyTracker()
+        self.default_hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="http")
+
+    def hedge_delay(self) -> float:
+        p95 = self.latencies.p95()
+        if p95 is None:
+            return self.default_hedge_delay
+        return max(self.min_hedge_delay, p95)
+
+    def get(  # noqa: PLR0913, PLR0917
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        timeout: Timeout = (3.05, 10),
+        idempotent: bool = True,
+        stream: bool = False,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> requests.Response:
+        """The response of the last attempt is returned even if it is a server
+        error, it is up to the caller to call raise_for_status()."""
+        for attempt in range(self.retry.attempts):
+            last_attempt = attempt == self.retry.attempts - 1
+            self.breaker.check()
+            try:
+                if idempotent:
+                    response = self._hedged_get(url, params, timeout, stream, headers)
+                else:
+                    response = self._timed_get(url, params, timeout, stream, headers)
+            except (exceptions.ConnectionError, exceptions.Timeout) as e:
+                self.breaker.failure()
+                never_sent = isinstance(e, exceptions.ConnectTimeout)
+                if last_attempt or not (idempotent or never_sent):
+                    raise
+                debug(f"Attempt {attempt + 1} failed: {e}")
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    self.breaker.success()
+                    return response
+                self.breaker.failure()
+                if last_attempt or not idempotent:
+                    return response
+                debug(f"Attempt {attempt + 1} failed: HTTP {response.status_code}")
+                response.close()
+            time.sleep(self.retry.delay(attempt))
+
+        raise AssertionError("unreachable")  # pragma: no cover
+
+    def _timed_get(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]],
+        timeout: Timeout,
+        stream: bool,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> requests.Response:
+        start = time.monotonic()
+        response = requests.get(
+            url, params=params, timeout=timeout, stream=stream, headers=headers
+        )
+        self.latencies.add(time.monotonic() - start)
+        return response
+
+    def _hedged_get(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]],
+        timeout: Timeout,
+        stream: bool,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> requests.Response:
+        get = partial(self._timed_get, url, params, timeout, stream, headers)
+        primary = self.executor.submit(get)
+        done, _ = wait([primary], timeout=self.hedge_delay())
+        if done:
+            return primary.result()
+
+        debug(f"No answer after {self.hedge_delay():.2f}s, hedging {url}")
+        hedge = self.executor.submit(get)
+        pending = {primary, hedge}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.add_done_callback(_close_response)
+                    return future.result()
+                error = future.exception()
+        assert error is not None
+        raise error
+
+
+def _close_response(future: "Future[requests.Response]"):
+    if future.exception() is None:
+        future.result().close()
@@ -0,0 +1,175 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+from typing import Any, Dict, Generator, List, Optional
+
+from requests.exceptions import RequestException
+
+from castme.federation import FederatedSubSonic
+from castme.messages import debug as msg_debug
+from castme.messages import error
+from castme.player import PlaybackObserver
+from castme.song import Song
+from castme.subsonic import SubsonicApiError
+
+BATCH_SIZE = 50
+MIN_BACKOFF = 5.0
+MAX_BACKOFF = 300.0
+
+
+def debug(msg: str):
+    msg_debug("scrobbler", msg)
+
+
+class Scrobbler(PlaybackObserver):
+    """Report the songs played to their server, from a background thread so that
+    the backends are never blocked.
+
+    The plays are sent in batches, and kept in a file until the server acknowledges
+    them: the plays made while the server is unreachable are sent when it comes
+    back, even after a restart of castme. The song being played is only reported
+    once, it is not worth retrying.
+    """
+
+    def __init__(self, subsonic: FederatedSubSonic, path: str, autostart: bool = True):
+        """The plays are only sent once start() is called, immediately by default"""
+        self.subsonic = subsonic
+        self.path = path
+        self.lock = Lock()
+        # {"server", "id", "time"} of the plays not acknowledged by the server
+        self.pending: List[Dict[str, Any]] = self.load()
+        self.saved = True
+        self.now_playing: Optional[Song] = None
+        self.wakeup = Event()
+        self.closing = False
+        self.thread = Thread(target=self.loop, name="scrobbler")
+        if self.pending:
+            # Plays left from the previous session
+            self.wakeup.set()
+        if autostart:
+            self.start()
+
+    def start(self):
+        self.thread.start()
+
+    def load(self) -> List[Dict[str, Any]]:
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, encoding="utf-8") as fd:
+                pending = json.load(fd)
+        except json.JSONDecodeError as e:
+            error(f"Ignoring the corrupted scrobbles file {self.path}: {e}")
+            return []
+        debug(f"{len(pending)} plays to report from the previous session")
+        return pending
+
+    def save(self):
+        with self.lock:
+            if self.saved:
+                return
+            pending = list(self.pending)
+            self.saved = True
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fd:
+            json.dump(pending, fd)
+        os.replace(tmp_path, self.path)
+
+    def started(self, song: Song):
+        with self.lock:
+            self.now_playing = song
+        self.wakeup.set()
+
+    def finished(self, song: Song):
+        play = {"server": song.server, "id": song.id, "time": int(time.time() * 1000)}
+        with self.lock:
+            self.pending.append(play)
+            self.saved = False
+        self.wakeup.set()
+
+    def loop(self):
+        backoff: Optional[float] = None
+        while True:
+            self.wakeup.wait(backoff)
+            self.wakeup.clear()
+            self.save()
+            if self.closing:
+                return
+            if self.submit():
+                backoff = None
+            else:
+                backoff = min(MAX_BACKOFF, 2 * backoff) if backoff else MIN_BACKOFF
+                debug(f"Server unreachable, next attempt in {backoff}s")
+
+    def submit(self) -> bool:
+        """Send the song playing and the pending plays. Returns False if a server
+        could not be reached, the plays are then kept for the next attempt."""
+        with self.lock:
+            song, self.now_playing = self.now_playing, None
+        if song is not None:
+            try:
+                self.scrobble(song.server, [song.id], [int(time.time() * 1000)], False)
+            except (RequestException, SubsonicApiError) as e:
+                debug(f"Could not report {song.title} as playing: {e}")
+
+        while True:
+            with self.lock:
+                batch = self.pending[:BATCH_SIZE]
+            if not batch:
+                return True
+            failed = self.submit_batch(batch)
+            with self.lock:
+                self.pending[: len(batch)] = failed
+                self.saved = False
+            self.save()
+            if failed:
+                return False
+
+    def submit_batch(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Returns the plays that could not be sent"""
+        per_server: Dict[str, List[Dict[str, Any]]] = {}
+        for play in batch:
+            per_server.setdefault(play["server"], []).append(play)
+        failed = []
+        for server, plays in per_server.items():
+            try:
+                self.scrobble(
+                    server, [p["id"] for p in plays], [p["time"] for p in plays], True
+                )
+                debug(f"Reported {len(plays)} plays to {server}")
+            except RequestException as e:
+                debug(f"Could not report the plays to {server}: {e}")
+                failed.extend(plays)
+            except SubsonicApiError as e:
+                # Retrying would not help, the plays are dropped
+                error(f"The server {server} refused the plays: {e}")
+        return failed
+
+    def scrobble(
+        self, server_name: str, song_ids: List[str], times: List[int], submission: bool
+    ):
+        server = self.subsonic.server(server_name)
+        if server is None:
+            debug(f"Server {server_name} not configured anymore, dropping the plays")
+            return
+        server.scrobble(song_ids, times, submission)
+
+    def close(self):
+        self.closing = True
+        self.wakeup.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+
+@contextmanager
+def scrobbler(
+    subsonic: FederatedSubSonic, path: str
+) -> Generator[Scrobbler, None, None]:
+    the_scrobbler = Scrobbler(subsonic, os.path.expanduser(path))
+    try:
+        yield the_scrobbler
+    finally:
+        the_scrobbler.close()
@@ -0,0 +1,235 @@
+import json
+import os
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+from typing import IO, Any, Callable, Dict, Generator, List, Optional
+
+from castme.messages import debug as msg_debug
+from castme.messages import error
+from castme.song_queue import (
+    PendingSong,
+    QueueEntry,
+    QueueObserver,
+    Range,
+    SongQueue,
+    entry_key,
+    move_entries,
+)
+
+POSITION_INTERVAL = 2.0
+# Positions moving less than that are not worth a new record
+POSITION_THRESHOLD = 1.0
+
+
+def debug(msg: str):
+    msg_debug("session", msg)
+
+
+def encode_entry(entry: QueueEntry) -> Dict[str, Any]:
+    """Only the id is kept: the urls of the songs hold the credentials of their
+    server. The songs are loaded again when needed, like the pending ones."""
+    return {"pending": entry_key(entry)}
+
+
+def decode_entry(data: Dict[str, Any]) -> QueueEntry:
+    if "pending" in data:
+        return PendingSong(data["pending"])
+    # Whole song, written by the previous versions
+    return PendingSong(f"{data['server']}/{data['id']}")
+
+
+class Session(QueueObserver):
+    """Journal of the queue, of the position in the current song and of the backend
+    in use, so that they can be restored at startup without calling the server. The
+    songs are restored as pending songs, see encode_entry.
+
+    Every change is appended to a log file as a JSON line. The log is compacted
+    into a snapshot of the current state when loaded, and when it grows too big.
+    """
+
+    def __init__(self, path: str, max_records: int = 10_000):
+        self.path = path
+        self.max_records = max_records
+        self.records = 0
+        self.fd: Optional[IO[str]] = None
+        self.songs: Optional[SongQueue] = None
+        self.lock = Lock()
+        # Restored from the log, then kept up to date
+        self.position = 0.0
+        self.backend: Optional[str] = None
+        self.closing = Event()
+        self.tracker: Optional[Thread] = None
+
+    def load(self) -> List[QueueEntry]:
+        """Replay the log and return the songs in the queue. A truncated last line,
+        from a crash in the middle of a write, is ignored. So is everything after a
+        record that does not apply to the queue."""
+        entries: List[QueueEntry] = []
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, encoding="utf-8") as fd:
+            for line in fd:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                try:
+                    self.replay(entries, record)
+                except (IndexError, KeyError) as e:
+                    error(f"Ignoring the end of the corrupted session {self.path}: {e}")
+                    break
+        debug(f"Loaded {len(entries)} songs, position {self.position}")
+        return entries
+
+    def replay(self, entries: List[QueueEntry], record: Dict[str, Any]):
+        match record["op"]:
+            case "add":
+                entries.extend(decode_entry(e) for e in record["songs"])
+            case "remove":
+                del entries[record["index"]]
+                if record["index"] == 0:
+                    self.position = 0
+            case "clear":
+                entries.clear()
+                self.position = 0
+            case "remove_ranges":
+                for start, stop in record["ranges"]:
+                    del entries[start:stop]
+                    if start == 0:
+                        self.position = 0
+            case "move":
+                start, stop = record["start"], record["stop"]
+                move_entries(entries, start, stop, record["destination"])
+                if 0 in (start, record["destination"]):
+                    self.position = 0
+            case "position":
+                self.position = record["position"]
+            case "backend":
+                self.backend = record["name"]
+
+    def attach(self, songs: SongQueue):
+        """Fill the queue with the songs from the log, and journal its changes from
+        now on"""
+        with songs.lock:
+            songs.entries.extend(self.load())
+            self.songs = songs
+            with self.locked():
+                self.compact()
+            songs.observers.append(self)
+
+    def track_position(self, get_position: Callable[[], Optional[float]]):
+        """Sample the position in the current song in a background thread"""
+
+        def loop():
+            while not self.closing.wait(POSITION_INTERVAL):
+                position = get_position()
+                if position is not None:
+                    self.set_position(position)
+
+        self.tracker = Thread(target=loop, name="session")
+        self.tracker.start()
+
+    def set_position(self, position: float):
+        with self.locked():
+            if abs(position - self.position) < POSITION_THRESHOLD:
+                return
+            self.position = position
+            self.write({"op": "position", "position": position})
+
+    def set_backend(self, name: str):
+        with self.locked():
+            self.backend = name
+            self.write({"op": "backend", "name": name})
+
+    def extended(self, entries: List[QueueEntry]):
+        with self.locked():
+            self.write({"op": "add", "songs": [encode_entry(e) for e in entries]})
+
+    def removed(self, index: int):
+        with self.locked():
+            if index == 0:
+                self.position = 0
+            self.write({"op": "remove", "index": index})
+
+    def cleared(self):
+        with self.locked():
+            self.position = 0
+            self.write({"op": "clear"})
+
+    def removed_ranges(self, ranges: List[Range]):
+        with self.locked():
+            if ranges[-1][0] == 0:
+                self.position = 0
+            self.write({"op": "remove_ranges", "ranges": ranges})
+
+    def moved(self, start: int, stop: int, destination: int):
+        with self.locked():
+            if 0 in (start, destination):
+                self.position = 0
+            self.write(
+                {"op": "move", "start": start, "stop": stop, "destination": destination}
+            )
+
+    def reordered(self):
+        with self.locked():
+            # As big as the queue either way
+            self.compact()
+
+    @contextmanager
+    def locked(self) -> Generator[None, None, None]:
+        """Take the queue lock, then the session lock. The queue lock is already
+        held when the queue notifies its observers, so the order must be the same
+        everywhere. It also makes the queue safe to read during the compaction."""
+        assert self.songs is not None
+        with self.songs.lock, self.lock:
+            yield
+
+    def write(self, record: Dict[str, Any]):
+        """Must be called within locked()"""
+        if self.fd is None:
+            return
+        self.fd.write(json.dumps(record) + "\n")
+        # Flushed right away, so that nothing is lost if castme crashes
+        self.fd.flush()
+        self.records += 1
+        if self.records > self.max_records:
+            self.compact()
+
+    def compact(self):
+        """Must be called within locked()"""
+        assert self.songs is not None
+        if self.fd is not None:
+            self.fd.close()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        snapshot: List[Dict[str, Any]] = [
+            {"op": "add", "songs": [encode_entry(e) for e in self.songs.entries]}
+        ]
+        if self.position:
+            snapshot.append({"op": "position", "position": self.position})
+        if self.backend:
+            snapshot.append({"op": "backend", "name": self.backend})
+        with open(tmp_path, "w", encoding="utf-8") as fd:
+            fd.writelines(json.dumps(record) + "\n" for record in snapshot)
+        os.replace(tmp_path, self.path)
+        self.records = len(snapshot)
+        self.fd = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        self.closing.set()
+        if self.tracker:
+            self.tracker.join()
+        with self.lock:
+            if self.fd is not None:
+                self.fd.close()
+                self.fd = None
+
+
+@contextmanager
+def session(path: str, songs: SongQueue) -> Generator[Session, None, None]:
+    the_session = Session(os.path.expanduser(path))
+    the_session.attach(songs)
+    try:
+        yield the_session
+    finally:
+        the_session.close()
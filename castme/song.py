@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional
 
 
 @dataclass
@@ -9,6 +10,12 @@ class Song:
     url: str
     content_type: str
     album_art: str
+    id: str = ""
+    # Name of the server the song comes from
+    server: str = ""
+    # ReplayGain, in dB
+    track_gain: Optional[float] = None
+    album_gain: Optional[float] = None
 
     def __str__(self) -> str:
         return f"{self.title} / {self.album_name} by {self.artist}"
@@ -0,0 +1,339 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from threading import RLock
+from typing import (
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from requests.exceptions import RequestException
+
+from castme.messages import debug as msg_debug
+from castme.player import NoSongsToPlayException
+from castme.song import Song
+
+# Takes the ids of pending songs, returns the songs found, by id. The songs not
+# returned do not exist anymore, see UnresolvedSongs.
+SongResolver = Callable[[List[str]], Dict[str, Song]]
+QueueEntry = Union[Song, "PendingSong"]
+# [start, stop) indexes of entries
+Range = Tuple[int, int]
+
+
+def debug(msg: str):
+    msg_debug("queue", msg)
+
+
+class UnresolvedSongs(RequestException):
+    """Raised by a resolver when some songs could not be asked to their server. They
+    are kept in the queue, unlike the songs that were not found."""
+
+    def __init__(self, songs: Dict[str, Song], ids: Set[str]):
+        super().__init__()
+        # Songs resolved, by id, and the ids of the others
+        self.songs = songs
+        self.ids = ids
+
+    def __str__(self):
+        return f"Could not load {len(self.ids)} songs, their server did not answer"
+
+
+@dataclass(slots=True)
+class PendingSong:
+    """Placeholder for a song known only by its id. Only the id is kept to
+    keep the memory usage low for very large playlists."""
+
+    id: str
+
+    def __str__(self) -> str:
+        return f"<song {self.id}, not loaded yet>"
+
+
+class QueueObserver:
+    """Notified of every change made to the queue, while the queue lock is held"""
+
+    def extended(self, entries: List[QueueEntry]):
+        pass
+
+    def removed(self, index: int):
+        pass
+
+    def cleared(self):
+        pass
+
+    def removed_ranges(self, ranges: List[Range]):
+        """The ranges are removed in that order, from the end of the queue"""
+
+    def moved(self, start: int, stop: int, destination: int):
+        """See move_entries"""
+
+    def reordered(self):
+        """The whole queue changed, e.g. shuffled"""
+
+
+def entry_key(entry: QueueEntry) -> str:
+    """Same for a song and its pending version, see FederatedSubSonic"""
+    if isinstance(entry, PendingSong):
+        return entry.id
+    return f"{entry.server}/{entry.id}"
+
+
+def move_entries(entries: List[QueueEntry], start: int, stop: int, destination: int):
+    """Move the entries in [start, stop) before the entry at `destination`, which
+    is outside of that range. A destination of len(entries) moves them at the end."""
+    block = entries[start:stop]
+    del entries[start:stop]
+    if destination > start:
+        destination -= len(block)
+    entries[destination:destination] = block
+
+
+def merge_ranges(ranges: Iterable[Range], size: int) -> List[Range]:
+    """Clamp the ranges to [0, size) and merge them, from the last one to the first
+    so that removing them in that order does not shift the next ones"""
+    merged: List[Range] = []
+    for first, last in sorted(ranges):
+        start, stop = max(0, first), min(size, last)
+        if start >= stop:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged[::-1]
+
+
+class SongQueue:
+    """List of songs shared between the CLI and the backends, the first song being
+    the one currently playing.
+
+    Pending songs are resolved into real songs (metadata and stream url) only when
+    they get within `window` songs of the requested position, or of the head of the
+    queue: that part is resolved in the background as the queue moves forward. All
+    the methods are thread-safe, as the backends access the queue from their own
+    thread. The resolver is called without holding the lock.
+    """
+
+    def __init__(self, resolver: Optional[SongResolver] = None, window: int = 5):
+        self.resolver = resolver
+        self.window = window
+        self.entries: List[QueueEntry] = []
+        self.observers: List[QueueObserver] = []
+        self.lock = RLock()
+        self.resolver_thread = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="queue"
+        )
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[QueueEntry]:
+        with self.lock:
+            return iter(list(self.entries))
+
+    def __getitem__(self, index: int) -> Song:
+        """Raises IndexError if the songs from `index` could not be resolved"""
+        while True:
+            self._resolve(index)
+            with self.lock:
+                song = self.entries[index]
+                # Another thread may have changed the queue during the resolution
+                if isinstance(song, Song):
+                    return song
+
+    def peek(self, index: int) -> Optional[QueueEntry]:
+        """The entry at `index` as it is, without resolving it. None if there is no
+        such entry."""
+        with self.lock:
+            if -len(self.entries) <= index < len(self.entries):
+                return self.entries[index]
+            return None
+
+    def head(self) -> Song:
+        """The song currently playing. Raises NoSongsToPlayException when the queue
+        is empty, or when none of its first songs could be resolved."""
+        try:
+            return self[0]
+        except IndexError as e:
+            raise NoSongsToPlayException() from e
+
+    def upcoming(self, count: int) -> List[Song]:
+        """The songs following the head, at most `count`"""
+        with self.lock:
+            count = min(count, len(self.entries) - 1)
+        songs = []
+        for i in range(1, count + 1):
+            try:
+                songs.append(self[i])
+            except (IndexError, UnresolvedSongs):
+                break
+        return songs
+
+    def extend(self, songs: Iterable[QueueEntry]):
+        with self.lock:
+            new_entries = list(songs)
+            self.entries.extend(new_entries)
+            for observer in self.observers:
+                observer.extended(new_entries)
+
+    def extend_pending(self, song_ids: Iterable[str]):
+        self.extend(PendingSong(i) for i in song_ids)
+        self._resolve_ahead()
+
+    def pop(self, index: int) -> QueueEntry:
+        with self.lock:
+            entry = self.entries.pop(index)
+            self._notify_removed(index)
+        if index == 0:
+            self._resolve_ahead()
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            for observer in self.observers:
+                observer.cleared()
+
+    def page(self, start: int, count: int) -> List[QueueEntry]:
+        """The entries in [start, start + count), without resolving them"""
+        with self.lock:
+            return self.entries[start : start + count]
+
+    def remove_ranges(self, ranges: Iterable[Range]) -> int:
+        """Remove the entries of all the [start, stop) ranges at once, the observers
+        are notified once. Returns the number of entries removed."""
+        with self.lock:
+            merged = merge_ranges(ranges, len(self.entries))
+            self._remove_merged(merged)
+        if merged and merged[-1][0] == 0:
+            self._resolve_ahead()
+        return sum(stop - start for start, stop in merged)
+
+    def move(self, start: int, stop: int, destination: int):
+        """See move_entries. Raises IndexError if the indexes are out of the queue."""
+        with self.lock:
+            size = len(self.entries)
+            if not (0 <= start < stop <= size and 0 <= destination <= size):
+                raise IndexError()
+            if start <= destination <= stop:
+                # Already there
+                return
+            move_entries(self.entries, start, stop, destination)
+            for observer in self.observers:
+                observer.moved(start, stop, destination)
+        self._resolve_ahead()
+
+    def dedupe(self) -> int:
+        """Remove the entries already present earlier in the queue. Returns the
+        number of entries removed."""
+        with self.lock:
+            seen = set()
+            duplicates: List[Range] = []
+            for index, entry in enumerate(self.entries):
+                key = entry_key(entry)
+                if key not in seen:
+                    seen.add(key)
+                elif duplicates and duplicates[-1][1] == index:
+                    duplicates[-1] = (duplicates[-1][0], index + 1)
+                else:
+                    duplicates.append((index, index + 1))
+            self._remove_merged(duplicates[::-1])
+        return sum(stop - start for start, stop in duplicates)
+
+    def shuffle(self):
+        """Shuffle the songs after the one playing"""
+        with self.lock:
+            upcoming = self.entries[1:]
+            random.shuffle(upcoming)
+            self.entries[1:] = upcoming
+            for observer in self.observers:
+                observer.reordered()
+        self._resolve_ahead()
+
+    def _remove_merged(self, ranges: List[Range]):
+        """Must be called with the lock held, see merge_ranges for the order"""
+        if not ranges:
+            return
+        for start, stop in ranges:
+            del self.entries[start:stop]
+        for observer in self.observers:
+            observer.removed_ranges(ranges)
+
+    def _notify_removed(self, index: int):
+        if index < 0:
+            index += len(self.entries) + 1
+        for observer in self.observers:
+            observer.removed(index)
+
+    def _resolve_ahead(self):
+        """Resolve the songs following the head in the background"""
+        if self.resolver is not None:
+            self.resolver_thread.submit(self._resolve_quietly, 0)
+
+    def _resolve_quietly(self, index: int):
+        try:
+            self._resolve(index)
+        except Exception as e:
+            # The resolution is attempted again when the songs are needed
+            debug(f"Could not resolve the upcoming songs: {e}")
+
+    def _resolve(self, index: int):
+        """Resolve the pending songs in [index, index + window). Songs that could
+        not be found are removed from the queue. UnresolvedSongs is only raised if
+        the song at `index` is one of the songs to resolve again later."""
+        while True:
+            with self.lock:
+                if index < 0:
+                    index += len(self.entries)
+                window = self.entries[index : index + self.window]
+                pending = [s for s in window if isinstance(s, PendingSong)]
+            if not pending:
+                return
+            assert self.resolver is not None, "No resolver for pending songs"
+            try:
+                resolved = self.resolver([s.id for s in pending])
+            except UnresolvedSongs as e:
+                with self.lock:
+                    self._splice(pending, e.songs, e.ids)
+                    if isinstance(self.peek(index), PendingSong):
+                        raise
+                return
+            with self.lock:
+                self._splice(pending, resolved)
+
+    def _splice(
+        self,
+        pending: List[PendingSong],
+        resolved: Dict[str, Song],
+        unresolved: Collection[str] = (),
+    ):
+        """Replace the pending songs by their resolved version, the `unresolved` ones
+        are kept as they are. The queue may have changed during the resolution: the
+        entries are found by identity, and the ones already removed or resolved by
+        another thread are skipped."""
+        wanted = {id(p) for p in pending}
+        index = 0
+        while index < len(self.entries) and wanted:
+            entry = self.entries[index]
+            if id(entry) not in wanted:
+                index += 1
+                continue
+            wanted.discard(id(entry))
+            assert isinstance(entry, PendingSong)
+            if entry.id in resolved:
+                self.entries[index] = resolved[entry.id]
+                index += 1
+            elif entry.id in unresolved:
+                index += 1
+            else:
+                del self.entries[index]
+                self._notify_removed(index)
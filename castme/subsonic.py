@@ -2,12 +2,13 @@ import difflib
 import random
 import string
 from hashlib import md5
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from urllib.parse import urlencode
 
-import requests
-
+from castme.jsonstream import ArrayNotFoundError, iter_array
 from castme.messages import debug as msg_debug
+from castme.messages import error
+from castme.resilience import ResilientHttp, Timeout
 from castme.song import Song
 
 
@@ -23,6 +24,14 @@ class AlbumNotFoundException(Exception):
         return f"Album not found with keyword: {self.keyword}"
 
 
+class PlaylistNotFoundException(Exception):
+    def __init__(self, keyword: str):
+        self.keyword = keyword
+
+    def __str__(self):
+        return f"Playlist not found with keyword: {self.keyword}"
+
+
 class SubsonicApiError(Exception):
     def __init__(self, message: str, code: int):
         self.message = message
@@ -34,22 +43,63 @@ class SubsonicApiError(Exception):
 
 SUBSONIC_SUPPORTED_VERSION = "1.16.1"
 
+DEFAULT_TIMEOUT: Timeout = (3.05, 5)
+# Some verbs are slow to answer on big libraries, they get more time before the first
+# byte of the answer.
+VERB_TIMEOUTS: Dict[str, Timeout] = {
+    "getAlbumList": (3.05, 20),
+}
+# Calls that must not be sent twice by the hedging, as they change the server state
+NON_IDEMPOTENT_VERBS = {"scrobble"}
+STREAM_CHUNK_SIZE = 64 * 1024
+# Albums asked per call, the maximum allowed by the API
+ALBUM_PAGE_SIZE = 500
+
+
+def find_closest(keyword: str, names: List[str]) -> Optional[int]:
+    """Return the index of the name matching the keyword best, or None"""
+    # This truncation is a hack, but get_close_matches doesn't handle very
+    # dissimilar string length well. We essentially assume that the user
+    # was lazy and just typed the beginning of the name, which works
+    # actually really well. It is a good enough heuristic for now.
+    truncated = [n[: len(keyword) + 3] for n in names]
+    closest = difflib.get_close_matches(keyword, truncated, 1)
+    if not closest:
+        return None
+    debug(f"Closest match {closest}")
+    return truncated.index(closest[0])
+
+
+def check_response(data: Dict[str, Any]):
+    response = data["subsonic-response"]
+    if response["status"] == "failed":
+        error_data = response["error"]
+        raise SubsonicApiError(error_data["message"], error_data["code"])
+
 
 class SubSonic:
     """API client implementation based on the official documentation:
     https://www.subsonic.org/pages/api.jsp
     """
 
-    def __init__(
-        self, app_id: str, user: str, password: str, server_prefix: str
+    def __init__(  # noqa: PLR0913, PLR0917
+        self,
+        app_id: str,
+        user: str,
+        password: str,
+        server_prefix: str,
+        http: Optional[ResilientHttp] = None,
+        name: str = "",
     ) -> None:
+        self.name = name
         self.app_id = app_id
         self.user = user
         self.password = password
         self.server_prefix = server_prefix
+        self.http = http or ResilientHttp()
 
     def make_sonic_url(
-        self, verb: str, **kwargs: str | int
+        self, verb: str, **kwargs: str | int | List[str] | List[int]
     ) -> Tuple[str, Dict[str, Any]]:
         salt = "".join(random.choices(string.ascii_letters + string.digits, k=10))
         token = md5((self.password + salt).encode()).hexdigest()
@@ -64,65 +114,165 @@ class SubSonic:
 
         return f"{self.server_prefix}/rest/{verb}", parameters
 
-    def call_sonic(self, verb: str, **kwargs: str | int):
+    def call_sonic(self, verb: str, **kwargs: str | int | List[str] | List[int]):
+        """List arguments are sent as repeated parameters"""
         url, parameters = self.make_sonic_url(verb, **kwargs)
-        req = requests.get(url, params=parameters, timeout=20)
+        req = self.http.get(
+            url,
+            params=parameters,
+            timeout=VERB_TIMEOUTS.get(verb, DEFAULT_TIMEOUT),
+            idempotent=verb not in NON_IDEMPOTENT_VERBS,
+        )
         req.raise_for_status()
-        response = req.json()["subsonic-response"]
-        if response["status"] == "failed":
-            error_data = response["error"]
-            raise SubsonicApiError(error_data["message"], error_data["code"])
-        return req.json()
+        data = req.json()
+        check_response(data)
+        return data
+
+    def iter_sonic(
+        self, verb: str, key: str, **kwargs: str | int
+    ) -> Iterator[Dict[str, Any]]:
+        """Call the API and yield the entries of the `key` array (e.g. "album" or
+        "song") as they are received, without loading the whole response in memory.
+        """
+        url, parameters = self.make_sonic_url(verb, **kwargs)
+        with self.http.get(
+            url,
+            params=parameters,
+            timeout=VERB_TIMEOUTS.get(verb, DEFAULT_TIMEOUT),
+            stream=True,
+        ) as req:
+            req.raise_for_status()
+            try:
+                yield from iter_array(req.iter_content(STREAM_CHUNK_SIZE), key)
+            except ArrayNotFoundError as e:
+                # Either an error, or an empty result: the server omits empty arrays
+                check_response(e.document)
 
     def get_all_albums(self) -> List[str]:
-        albums = self.call_sonic("getAlbumList", type="alphabeticalByName", size=500)[
-            "subsonic-response"
-        ]["albumList"]["album"]
-        return [a["title"] for a in albums]
+        return [a["title"] for a in self.get_album_list()]
+
+    def iter_albums(self) -> Iterator[Dict[str, Any]]:
+        """All the albums sorted by name, asked ALBUM_PAGE_SIZE at a time"""
+        offset = 0
+        while True:
+            received = 0
+            for album in self.iter_sonic(
+                "getAlbumList",
+                "album",
+                type="alphabeticalByName",
+                size=ALBUM_PAGE_SIZE,
+                offset=offset,
+            ):
+                received += 1
+                yield album
+            if received < ALBUM_PAGE_SIZE:
+                return
+            offset += received
+
+    def get_album_list(self) -> List[Dict[str, str]]:
+        """Title and artist of all the albums"""
+        return [
+            {"title": a["title"], "artist": a.get("artist", "")}
+            for a in self.iter_albums()
+        ]
 
     def get_songs_for_album(self, album_name: str) -> Tuple[str, List[Song]]:
-        output = self.call_sonic("getAlbumList", type="alphabeticalByName", size=500)[
-            "subsonic-response"
+        # Only keep the fields we need, the entries hold a lot of unused metadata
+        albums = [
+            {"title": a["title"], "id": a["id"], "coverArt": a["coverArt"]}
+            for a in self.iter_albums()
         ]
-        albums = output["albumList"]["album"]
         debug(f"Found {len(albums)}")
-        songs = []
-        closest = difflib.get_close_matches(
-            album_name,
-            # This truncation is a hack, but get_close_matches doesn't handle very
-            # dissimilar string length well. We essentially assume that the user
-            # was lazy and just typed the beginning of the album name, which works
-            # actually really well. It is a good enough heuristic for now.
-            [a["title"][: len(album_name) + 3] for a in albums],
-            1,
-        )
-        if not closest:
+        closest = find_closest(album_name, [a["title"] for a in albums])
+        if closest is None:
             raise AlbumNotFoundException(album_name)
 
-        debug(f"Closest match {closest}")
-
-        for album in albums:
-            debug(f'Looking at {album["title"]}')
-            if album["title"][: len(album_name) + 3] == closest[0]:
-                cover_url, cover_params = self.make_sonic_url(
-                    "getCoverArt", id=album["coverArt"]
-                )
-                theid = album["id"]
-                data = self.call_sonic("getAlbum", id=theid)["subsonic-response"][
-                    "album"
-                ]["song"]
-                for s in data:
-                    strurl, params = self.make_sonic_url("stream", id=s["id"])
-                    songs.append(
-                        Song(
-                            s["title"],
-                            s["album"],
-                            s["artist"],
-                            strurl + "?" + urlencode(params),
-                            s["contentType"],
-                            cover_url + "?" + urlencode(cover_params),
-                        )
-                    )
-                return album["title"], songs
-
-        raise AlbumNotFoundException(album_name)
+        album = albums[closest]
+        songs = [
+            self.make_song(s, album["coverArt"])
+            for s in self.iter_sonic("getAlbum", "song", id=album["id"])
+        ]
+        return album["title"], songs
+
+    def get_playlists(self) -> List[Dict[str, Any]]:
+        return [
+            {"name": p["name"], "id": p["id"], "songCount": p.get("songCount", 0)}
+            for p in self.iter_sonic("getPlaylists", "playlist")
+        ]
+
+    def get_playlist_song_ids(self, playlist_name: str) -> Tuple[str, List[str]]:
+        """Only the ids are returned, the songs themselves can be loaded later on
+        with get_songs_by_id. This keeps very large playlists cheap to queue."""
+        playlists = self.get_playlists()
+        closest = find_closest(playlist_name, [p["name"] for p in playlists])
+        if closest is None:
+            raise PlaylistNotFoundException(playlist_name)
+
+        playlist = playlists[closest]
+        song_ids = [
+            s["id"] for s in self.iter_sonic("getPlaylist", "entry", id=playlist["id"])
+        ]
+        return playlist["name"], song_ids
+
+    def get_songs_by_id(self, song_ids: List[str]) -> Dict[str, Song]:
+        """Songs that are not found on the server are skipped"""
+        songs = {}
+        for song_id in song_ids:
+            try:
+                data = self.call_sonic("getSong", id=song_id)
+            except SubsonicApiError as e:
+                error(f"Skipping song {song_id}: {e}")
+                continue
+            entry = data["subsonic-response"]["song"]
+            songs[song_id] = self.make_song(entry, entry.get("coverArt", song_id))
+        return songs
+
+    def get_random_songs(self, count: int) -> List[Song]:
+        return [
+            self.make_song(s, s.get("coverArt", s["id"]))
+            for s in self.iter_sonic("getRandomSongs", "song", size=count)
+        ]
+
+    def get_similar_songs(self, song_id: str, count: int) -> List[Song]:
+        return [
+            self.make_song(s, s.get("coverArt", s["id"]))
+            for s in self.iter_sonic(
+                "getSimilarSongs2", "song", id=song_id, count=count
+            )
+        ]
+
+    def get_top_songs(self, artist: str, count: int) -> List[Song]:
+        return [
+            self.make_song(s, s.get("coverArt", s["id"]))
+            for s in self.iter_sonic("getTopSongs", "song", artist=artist, count=count)
+        ]
+
+    def scrobble(self, song_ids: List[str], times: List[int], submission: bool):
+        """Report several plays at once (`submission`), or the song being played.
+        `times` are the times of the plays, in milliseconds since the epoch."""
+        self.call_sonic(
+            "scrobble",
+            id=song_ids,
+            time=times,
+            submission="true" if submission else "false",
+        )
+
+    def make_song(self, entry: Dict[str, Any], cover_art_id: str) -> Song:
+        # OpenSubsonic extension, the fields are missing when the server has no value
+        replay_gain = entry.get("replayGain", {})
+        track_gain = replay_gain.get("trackGain")
+        album_gain = replay_gain.get("albumGain")
+        cover_url, cover_params = self.make_sonic_url("getCoverArt", id=cover_art_id)
+        stream_url, stream_params = self.make_sonic_url("stream", id=entry["id"])
+        return Song(
+            entry["title"],
+            entry["album"],
+            entry["artist"],
+            stream_url + "?" + urlencode(stream_params),
+            entry["contentType"],
+            cover_url + "?" + urlencode(cover_params),
+            entry["id"],
+            self.name,
+            None if track_gain is None else float(track_gain),
+            None if album_gain is None else float(album_gain),
+        )
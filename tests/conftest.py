@@ -0,0 +1,58 @@
+import time
+from threading import Thread
+from typing import Callable, Optional
+
+from mock_subsonic import (
+    CLIENT_NAME,
+    PORT,
+    PWD,
+    USER,
+    MockSubsonicHandler,
+    MockSubsonicServer,
+)
+from pytest import fixture
+
+from castme.messages import enable_debug_mode
+from castme.song import Song
+from castme.subsonic import SubSonic
+
+
+def wait_for(predicate: Callable[[], bool], timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.005)
+
+
+def make_song(
+    song_id: str, track_gain: Optional[float] = None, album_gain: Optional[float] = None
+) -> Song:
+    return Song(
+        f"Song {song_id}", "Album", "Artist", "url", "audio/mpeg", "art", song_id,
+        "main", track_gain, album_gain,
+    )  # fmt: skip
+
+
+@fixture(scope="session", autouse=True)
+def enable_debug():
+    enable_debug_mode()
+
+
+@fixture(scope="session")
+def mock_server():
+    with MockSubsonicServer(("", PORT), MockSubsonicHandler, True) as httpd:
+        server_thread = Thread(target=httpd.serve_forever)
+        server_thread.start()
+        yield PORT
+        httpd.shutdown()
+        server_thread.join()
+
+
+@fixture
+def subsonic(mock_server):
+    return SubSonic(CLIENT_NAME, USER, PWD, f"http://localhost:{mock_server}")
+
+
+@fixture
+def subsonic_wrong_pwd(mock_server):
+    return SubSonic(CLIENT_NAME, USER, "badpassword", f"http://localhost:{mock_server}")
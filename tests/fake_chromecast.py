@@ -0,0 +1,241 @@
+import time
+from dataclasses import dataclass, field, replace
+from threading import Condition, Thread
+from typing import Any, List, Optional, Tuple
+
+import requests
+
+IDLE = "IDLE"
+BUFFERING = "BUFFERING"
+PLAYING = "PLAYING"
+PAUSED = "PAUSED"
+
+
+@dataclass
+class Timings:
+    """Simulated delays of the Cast device, in seconds"""
+
+    # From the LOAD message to the first request to the media url
+    load: float = 0.05
+    # From the first bytes received to the PLAYING status
+    buffering: float = 0.05
+    # Length of every song
+    duration: float = 0.3
+    # From a command (play, pause, volume...) to the status update
+    command: float = 0.01
+
+
+@dataclass
+class FakeMediaStatus:
+    """Subset of pychromecast's MediaStatus used by castme"""
+
+    player_state: str = IDLE
+    idle_reason: Optional[str] = None
+    title: Optional[str] = None
+    media_session_id: Optional[int] = None
+    current_time: float = 0
+    last_updated: float = field(default_factory=time.monotonic)
+
+    @property
+    def player_is_idle(self) -> bool:
+        return self.player_state == IDLE
+
+    @property
+    def player_is_playing(self) -> bool:
+        return self.player_state in (PLAYING, BUFFERING)
+
+    @property
+    def player_is_paused(self) -> bool:
+        return self.player_state == PAUSED
+
+    @property
+    def adjusted_current_time(self) -> float:
+        if self.player_state != PLAYING:
+            return self.current_time
+        return self.current_time + time.monotonic() - self.last_updated
+
+
+class FakeMediaController:
+    """In-process stand-in for pychromecast's MediaController.
+
+    Like the real device, the commands return immediately and the status updates
+    are sent to the listeners later, from another thread. A loaded song goes
+    through BUFFERING and PLAYING, and ends IDLE with the FINISHED reason after
+    `timings.duration` seconds of playback. The media url is really fetched, so
+    the Subsonic server (or the relay) is part of the measurements.
+    """
+
+    def __init__(self, timings: Timings):
+        self.timings = timings
+        self.status = FakeMediaStatus()
+        self.listeners: List[Any] = []
+        self.condition = Condition()
+        # Incremented by every command interrupting the current song
+        self.generation = 0
+        # (time, event, title) for every status update and command received
+        self.events: List[Tuple[float, str, Optional[str]]] = []
+
+    @property
+    def is_active(self) -> bool:
+        return True
+
+    def register_status_listener(self, listener: Any):
+        self.listeners.append(listener)
+
+    def play_media(
+        self,
+        url: str,
+        content_type: str,
+        title: Optional[str] = None,
+        thumb: Optional[str] = None,
+        current_time: Optional[float] = None,
+        **kwargs: Any,
+    ):
+        with self.condition:
+            self.generation += 1
+            self.record("load", title)
+            generation = self.generation
+            self.condition.notify_all()
+        Thread(
+            target=self.load,
+            args=(generation, url, title, current_time or 0),
+            daemon=True,
+        ).start()
+
+    def load(self, generation: int, url: str, title: Optional[str], start: float):
+        if not self.sleep(generation, self.timings.load):
+            return
+        with requests.get(url, stream=True, timeout=5) as response:
+            response.raise_for_status()
+            next(response.iter_content(1024), b"")
+        if not self.set_state(
+            generation,
+            BUFFERING,
+            title=title,
+            current_time=start,
+            media_session_id=generation,
+        ):
+            return
+        if not self.sleep(generation, self.timings.buffering):
+            return
+        self.set_state(generation, PLAYING, current_time=start)
+        self.wait_end(generation)
+
+    def wait_end(self, generation: int):
+        with self.condition:
+            while self.generation == generation:
+                if self.status.player_state == PLAYING:
+                    remaining = (
+                        self.timings.duration - self.status.adjusted_current_time
+                    )
+                    if remaining <= 0:
+                        self.update(IDLE, idle_reason="FINISHED")
+                        return
+                    self.condition.wait(remaining)
+                else:
+                    self.condition.wait()
+
+    def play(self):
+        self.command(PLAYING)
+
+    def pause(self):
+        self.command(PAUSED)
+
+    def stop(self):
+        self.command(IDLE, idle_reason="CANCELLED")
+
+    def command(self, state: str, **changes: Any):
+        with self.condition:
+            self.record(state.lower(), self.status.title)
+        Thread(target=self.apply, args=(state,), kwargs=changes, daemon=True).start()
+
+    def apply(self, state: str, **changes: Any):
+        time.sleep(self.timings.command)
+        with self.condition:
+            if state == IDLE:
+                self.generation += 1
+            self.update(state, **changes)
+
+    def sleep(self, generation: int, delay: float) -> bool:
+        """Wait for `delay`, return False if the song was interrupted meanwhile"""
+        deadline = time.monotonic() + delay
+        with self.condition:
+            while self.generation == generation:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return True
+                self.condition.wait(remaining)
+        return False
+
+    def set_state(self, generation: int, state: str, **changes: Any) -> bool:
+        with self.condition:
+            if self.generation != generation:
+                return False
+            self.update(state, **changes)
+            return True
+
+    def update(self, state: str, **changes: Any):
+        """Must be called with the condition held"""
+        defaults = {
+            "idle_reason": None,
+            "current_time": self.status.adjusted_current_time,
+        }
+        self.status = replace(
+            self.status,
+            player_state=state,
+            last_updated=time.monotonic(),
+            **(defaults | changes),
+        )
+        self.record(f"status {state}", self.status.title)
+        self.condition.notify_all()
+        status = replace(self.status)
+        # Outside of the lock: the listeners can send new commands
+        self.condition.release()
+        try:
+            for listener in self.listeners:
+                listener.new_media_status(status)
+        finally:
+            self.condition.acquire()
+
+    def record(self, event: str, title: Optional[str]):
+        self.events.append((time.monotonic(), event, title))
+
+
+@dataclass
+class FakeCastInfo:
+    host: str = "127.0.0.1"
+
+
+@dataclass
+class FakeCastStatus:
+    volume_level: float
+
+
+class FakeChromecast:
+    """In-process stand-in for pychromecast's Chromecast"""
+
+    def __init__(self, timings: Optional[Timings] = None):
+        self.timings = timings or Timings()
+        self.media_controller = FakeMediaController(self.timings)
+        self.cast_info = FakeCastInfo()
+        self.volume = 0.5
+        # Every volume set
+        self.volumes: List[float] = []
+
+    @property
+    def status(self) -> FakeCastStatus:
+        return FakeCastStatus(self.volume)
+
+    def wait(self, timeout: Optional[float] = None):
+        pass
+
+    def set_volume(self, volume: float):
+        time.sleep(self.timings.command)
+        self.volume = min(1.0, max(0.0, volume))
+        self.volumes.append(self.volume)
+
+    def volume_up(self, delta: float):
+        self.set_volume(self.volume + delta)
+
+    def volume_down(self, delta: float):
+        self.set_volume(self.volume - delta)
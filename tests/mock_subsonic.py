@@ -0,0 +1,247 @@
+import json
+import re
+import socketserver
+import time
+import wave
+from collections import Counter
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler
+from io import BytesIO
+from typing import Any, ClassVar, Dict, List
+from urllib.parse import parse_qs, urlparse
+
+PORT = 4040
+VERSION = "1.16.1"
+CLIENT_NAME = "tests"
+USER = "castme"
+PWD = "pwd123"
+# Same password as USER, but every answer is delayed
+SLOW_USER = "slow"
+SLOW_DELAY = 2
+
+FAILED_AUTH_CODE = 40
+
+
+def fake_content(item_id: str) -> bytes:
+    """Content returned by stream and getCoverArt for an id"""
+    return (item_id * 1000).encode()
+
+
+def silent_wav(duration: float) -> bytes:
+    """A valid audio file, for the tests playing the songs"""
+    content = BytesIO()
+    with wave.open(content, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(22050)
+        wav.writeframes(b"\0\0" * int(22050 * duration))
+    return content.getvalue()
+
+
+def tone_wav(duration: float, amplitude: int) -> bytes:
+    """A square wave, its RMS is `amplitude`"""
+    period = [amplitude] * 50 + [-amplitude] * 50
+    content = BytesIO()
+    with wave.open(content, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(22050)
+        samples = period * int(22050 * duration / len(period))
+        wav.writeframes(b"".join(s.to_bytes(2, "little", signed=True) for s in samples))
+    return content.getvalue()
+
+
+def create_response(response_status, **data):
+    response = {
+        "subsonic-response": {"status": response_status, "version": VERSION, **data}
+    }
+    return json.dumps(response).encode("utf-8")
+
+
+class MockSubsonicServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_port = True
+    daemon_threads = True
+    block_on_close = False
+
+
+class MockSubsonicHandler(BaseHTTPRequestHandler):
+    # Number of calls received per "key" parameter, used to inject failures
+    calls: ClassVar[Counter] = Counter()
+    # Parameters of the scrobble calls received
+    scrobbles: ClassVar[List[Dict[str, List[str]]]] = []
+
+    def send_api_response(self, data: bytes):
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_huge_album_list(self, size: int):
+        """Generated on the fly, so that the server itself doesn't skew the memory
+        measurements of the client"""
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.end_headers()
+        self.wfile.write(
+            b'{"subsonic-response": {"status": "ok", "version": "'
+            + VERSION.encode()
+            + b'", "albumList2": {"album": ['
+        )
+        for batch_start in range(0, size, 1000):
+            albums = [
+                {
+                    "id": str(i),
+                    "title": f"Album {i}",
+                    "artist": f"Artist {i}",
+                    "coverArt": f"al-{i}",
+                    "created": "2004-11-27T20:23:32",
+                }
+                for i in range(batch_start, min(size, batch_start + 1000))
+            ]
+            separator = b", " if batch_start else b""
+            self.wfile.write(separator + json.dumps(albums)[1:-1].encode())
+        self.wfile.write(b"]}}}")
+
+    @staticmethod
+    def check_auth(params: Dict[str, Any]):
+        return params["u"] in ([USER], [SLOW_USER]) and params["t"] == [
+            md5((PWD + params["s"][0]).encode("utf-8")).hexdigest()
+        ]
+
+    def do_GET(self):  # noqa: PLR0912, PLR0915
+        parsed_path = urlparse(self.path)
+        params = parse_qs(parsed_path.query)
+        if params.get("u") == [SLOW_USER]:
+            time.sleep(SLOW_DELAY)
+
+        if not self.check_auth(params):
+            self.send_api_response(
+                create_response(
+                    "failed",
+                    status="failed",
+                    version="1.16.1",
+                    type="navidrome",
+                    serverVersion="0.53.3 (13af8ed4)",
+                    openSubsonic=True,
+                    error={
+                        "code": FAILED_AUTH_CODE,
+                        "message": "Wrong username or password",
+                    },
+                )
+            )
+
+        elif parsed_path.path == "/rest/ping":
+            self.send_api_response(create_response("ok"))
+
+        elif parsed_path.path == "/rest/getAlbumList":
+            self.calls[parsed_path.path] += 1
+            with open("tests/AlbumList.json", "rb") as fd:
+                albums = json.load(fd)
+            offset = int(params.get("offset", ["0"])[0])
+            size = int(params.get("size", ["10"])[0])
+            albums["album"] = albums["album"][offset : offset + size]
+            self.send_api_response(create_response("ok", albumList=albums))
+
+        elif parsed_path.path == "/rest/getAlbumList2":
+            self.send_huge_album_list(int(params["size"][0]))
+
+        elif parsed_path.path == "/rest/getAlbum":
+            self.calls[parsed_path.path] += 1
+            with open("tests/HighVoltage.json", "rb") as fd:
+                album = json.load(fd)
+            if params["id"][0] != album["id"]:
+                self.send_error(404, "Not Found")
+                return
+            self.send_api_response(create_response("ok", album=album))
+
+        elif parsed_path.path == "/rest/getPlaylists":
+            playlists = {"playlist": [{"id": "1", "name": "Best of", "songCount": 3}]}
+            self.send_api_response(create_response("ok", playlists=playlists))
+
+        elif parsed_path.path == "/rest/getPlaylist":
+            with open("tests/HighVoltage.json", "rb") as fd:
+                songs = json.load(fd)["song"]
+            # The last song does not exist anymore on the server
+            playlist = {"id": "1", "name": "Best of", "entry": [*songs, {"id": "0"}]}
+            self.send_api_response(create_response("ok", playlist=playlist))
+
+        elif parsed_path.path in {
+            "/rest/getRandomSongs",
+            "/rest/getSimilarSongs2",
+            "/rest/getTopSongs",
+        }:
+            self.calls[parsed_path.path] += 1
+            with open("tests/HighVoltage.json", "rb") as fd:
+                songs = json.load(fd)["song"]
+            self.send_api_response(create_response("ok", randomSongs={"song": songs}))
+
+        elif parsed_path.path == "/rest/getSong":
+            with open("tests/HighVoltage.json", "rb") as fd:
+                songs = json.load(fd)["song"]
+            for song in songs:
+                if song["id"] == params["id"][0]:
+                    self.send_api_response(create_response("ok", song=song))
+                    return
+            self.send_api_response(
+                create_response(
+                    "failed", error={"code": 70, "message": "Song not found"}
+                )
+            )
+
+        elif parsed_path.path in {"/rest/stream", "/rest/getCoverArt"}:
+            self.calls[parsed_path.path] += 1
+            is_stream = parsed_path.path == "/rest/stream"
+            content_type = "audio/mpeg" if is_stream else "image/png"
+            content = fake_content(params["id"][0])
+            if "duration" in params:
+                content = silent_wav(float(params["duration"][0]))
+            if "delay" in params:
+                # Slow transcoding: the size is unknown, and the end comes later
+                self.send_response(200)
+                self.send_header("Content-type", content_type)
+                self.end_headers()
+                self.wfile.write(content[:100])
+                self.wfile.flush()
+                time.sleep(float(params["delay"][0]))
+                self.wfile.write(content[100:])
+                return
+            byte_range = re.match(r"bytes=(\d+)-(\d*)$", self.headers["Range"] or "")
+            if is_stream and byte_range:
+                first = int(byte_range.group(1))
+                last = int(byte_range.group(2) or len(content) - 1)
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", f"bytes {first}-{last}/{len(content)}"
+                )
+                content = content[first : last + 1]
+            else:
+                self.send_response(200)
+            self.send_header("Content-type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        elif parsed_path.path == "/rest/scrobble":
+            self.scrobbles.append(params)
+            self.send_api_response(create_response("ok"))
+
+        elif parsed_path.path == "/rest/echo":
+            self.send_api_response(create_response("ok", params=params))
+
+        elif parsed_path.path == "/rest/stall":
+            # The first call stalls, simulating a stuck connection
+            self.calls[params["key"][0]] += 1
+            if self.calls[params["key"][0]] == 1:
+                time.sleep(float(params["delay"][0]))
+            self.send_api_response(create_response("ok"))
+
+        elif parsed_path.path == "/rest/flaky":
+            # Fails with a 503 `failures` times before answering
+            self.calls[params["key"][0]] += 1
+            if self.calls[params["key"][0]] <= int(params["failures"][0]):
+                self.send_error(503, "Service Unavailable")
+                return
+            self.send_api_response(create_response("ok"))
+
+        else:
+            self.send_error(404, "Not Found")
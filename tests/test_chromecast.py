@@ -0,0 +1,187 @@
+import time
+from typing import List, Optional, cast
+
+import pytest
+from conftest import wait_for
+from fake_chromecast import (
+    IDLE,
+    PAUSED,
+    PLAYING,
+    FakeChromecast,
+    FakeMediaStatus,
+    Timings,
+)
+from pychromecast import Chromecast
+from pychromecast.error import ChromecastConnectionError
+
+from castme.backends.chromecast import ChromecastBackend
+from castme.config import Config
+from castme.loudness import GainMode, Normalizer
+from castme.player import PlaybackObserver
+from castme.song_queue import SongQueue
+from castme.subsonic import SubSonic
+
+CONFIG = Config(chromecast_friendly_name="fake", default_backend="chromecast")
+
+
+class StatusRecorder:
+    def __init__(self):
+        self.statuses: List[FakeMediaStatus] = []
+        self.times: List[float] = []
+
+    def new_media_status(self, status: FakeMediaStatus):
+        self.times.append(time.monotonic())
+        self.statuses.append(status)
+
+    def first_after(self, start: float, state: str) -> Optional[float]:
+        for when, status in zip(self.times, self.statuses, strict=True):
+            if when >= start and status.player_state == state:
+                return when
+        return None
+
+    def played(self) -> List[Optional[str]]:
+        return [s.title for s in self.statuses if s.player_state == PLAYING]
+
+    def load_media_failed(self, item: int, error_code: int):
+        pass
+
+
+def wait_state_after(recorder: StatusRecorder, start: float, state: str) -> float:
+    """Return the time it took for the status to change to `state` after `start`"""
+    wait_for(lambda: recorder.first_after(start, state) is not None)
+    return cast(float, recorder.first_after(start, state)) - start
+
+
+def start_backend(subsonic: SubSonic, timings: Timings, albums: int = 1):
+    songs = SongQueue()
+    for _ in range(albums):
+        songs.extend(subsonic.get_songs_for_album("High")[1])
+    chromecast = FakeChromecast(timings)
+    backend = ChromecastBackend(
+        CONFIG, songs, PlaybackObserver(), cast(Chromecast, chromecast)
+    )
+    recorder = StatusRecorder()
+    chromecast.media_controller.register_status_listener(recorder)
+    return songs, backend, recorder
+
+
+def test_queue_played_in_order(subsonic: SubSonic):
+    songs, backend, recorder = start_backend(subsonic, Timings(duration=0.1))
+    backend.force_play()
+    wait_for(lambda: len(songs) == 0)
+    assert recorder.played() == ["The Jack", "Tnt"]
+    backend.close()
+
+
+def test_playpause_position(subsonic: SubSonic):
+    songs, backend, recorder = start_backend(subsonic, Timings(duration=10))
+    assert backend.position() is None
+    backend.force_play(start=3)
+    wait_for(lambda: recorder.played() == ["The Jack"])
+    position = backend.position()
+    assert position is not None
+    assert position >= 3  # noqa: PLR2004
+
+    backend.playpause()
+    wait_for(lambda: recorder.statuses[-1].player_state == PAUSED)
+    position = backend.position()
+    time.sleep(0.05)
+    assert backend.position() == position
+
+    backend.playpause()
+    wait_for(lambda: recorder.statuses[-1].player_state == PLAYING)
+    assert len(songs) == 2  # noqa: PLR2004
+    backend.close()
+
+
+def test_volume_follows_replay_gain(subsonic: SubSonic):
+    songs = SongQueue()
+    songs.extend(subsonic.get_songs_for_album("High")[1])
+    chromecast = FakeChromecast(Timings(duration=0.1))
+    backend = ChromecastBackend(
+        CONFIG,
+        songs,
+        PlaybackObserver(),
+        cast(Chromecast, chromecast),
+        Normalizer(GainMode.TRACK, preamp=0),
+    )
+    backend.force_play()
+    wait_for(lambda: len(songs) == 0)
+    # The Jack has a gain of -6.5dB, Tnt has no gain
+    assert chromecast.volumes == [pytest.approx(0.5 * 0.473, abs=1e-3), 0.5]
+    backend.close()
+
+
+def test_play_error_reported(subsonic: SubSonic, monkeypatch: pytest.MonkeyPatch):
+    songs, backend, recorder = start_backend(subsonic, Timings(duration=10))
+    controller = backend.chromecast.media_controller
+    play_media = controller.play_media
+
+    def fail_once(*args, **kwargs):
+        monkeypatch.setattr(controller, "play_media", play_media)
+        raise ChromecastConnectionError()
+
+    monkeypatch.setattr(controller, "play_media", fail_once)
+    backend.force_play()
+    wait_for(lambda: controller.play_media is play_media)
+    # Same as the `next` command
+    songs.pop(0)
+    backend.force_play()
+    wait_for(lambda: recorder.played() == ["Tnt"])
+    backend.close()
+
+
+def test_duplicate_finished_ignored(subsonic: SubSonic):
+    songs, backend, recorder = start_backend(subsonic, Timings(duration=10))
+    controller = backend.chromecast.media_controller
+    backend.force_play()
+    wait_for(lambda: recorder.played() == ["The Jack"])
+    finished = FakeMediaStatus(
+        IDLE, "FINISHED", media_session_id=controller.status.media_session_id
+    )
+    # pychromecast can send the same status several times
+    backend.dispatcher.submit_status(finished)
+    backend.dispatcher.submit_status(finished)
+    wait_for(lambda: recorder.played() == ["The Jack", "Tnt"])
+    backend.dispatcher.submit_status(finished)
+    time.sleep(0.05)
+    assert [s.title for s in songs] == ["Tnt"]
+    assert len(backend.dispatcher.latencies.samples) == 1
+    backend.close()
+
+
+def test_playback_latency(subsonic: SubSonic):
+    """The songs follow each other, and the commands are applied, within the delays
+    of the fake Cast device"""
+    timings = Timings(load=0.02, buffering=0.02, duration=0.1, command=0.01)
+    songs, backend, recorder = start_backend(subsonic, timings, albums=2)
+    controller = backend.chromecast.media_controller
+    songs_count = len(songs)
+
+    start = time.monotonic()
+    backend.force_play()
+    time_to_play = wait_state_after(recorder, start, PLAYING)
+
+    wait_for(lambda: len(songs) == 0, timeout=10)
+    wait_for(lambda: len(recorder.played()) == songs_count)
+    finished = [t for t, e, _ in controller.events if e == "status IDLE"]
+    playing = [t for t, e, _ in controller.events if e == "status PLAYING"]
+    gaps = [p - f for f, p in zip(finished, playing[1:], strict=False)]
+
+    # Long enough for the song not to end during the measurement
+    timings.duration = 10
+    songs.extend(subsonic.get_songs_for_album("High")[1])
+    backend.force_play()
+    wait_for(lambda: recorder.statuses[-1].player_state == PLAYING)
+    start = time.monotonic()
+    backend.playpause()
+    round_trip = wait_state_after(recorder, start, PAUSED)
+    backend.close()
+
+    assert len(gaps) == songs_count - 1
+    assert len(backend.dispatcher.latencies.samples) == songs_count - 1
+    # The simulated delays are the lower bound, the rest is castme and Subsonic
+    assert time_to_play >= timings.load + timings.buffering
+    assert min(gaps) >= timings.load + timings.buffering
+    assert max(gaps) < 1
+    assert round_trip >= timings.command
@@ -0,0 +1,47 @@
+import time
+
+from castme.completion import Completer, normalize, readline_matches
+
+
+def test_normalize():
+    assert normalize("Saint-Saëns: Le Carnaval") == "saint-saens: le carnaval"
+    assert normalize("ÉLÈVE") == "eleve"
+
+
+def test_complete():
+    completer = Completer(["Élégie", "Electric Ladyland", "High Voltage", "Arrival"])
+    assert completer.complete("el") == ["Electric Ladyland", "Élégie"]
+    assert completer.complete("ELE") == ["Electric Ladyland", "Élégie"]
+    assert completer.complete("élé") == ["Electric Ladyland", "Élégie"]
+    assert completer.complete("eleg") == ["Élégie"]
+    assert completer.complete("high") == ["High Voltage"]
+    assert completer.complete("x") == []
+    assert completer.complete("") == [
+        "Arrival",
+        "Electric Ladyland",
+        "Élégie",
+        "High Voltage",
+    ]
+
+
+def test_update_incremental():
+    names = [f"Album {i:06}" for i in range(1000)]
+    completer = Completer(names)
+    completer.update([*names[1:], "Zebra"])
+    assert completer.complete("album 000000") == []
+    assert completer.complete("zeb") == ["Zebra"]
+    assert len(completer) == len(names)
+
+
+def test_readline_matches():
+    # readline only gives the last word of the line
+    assert readline_matches(["High Voltage"], "high vo", "vo") == ["Voltage"]
+
+
+def test_complete_large_catalog():
+    completer = Completer(f"Album number {i}" for i in range(100_000))
+    start = time.monotonic()
+    for i in range(100):
+        completer.complete(f"album number {i}")
+    # A few ms per completion at most
+    assert (time.monotonic() - start) / 100 < 0.005  # noqa: PLR2004
@@ -0,0 +1,133 @@
+import time
+
+import pytest
+from mock_subsonic import CLIENT_NAME, PWD, SLOW_USER, USER
+from requests.exceptions import ConnectionError, Timeout
+
+from castme.federation import MAX_IN_FLIGHT, FederatedSubSonic
+from castme.resilience import ResilientHttp, RetryPolicy
+from castme.song_queue import PendingSong, SongQueue, UnresolvedSongs
+from castme.subsonic import SubSonic, SubsonicApiError
+
+SLOW_DEADLINE = 0.5
+
+
+def make_server(name: str, port: int, user: str = USER, pwd: str = PWD) -> SubSonic:
+    # No retries, so that the failing servers fail fast
+    http = ResilientHttp(retry=RetryPolicy(attempts=1))
+    return SubSonic(CLIENT_NAME, user, pwd, f"http://localhost:{port}", http, name)
+
+
+def test_album_list_merged(mock_server):
+    federation = FederatedSubSonic(
+        [make_server("a", mock_server), make_server("b", mock_server)]
+    )
+    single = make_server("a", mock_server).get_all_albums()
+    # Both servers have the same albums
+    assert federation.get_all_albums() == sorted(single, key=str.casefold)
+
+
+def test_playlist_ids_qualified(mock_server):
+    federation = FederatedSubSonic(
+        [make_server("a", mock_server), make_server("b", mock_server)]
+    )
+    playlists = federation.get_playlists()
+    assert [p["server"] for p in playlists] == ["a", "b"]
+
+    name, ids = federation.get_playlist_song_ids("Best")
+    assert name == "Best of"
+    assert all(i.startswith("a/") for i in ids)
+
+    queue = SongQueue(federation.get_songs_by_id)
+    queue.extend_pending([*ids, "unknown/1"])
+    assert queue[0].server == "a"
+    assert queue[0].title == "The Jack"
+
+
+def test_failing_server_ignored(mock_server):
+    federation = FederatedSubSonic(
+        [
+            make_server("down", 1),
+            make_server("wrong", mock_server, pwd="badpassword"),
+            make_server("ok", mock_server),
+        ]
+    )
+    assert "High Voltage" in federation.get_all_albums()
+    _, songs = federation.get_songs_for_album("High")
+    assert songs[0].server == "ok"
+
+
+def test_all_servers_failing(mock_server):
+    federation = FederatedSubSonic(
+        [make_server("down", 1), make_server("wrong", mock_server, pwd="bad")]
+    )
+    with pytest.raises((ConnectionError, SubsonicApiError)):
+        federation.get_all_albums()
+
+
+def test_slow_server_deadline(mock_server):
+    federation = FederatedSubSonic(
+        [
+            make_server("slow", mock_server, user=SLOW_USER),
+            make_server("ok", mock_server),
+        ],
+        deadline=SLOW_DEADLINE,
+    )
+    start = time.monotonic()
+    playlists = federation.get_playlists()
+    assert time.monotonic() - start < 3 * SLOW_DEADLINE
+    assert [p["server"] for p in playlists] == ["ok"]
+
+
+def test_all_servers_too_slow(mock_server):
+    federation = FederatedSubSonic(
+        [make_server("slow", mock_server, user=SLOW_USER)], deadline=SLOW_DEADLINE
+    )
+    # Not an album missing from the servers
+    with pytest.raises(Timeout):
+        federation.get_songs_for_album("High")
+
+
+def test_slow_server_does_not_starve_the_others(mock_server):
+    federation = FederatedSubSonic(
+        [
+            make_server("slow", mock_server, user=SLOW_USER),
+            make_server("ok", mock_server),
+        ],
+        deadline=SLOW_DEADLINE,
+    )
+    # More calls than the threads of a server, the slow ones pile up
+    for _ in range(2 * MAX_IN_FLIGHT):
+        start = time.monotonic()
+        playlists = federation.get_playlists()
+        assert time.monotonic() - start < 3 * SLOW_DEADLINE
+        assert [p["server"] for p in playlists] == ["ok"]
+
+
+def test_slow_server_songs_kept(mock_server):
+    federation = FederatedSubSonic(
+        [
+            make_server("slow", mock_server, user=SLOW_USER),
+            make_server("ok", mock_server),
+        ],
+        deadline=SLOW_DEADLINE,
+    )
+    ids = make_server("ok", mock_server).get_playlist_song_ids("Best")[1]
+    queue = SongQueue(federation.get_songs_by_id)
+    # The last song of the playlist does not exist anymore
+    queue.extend(PendingSong(f"{s}/{i}") for s in ("ok", "slow") for i in ids)
+    assert queue[0].title == "The Jack"
+    assert [str(e) for e in queue][2:] == [
+        f"<song slow/{i}, not loaded yet>" for i in ids
+    ]
+
+    # The songs of the slow server are asked again when needed
+    with pytest.raises(UnresolvedSongs):
+        queue[2]
+    assert len(queue) == len(ids) + 2
+
+    queue.pop(0)
+    queue.pop(0)
+    with pytest.raises(UnresolvedSongs):
+        queue.head()
+    assert len(queue) == len(ids)
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from castme.jsonstream import ArrayNotFoundError, UnterminatedArrayError, iter_array
+
+
+def chunked(data: str, size: int):
+    raw = data.encode("utf-8")
+    return [raw[i : i + size] for i in range(0, len(raw), size)]
+
+
+DOCUMENT = json.dumps(
+    {
+        "subsonic-response": {
+            "status": "ok",
+            "album": {
+                "name": "Ça plane pour moi",
+                "song": [
+                    {"id": 1, "album": "Ça plane", "title": "]Tricky, [one"},
+                    {"id": 2, "title": "Deux", "tags": [1, 2, {"a": "b"}]},
+                    3.25,
+                    "text",
+                ],
+            },
+        }
+    },
+    indent=2,
+)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 1000])
+def test_iter_array_chunks(chunk_size: int):
+    expected = json.loads(DOCUMENT)["subsonic-response"]["album"]["song"]
+    assert list(iter_array(chunked(DOCUMENT, chunk_size), "song")) == expected
+
+
+def test_iter_array_empty():
+    assert list(iter_array(chunked('{"song": []}', 3), "song")) == []
+
+
+def test_iter_array_not_found():
+    with pytest.raises(ArrayNotFoundError) as e:
+        list(iter_array(chunked('{"status": "failed"}', 3), "song"))
+    assert e.value.document == {"status": "failed"}
+
+
+def test_iter_array_truncated():
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_array(chunked('{"song": [{"id": 1}, {"id"', 3), "song"))
+
+
+def test_iter_array_unterminated():
+    with pytest.raises(UnterminatedArrayError):
+        list(iter_array(chunked('{"song": [{"id": 1}, ', 3), "song"))
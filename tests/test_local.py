@@ -0,0 +1,132 @@
+import time
+from typing import List, Tuple
+from urllib.parse import urlencode
+
+import pytest
+from conftest import wait_for
+from mock_subsonic import MockSubsonicHandler, tone_wav
+
+import castme.backends.local
+from castme.backends.local import LocalBackendImpl, music
+from castme.loudness import GainMode, Normalizer, measure_gain
+from castme.player import PlaybackObserver
+from castme.song import Song
+from castme.song_queue import SongQueue
+from castme.subsonic import SubSonic
+
+
+class Recorder(PlaybackObserver):
+    def __init__(self):
+        # (time, "started" or "finished", title)
+        self.events: List[Tuple[float, str, str]] = []
+
+    def started(self, song: Song):
+        self.events.append((time.monotonic(), "started", song.title))
+
+    def finished(self, song: Song):
+        self.events.append((time.monotonic(), "finished", song.title))
+
+    def titles(self, kind: str) -> List[str]:
+        return [title for _, event, title in self.events if event == kind]
+
+
+def make_songs(subsonic: SubSonic, count: int, duration: float) -> List[Song]:
+    songs = []
+    for i in range(count):
+        url, params = subsonic.make_sonic_url(
+            "stream", id=str(i), duration=str(duration)
+        )
+        url = f"{url}?{urlencode(params)}"
+        songs.append(Song(f"song {i}", "album", "artist", url, "audio/wav", "", str(i)))
+    return songs
+
+
+@pytest.fixture
+def local(monkeypatch):
+    monkeypatch.setenv("SDL_AUDIODRIVER", "dummy")
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    songs = SongQueue()
+    recorder = Recorder()
+    normalizer = Normalizer(GainMode.TRACK)
+    backend = LocalBackendImpl(songs, recorder, normalizer)
+    yield songs, backend, recorder
+    backend.close()
+    normalizer.close()
+
+
+class MusicSpy:
+    """Records the calls made to pygame.mixer.music, and forwards them"""
+
+    def __init__(self):
+        self.calls: List[str] = []
+
+    def __getattr__(self, name: str):
+        attribute = getattr(music, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            return attribute(*args, **kwargs)
+
+        return call
+
+
+def test_gapless(subsonic: SubSonic, local, monkeypatch: pytest.MonkeyPatch):
+    songs, backend, recorder = local
+    spy = MusicSpy()
+    monkeypatch.setattr(castme.backends.local, "music", spy)
+    duration = 0.3
+    songs.extend(make_songs(subsonic, 3, duration))
+    downloads = MockSubsonicHandler.calls["/rest/stream"]
+    backend.force_play()
+    wait_for(lambda: recorder.titles("started") == ["song 0"])
+    # The next song is downloaded while the first one plays
+    preloaded = downloads + 2
+    wait_for(
+        lambda: MockSubsonicHandler.calls["/rest/stream"] == preloaded, duration / 2
+    )
+
+    wait_for(lambda: len(recorder.titles("finished")) == 3)  # noqa: PLR2004
+    assert recorder.titles("started") == ["song 0", "song 1", "song 2"]
+    assert len(songs) == 0
+    # Nothing is loaded between two songs, pygame chains the queued ones. It only
+    # stops at the end of the queue.
+    transitions = [c for c in spy.calls if c in {"load", "play", "queue", "stop"}]
+    assert transitions == ["load", "play", "queue", "queue", "stop"]
+
+
+def test_next_and_clear_with_queued_song(subsonic: SubSonic, local):
+    songs, backend, recorder = local
+    songs.extend(make_songs(subsonic, 3, 5))
+    backend.force_play()
+    wait_for(lambda: recorder.titles("started") == ["song 0"])
+    # Let the second song be queued, then skip the first one, as `next` does
+    time.sleep(0.3)
+    songs.pop(0)
+    backend.force_play()
+    wait_for(lambda: recorder.titles("started") == ["song 0", "song 1"])
+    assert songs[0].title == "song 1"
+
+    songs.clear()
+    backend.stop()
+    wait_for(lambda: backend.position() is None)
+    assert recorder.titles("finished") == []
+
+
+def test_decode_on_pygame_thread(local):
+    _, backend, _ = local
+    content = tone_wav(0.5, 2**13)
+    samples = backend.decode(content)
+    assert samples is not None
+    assert measure_gain(samples) == pytest.approx(-6, abs=0.5)
+    assert backend.decode(b"not a song") is None
+
+
+def test_played_song_measured(subsonic: SubSonic, local):
+    songs, backend, recorder = local
+    songs.extend(make_songs(subsonic, 1, 5))
+    backend.force_play()
+    wait_for(lambda: recorder.titles("started") == ["song 0"])
+    # Not queued after another song, measured anyway
+    wait_for(lambda: backend.normalizer.key(songs[0]) in backend.normalizer.measured)
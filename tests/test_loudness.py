@@ -0,0 +1,100 @@
+import wave
+from io import BytesIO
+from typing import List, Optional
+
+import pytest
+from conftest import make_song, wait_for
+from mock_subsonic import tone_wav
+
+from castme.loudness import GainMode, Normalizer, Volume, measure_gain
+from castme.subsonic import SubSonic
+
+
+class WavDecoder:
+    def __init__(self):
+        self.decoded: List[bytes] = []
+
+    def __call__(self, content: bytes) -> Optional[bytes]:
+        self.decoded.append(content)
+        try:
+            with wave.open(BytesIO(content)) as wav:
+                return wav.readframes(wav.getnframes())
+        except wave.Error:
+            return None
+
+
+def test_replay_gain_from_server(subsonic: SubSonic):
+    _, songs = subsonic.get_songs_for_album("High Voltage")
+    assert (songs[0].track_gain, songs[0].album_gain) == (-6.5, -7.0)
+    assert (songs[1].track_gain, songs[1].album_gain) == (None, None)
+
+
+def test_gain_modes():
+    song = make_song("1", track_gain=-6.0, album_gain=-12.0)
+    assert Normalizer(GainMode.ALBUM).factor(song) == pytest.approx(0.251, abs=1e-3)
+    assert Normalizer(GainMode.TRACK).factor(song) == pytest.approx(0.501, abs=1e-3)
+    assert Normalizer(GainMode.OFF).factor(song) == 1
+    # Never louder than the volume asked
+    assert Normalizer(GainMode.TRACK).factor(make_song("2", track_gain=3)) == 1
+    normalizer = Normalizer(GainMode.ALBUM, preamp=-6.0)
+    assert normalizer.factor(make_song("3", track_gain=3)) == pytest.approx(0.708, 1e-3)
+
+
+def test_measured_once(tmp_path):
+    # The RMS of the tone is at -12dBFS
+    content = tone_wav(1, 2**13)
+    decoder = WavDecoder()
+    assert measure_gain(decoder(content) or b"") == pytest.approx(-6, abs=0.5)
+
+    path = str(tmp_path / "loudness.json")
+    normalizer = Normalizer(GainMode.ALBUM, path=path)
+    normalizer.set_decoder(decoder)
+    song, invalid = make_song("1"), make_song("2")
+    assert normalizer.factor(song) == 1
+    normalizer.prepare([song], content)
+    normalizer.prepare([invalid], b"not a song")
+    wait_for(lambda: normalizer.gain(song) is not None)
+    assert normalizer.factor(song) == pytest.approx(0.5, abs=0.03)
+    wait_for(lambda: "main/2" in normalizer.measured)
+    assert normalizer.factor(invalid) == 1
+
+    # Neither is measured again
+    normalizer.prepare([song, invalid])
+    normalizer.close()
+    assert len(decoder.decoded) == 3  # noqa: PLR2004
+
+    # Kept for the next sessions
+    loaded = Normalizer(GainMode.ALBUM, path=path)
+    assert loaded.gain(song) == normalizer.gain(song)
+    assert loaded.measured == normalizer.measured
+
+
+def test_volume_follows_songs():
+    device = {"volume": 0.8}
+    commands = []
+
+    def set_volume(value: float):
+        # Rounded, like the devices do
+        device["volume"] = round(value, 2)
+        commands.append(value)
+
+    volume = Volume(Normalizer(GainMode.TRACK), lambda: device["volume"], set_volume)
+    volume.song_changed(make_song("1", track_gain=-6.0))
+    assert device["volume"] == pytest.approx(0.4, abs=0.01)
+    # Same gain, no volume command
+    volume.song_changed(make_song("2", track_gain=-6.0))
+    assert len(commands) == 1
+    # Back to the volume asked, without any drift from the rounding
+    volume.song_changed(make_song("3", track_gain=0.0))
+    assert device["volume"] == 0.8  # noqa: PLR2004
+
+    volume.delta(-0.2)
+    volume.song_changed(make_song("4", track_gain=-6.0))
+    assert device["volume"] == pytest.approx(0.3, abs=0.01)
+    volume.set(1)
+    assert device["volume"] == pytest.approx(0.5, abs=0.01)
+
+    # Changed by another application
+    device["volume"] = 0.2
+    volume.song_changed(make_song("5", track_gain=0.0))
+    assert device["volume"] == pytest.approx(0.4, abs=0.01)
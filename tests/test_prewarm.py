@@ -0,0 +1,67 @@
+import pytest
+from conftest import wait_for
+from mock_subsonic import CLIENT_NAME, PWD, USER, MockSubsonicHandler
+
+from castme import prewarm
+from castme.config import Config
+from castme.federation import FederatedSubSonic
+from castme.prewarm import AlbumHistory, Prewarmer, prewarmer
+from castme.subsonic import AlbumNotFoundException, SubSonic
+
+
+def test_predict_next_albums(tmp_path):
+    history = AlbumHistory(str(tmp_path / "albums.json"), max_albums=4)
+    for album in ["A", "B", "A", "B", "A", "C", "D", "A"]:
+        history.record(album.lower(), album)
+    # B follows A more often than C, D was never queued after A
+    assert history.predict(2) == ["B", "C"]
+    assert history.predict(3) == ["B", "C", "D"]
+    assert history.resolve("B") == "B"
+    assert history.predict(0) == []
+
+    history.save()
+    loaded = AlbumHistory(history.path, max_albums=4)
+    loaded.load()
+    assert loaded.predict(2) == ["B", "C"]
+
+    # Beyond max_albums, the least queued ones are forgotten
+    loaded.record("e", "E")
+    assert "E" in loaded.counts
+    assert len(loaded.counts) == loaded.max_albums
+    assert loaded.resolve("d") is None
+
+
+@pytest.fixture
+def federation(mock_server):
+    return FederatedSubSonic(
+        [SubSonic(CLIENT_NAME, USER, PWD, f"http://localhost:{mock_server}")]
+    )
+
+
+def test_prewarmed_album_hit(federation, tmp_path, monkeypatch):
+    monkeypatch.setattr(prewarm, "IDLE_DELAY", 0.05)
+    history = AlbumHistory(str(tmp_path / "albums.json"))
+    history.record("high", "High Voltage")
+    history.record("arrival", "Arrival")
+    the_prewarmer = Prewarmer(federation, history, albums=1)
+
+    wait_for(lambda: "High Voltage" in the_prewarmer.warm)
+    calls = MockSubsonicHandler.calls["/rest/getAlbum"]
+    name, songs = the_prewarmer.get_songs_for_album("High")
+    assert name == "High Voltage"
+    assert [s.title for s in songs] == ["The Jack", "Tnt"]
+    # Served without calling the server
+    assert MockSubsonicHandler.calls["/rest/getAlbum"] == calls
+    assert the_prewarmer.hit_rate() == 1
+
+    # Never queued before, not predicted
+    with pytest.raises(AlbumNotFoundException):
+        the_prewarmer.get_songs_for_album("Unknown album")
+    assert the_prewarmer.hit_rate() == 0.5  # noqa: PLR2004
+    the_prewarmer.close()
+
+
+def test_prewarm_disabled(federation):
+    config = Config("fake", "local", prewarm_albums=0)
+    with prewarmer(federation, config) as the_prewarmer:
+        assert the_prewarmer is None
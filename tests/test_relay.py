@@ -0,0 +1,149 @@
+import os
+import time
+from dataclasses import replace
+from pathlib import Path
+from urllib.parse import urlencode
+
+import pytest
+import requests
+from mock_subsonic import MockSubsonicHandler, fake_content
+
+from castme.relay import (
+    HEAD_SUFFIX,
+    AudioCache,
+    RangeNotSatisfiable,
+    Relay,
+    parse_range,
+)
+from castme.resilience import ResilientHttp
+from castme.song import Song
+from castme.subsonic import SubSonic
+
+
+@pytest.mark.parametrize(
+    ("header", "expected"),
+    [
+        (None, None),
+        ("bytes=0-", (0, 99)),
+        ("bytes=10-19", (10, 19)),
+        ("bytes=90-200", (90, 99)),
+        ("bytes=-10", (90, 99)),
+        ("items=0-10", None),
+    ],
+)
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+def test_parse_range_not_satisfiable():
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=100-", 100)
+
+
+@pytest.fixture
+def relay(tmp_path: Path):
+    the_relay = Relay(AudioCache(str(tmp_path), 10**6, ResilientHttp()), "127.0.0.1", 0)
+    yield the_relay
+    the_relay.close()
+
+
+def test_relay_caches_songs(subsonic: SubSonic, relay: Relay):
+    _, songs = subsonic.get_songs_for_album("High Voltage")
+    url = relay.audio_url(songs[0])
+    calls = MockSubsonicHandler.calls["/rest/stream"]
+
+    for _ in range(2):
+        response = requests.get(url, timeout=5)
+        assert response.status_code == 200  # noqa: PLR2004
+        assert response.content == fake_content("71463")
+        assert response.headers["Content-Type"] == "audio/mpeg"
+    # The second request was served from the cache
+    assert MockSubsonicHandler.calls["/rest/stream"] == calls + 1
+
+    response = requests.get(url, headers={"Range": "bytes=10-19"}, timeout=5)
+    assert response.status_code == 206  # noqa: PLR2004
+    assert response.content == fake_content("71463")[10:20]
+    assert (
+        response.headers["Content-Range"] == f"bytes 10-19/{len(fake_content('71463'))}"
+    )
+
+    response = requests.get(relay.art_url(songs[0]), timeout=5)
+    assert response.content == fake_content("23")
+
+
+def test_relay_streams_while_downloading(subsonic: SubSonic, relay: Relay):
+    delay = 1
+    url, params = subsonic.make_sonic_url("stream", id="71463", delay=delay)
+    song = Song("Slow", "album", "artist", url, "audio/mpeg", "art", "slow")
+    token = relay.register("audio", song, f"{url}?{urlencode(params)}", "audio/mpeg")
+
+    start = time.monotonic()
+    with requests.get(relay.url("audio", token), stream=True, timeout=5) as response:
+        first_chunk = next(response.iter_content(100))
+        # The first bytes are sent before the end of the download
+        assert time.monotonic() - start < delay
+        content = first_chunk + response.content
+    assert content == fake_content("71463")
+    # The file is in the cache once complete
+    response = requests.get(relay.url("audio", token), timeout=5)
+    assert response.content == fake_content("71463")
+    assert response.headers["Content-Length"] == str(len(fake_content("71463")))
+
+
+def test_relay_prefetch(subsonic: SubSonic, relay: Relay):
+    _, songs = subsonic.get_songs_for_album("High Voltage")
+    relay.prefetch(songs)
+    deadline = time.monotonic() + 5
+    expected_files = 4  # 2 songs and their cover art
+    while (
+        len(os.listdir(relay.cache.directory)) < expected_files
+        and time.monotonic() < deadline
+    ):
+        time.sleep(0.01)
+    assert len(os.listdir(relay.cache.directory)) == expected_files
+
+
+def test_cache_eviction(subsonic: SubSonic, tmp_path: Path):
+    _, songs = subsonic.get_songs_for_album("High Voltage")
+    cache = AudioCache(str(tmp_path), 6000, ResilientHttp())
+    cache.get("first", songs[0].url)
+    time.sleep(0.01)
+    cache.get("second", songs[1].url)
+    assert os.listdir(tmp_path) == ["second"]
+
+
+def test_relay_same_id_on_two_servers(subsonic: SubSonic, relay: Relay):
+    _, songs = subsonic.get_songs_for_album("High Voltage")
+    other = replace(songs[1], id=songs[0].id, server="other")
+    assert relay.audio_url(songs[0]) != relay.audio_url(other)
+    assert requests.get(relay.audio_url(other), timeout=5).content == fake_content(
+        songs[1].id
+    )
+
+
+@pytest.mark.parametrize("kind", ["stream", "getCoverArt"])
+def test_cache_resumes_after_head(subsonic: SubSonic, tmp_path: Path, kind: str):
+    """The cover art ignores the ranges, the start of the answer is skipped"""
+    url, params = subsonic.make_sonic_url(kind, id="71463")
+    url = f"{url}?{urlencode(params)}"
+    cache = AudioCache(str(tmp_path), 10**6, ResilientHttp(), max_head_size=1000)
+    cache.fetch_head("key", url, 100, 10**6)
+    with open(tmp_path / f"key{HEAD_SUFFIX}", "rb") as fd:
+        assert fd.read() == fake_content("71463")[:100]
+
+    download = cache.fetch("key", url)
+    # The head is available before the server answers
+    assert download.available(0) >= 100  # noqa: PLR2004
+    download.wait()
+    with open(cache.get("key", url), "rb") as fd:
+        assert fd.read() == fake_content("71463")
+    assert os.listdir(tmp_path) == ["key"]
+
+
+def test_cache_head_budget(subsonic: SubSonic, tmp_path: Path):
+    _, songs = subsonic.get_songs_for_album("High Voltage")
+    cache = AudioCache(str(tmp_path), 10**6, ResilientHttp(), max_head_size=150)
+    cache.fetch_head("first", songs[0].url, 100, 10**6)
+    time.sleep(0.01)
+    cache.fetch_head("second", songs[1].url, 100, 10**6)
+    assert os.listdir(tmp_path) == [f"second{HEAD_SUFFIX}"]
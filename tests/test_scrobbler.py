@@ -0,0 +1,67 @@
+import json
+import time
+from typing import Dict, List
+
+from conftest import wait_for
+from mock_subsonic import CLIENT_NAME, PWD, USER, MockSubsonicHandler
+
+from castme.federation import FederatedSubSonic
+from castme.resilience import ResilientHttp, RetryPolicy
+from castme.scrobbler import Scrobbler
+from castme.subsonic import SubSonic
+
+
+def make_federation(port: int) -> FederatedSubSonic:
+    http = ResilientHttp(retry=RetryPolicy(attempts=1))
+    return FederatedSubSonic(
+        [SubSonic(CLIENT_NAME, USER, PWD, f"http://localhost:{port}", http, "main")]
+    )
+
+
+def submissions(kind: str) -> List[Dict[str, List[str]]]:
+    return [s for s in MockSubsonicHandler.scrobbles if s["submission"] == [kind]]
+
+
+def test_scrobble_batched(subsonic: SubSonic, mock_server: int, tmp_path):
+    MockSubsonicHandler.scrobbles.clear()
+    _, songs = subsonic.get_songs_for_album("High")
+    for song in songs:
+        song.server = "main"
+    path = tmp_path / "scrobbles.json"
+    the_scrobbler = Scrobbler(make_federation(mock_server), str(path), autostart=False)
+    # Nothing is sent before the thread starts, both plays are in the same batch
+    the_scrobbler.started(songs[0])
+    the_scrobbler.finished(songs[0])
+    the_scrobbler.finished(songs[1])
+    the_scrobbler.start()
+    wait_for(lambda: len(submissions("true")) == 1)
+    the_scrobbler.close()
+
+    assert submissions("false")[0]["id"] == ["71463"]
+    assert submissions("true")[0]["id"] == ["71463", "71464"]
+    assert len(submissions("true")[0]["time"]) == 2  # noqa: PLR2004
+    assert json.loads(path.read_text()) == []
+
+
+def test_scrobble_offline(subsonic: SubSonic, mock_server: int, tmp_path):
+    MockSubsonicHandler.scrobbles.clear()
+    _, songs = subsonic.get_songs_for_album("High")
+    for song in songs:
+        song.server = "main"
+    path = tmp_path / "scrobbles.json"
+
+    # Nothing listens on port 1: the plays are saved for later
+    offline = Scrobbler(make_federation(1), str(path))
+    start = time.monotonic()
+    offline.finished(songs[0])
+    offline.finished(songs[1])
+    assert time.monotonic() - start < 0.1  # noqa: PLR2004
+    wait_for(lambda: path.exists() and len(json.loads(path.read_text())) == len(songs))
+    offline.close()
+    assert MockSubsonicHandler.scrobbles == []
+
+    online = Scrobbler(make_federation(mock_server), str(path))
+    wait_for(lambda: len(submissions("true")) == 1)
+    online.close()
+    assert submissions("true")[0]["id"] == ["71463", "71464"]
+    assert json.loads(path.read_text()) == []
@@ -0,0 +1,123 @@
+import json
+from dataclasses import asdict
+from pathlib import Path
+from typing import List
+
+from conftest import make_song
+
+from castme.session import Session
+from castme.song_queue import PendingSong, QueueEntry, SongQueue, entry_key
+
+
+def pending(entries: List[QueueEntry]) -> List[PendingSong]:
+    """The songs are restored as pending songs"""
+    return [PendingSong(entry_key(e)) for e in entries]
+
+
+def restore(path: Path) -> tuple[Session, SongQueue]:
+    songs = SongQueue()
+    session = Session(str(path))
+    session.attach(songs)
+    return session, songs
+
+
+def test_session_restore(tmp_path: Path):
+    path = tmp_path / "session.log"
+    session, songs = restore(path)
+    songs.extend([make_song("1"), make_song("2"), make_song("3")])
+    songs.extend_pending(["main/4", "main/5"])
+    songs.pop(0)
+    session.set_position(42.5)
+    session.set_backend("local")
+    session.close()
+    # The urls hold the credentials of the server
+    assert "url" not in path.read_text()
+
+    session, songs = restore(path)
+    assert list(songs) == [
+        PendingSong("main/2"),
+        PendingSong("main/3"),
+        PendingSong("main/4"),
+        PendingSong("main/5"),
+    ]
+    assert session.position == 42.5  # noqa: PLR2004
+    assert session.backend == "local"
+
+    # Moving to the next song resets the position
+    songs.pop(0)
+    session.close()
+    session, songs = restore(path)
+    assert session.position == 0
+    assert len(songs) == 3  # noqa: PLR2004
+    session.close()
+
+
+def test_session_truncated_log(tmp_path: Path):
+    path = tmp_path / "session.log"
+    session, songs = restore(path)
+    songs.extend([make_song("1")])
+    session.close()
+    with open(path, "a") as fd:
+        fd.write('{"op": "clear"')
+
+    session, songs = restore(path)
+    assert list(songs) == [PendingSong("main/1")]
+    session.close()
+
+
+def test_session_invalid_record(tmp_path: Path):
+    path = tmp_path / "session.log"
+    records = [
+        # Whole song, from a previous version
+        {"op": "add", "songs": [asdict(make_song("1")), asdict(make_song("2"))]},
+        {"op": "remove", "index": 5},
+        {"op": "clear"},
+    ]
+    path.write_text("".join(json.dumps(r) + "\n" for r in records))
+
+    session, songs = restore(path)
+    assert list(songs) == [PendingSong("main/1"), PendingSong("main/2")]
+    session.close()
+    assert "url" not in path.read_text()
+
+
+def test_session_compaction(tmp_path: Path):
+    path = tmp_path / "session.log"
+    songs = SongQueue()
+    session = Session(str(path), max_records=10)
+    session.attach(songs)
+    for i in range(100):
+        songs.extend([make_song(str(i))])
+        songs.pop(0)
+    session.close()
+
+    assert len(path.read_text().splitlines()) <= 10  # noqa: PLR2004
+    session, songs = restore(path)
+    assert len(songs) == 0
+    session.close()
+
+
+def test_session_bulk_edits(tmp_path: Path):
+    path = tmp_path / "session.log"
+    session, songs = restore(path)
+    songs.extend([make_song(str(i)) for i in range(10)])
+    session.set_position(12.0)
+    songs.remove_ranges([(7, 9), (2, 4)])
+    songs.move(4, 6, 1)
+    songs.dedupe()
+    expected = list(songs)
+    assert session.position == 12.0  # noqa: PLR2004
+    songs.move(0, 1, 3)
+    session.close()
+
+    session, songs = restore(path)
+    assert list(songs) == pending([*expected[1:3], expected[0], *expected[3:]])
+    # The song playing was moved
+    assert session.position == 0
+    songs.shuffle()
+    shuffled = list(songs)
+    session.close()
+
+    session, songs = restore(path)
+    assert list(songs) == shuffled
+    session.close()
@@ -0,0 +1,103 @@
+from threading import Event, Thread
+from typing import Dict, List
+
+import pytest
+from conftest import make_song, wait_for
+
+from castme.player import NoSongsToPlayException
+from castme.song import Song
+from castme.song_queue import PendingSong, QueueObserver, Range, SongQueue
+
+
+def test_nothing_resolved():
+    queue = SongQueue(lambda ids: {})
+    queue.extend_pending(["1", "2"])
+    with pytest.raises(NoSongsToPlayException):
+        queue.head()
+    assert len(queue) == 0
+
+
+def test_resolver_called_without_lock():
+    resolving = Event()
+    release = Event()
+
+    def resolver(ids: List[str]) -> Dict[str, Song]:
+        resolving.set()
+        release.wait(5)
+        return {i: make_song(i) for i in ids}
+
+    queue = SongQueue(resolver, window=2)
+    queue.entries.extend(PendingSong(i) for i in ["1", "2", "3"])
+    reader = Thread(target=queue.head)
+    reader.start()
+    assert resolving.wait(5)
+    # The queue can be modified while the songs are resolved
+    queue.pop(0)
+    queue.extend([make_song("4")])
+    release.set()
+    reader.join()
+    assert [s.id for s in queue] == ["2", "3", "4"]
+
+
+def test_resolved_ahead():
+    queue = SongQueue(lambda ids: {i: make_song(i) for i in ids}, window=2)
+    queue.extend_pending(["1", "2", "3", "4"])
+    wait_for(lambda: isinstance(list(queue)[1], Song))
+    queue.pop(0)
+    # The window following the new head is resolved in the background
+    wait_for(lambda: isinstance(list(queue)[1], Song))
+    assert isinstance(list(queue)[2], PendingSong)
+
+
+class BatchRecorder(QueueObserver):
+    def __init__(self):
+        self.calls: List[str] = []
+
+    def removed(self, index: int):
+        self.calls.append("removed")
+
+    def removed_ranges(self, ranges: List[Range]):
+        self.calls.append(f"removed_ranges {ranges}")
+
+    def moved(self, start: int, stop: int, destination: int):
+        self.calls.append(f"moved {start} {stop} {destination}")
+
+    def reordered(self):
+        self.calls.append("reordered")
+
+
+def ids(queue: SongQueue) -> List[str]:
+    return [s.id for s in queue]
+
+
+def test_bulk_edits():
+    queue = SongQueue()
+    queue.extend(make_song(str(i)) for i in range(10))
+    recorder = BatchRecorder()
+    queue.observers.append(recorder)
+
+    # Overlapping and out of range ranges are merged and clamped
+    assert queue.remove_ranges([(8, 20), (2, 4), (3, 5)]) == 5  # noqa: PLR2004
+    assert ids(queue) == ["0", "1", "5", "6", "7"]
+    # Notified once, from the last range to the first
+    assert recorder.calls == ["removed_ranges [(8, 10), (2, 5)]"]
+
+    queue.move(3, 5, 1)
+    assert ids(queue) == ["0", "6", "7", "1", "5"]
+    queue.move(0, 1, 5)
+    assert ids(queue) == ["6", "7", "1", "5", "0"]
+    with pytest.raises(IndexError):
+        queue.move(2, 6, 0)
+
+    queue.extend(
+        [make_song("7"), PendingSong("main/1"), make_song("3"), make_song("7")]
+    )
+    recorder.calls.clear()
+    assert queue.dedupe() == 3  # noqa: PLR2004
+    assert ids(queue) == ["6", "7", "1", "5", "0", "3"]
+    assert recorder.calls == ["removed_ranges [(8, 9), (5, 7)]"]
+
+    queue.shuffle()
+    assert ids(queue)[0] == "6"
+    assert sorted(ids(queue)) == ["0", "1", "3", "5", "6", "7"]
+    assert recorder.calls[-1] == "reordered"
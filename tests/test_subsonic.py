@@ -1,116 +1,36 @@
-import json
-import socketserver
-from hashlib import md5
-from http.server import BaseHTTPRequestHandler
-from threading import Thread
-from typing import Any, Dict
+import time
+import tracemalloc
 from urllib.parse import parse_qs, urlparse
 
 import pytest
-from pytest import fixture
-
-from castme.messages import enable_debug_mode
-from castme.subsonic import AlbumNotFoundException, SubSonic, SubsonicApiError
-
-PORT = 4040
-VERSION = "1.16.1"
-CLIENT_NAME = "tests"
-USER = "castme"
-PWD = "pwd123"
-
-FAILED_AUTH_CODE = 40
-
-
-@fixture(scope="module", autouse=True)
-def enable_debug():
-    enable_debug_mode()
-
-
-def create_response(response_status, **data):
-    response = {
-        "subsonic-response": {"status": response_status, "version": VERSION, **data}
-    }
-    return json.dumps(response).encode("utf-8")
-
-
-class MockSubsonicServer(socketserver.TCPServer):
-    allow_reuse_port = True
-
-
-class MockSubsonicHandler(BaseHTTPRequestHandler):
-    def send_api_response(self, data: bytes):
-        self.send_response(200)
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
-        self.wfile.write(data)
-
-    @staticmethod
-    def check_auth(params: Dict[str, Any]):
-        return params["u"] == [USER] and params["t"] == [
-            md5((PWD + params["s"][0]).encode("utf-8")).hexdigest()
-        ]
-
-    def do_GET(self):
-        parsed_path = urlparse(self.path)
-        params = parse_qs(parsed_path.query)
-
-        if not self.check_auth(params):
-            self.send_api_response(
-                create_response(
-                    "failed",
-                    status="failed",
-                    version="1.16.1",
-                    type="navidrome",
-                    serverVersion="0.53.3 (13af8ed4)",
-                    openSubsonic=True,
-                    error={
-                        "code": FAILED_AUTH_CODE,
-                        "message": "Wrong username or password",
-                    },
-                )
-            )
-
-        elif parsed_path.path == "/rest/ping":
-            self.send_api_response(create_response("ok"))
-
-        elif parsed_path.path == "/rest/getAlbumList":
-            with open("tests/AlbumList.json", "rb") as fd:
-                albums = json.load(fd)
-            self.send_api_response(create_response("ok", albumList=albums))
-
-        elif parsed_path.path == "/rest/getAlbum":
-            with open("tests/HighVoltage.json", "rb") as fd:
-                album = json.load(fd)
-            if params["id"][0] != album["id"]:
-                self.send_error(404, "Not Found")
-                return
-            self.send_api_response(create_response("ok", album=album))
-
-        elif parsed_path.path == "/rest/echo":
-            self.send_api_response(create_response("ok", params=params))
-
-        else:
-            self.send_error(404, "Not Found")
-
-
-@fixture(scope="session")
-def mock_server():
-    with MockSubsonicServer(("", PORT), MockSubsonicHandler, True) as httpd:
-        server_thread = Thread(target=httpd.serve_forever)
-        server_thread.start()
-        yield PORT
-        httpd.shutdown()
-        server_thread.join()
-
-
-@fixture
-def subsonic(mock_server):
-    return SubSonic(CLIENT_NAME, USER, PWD, f"http://localhost:{mock_server}")
-
-
-@fixture
-def subsonic_wrong_pwd(mock_server):
-    return SubSonic(CLIENT_NAME, USER, "badpassword", f"http://localhost:{mock_server}")
+from conftest import wait_for
+from mock_subsonic import (
+    CLIENT_NAME,
+    FAILED_AUTH_CODE,
+    PWD,
+    USER,
+    VERSION,
+    MockSubsonicHandler,
+)
+from requests.exceptions import ConnectionError, HTTPError
+
+import castme.radio
+import castme.subsonic
+from castme.federation import FederatedSubSonic
+from castme.radio import radio
+from castme.resilience import (
+    CircuitBreaker,
+    CircuitOpenException,
+    ResilientHttp,
+    RetryPolicy,
+)
+from castme.song_queue import PendingSong, SongQueue
+from castme.subsonic import (
+    AlbumNotFoundException,
+    PlaylistNotFoundException,
+    SubSonic,
+    SubsonicApiError,
+)
 
 
 def test_call_sonic_no_args(subsonic: SubSonic):
@@ -140,6 +60,15 @@ def test_get_all_albums(subsonic: SubSonic):
     assert subsonic.get_all_albums() == ["Arrival", "High Voltage"]
 
 
+def test_albums_paged(subsonic: SubSonic, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(castme.subsonic, "ALBUM_PAGE_SIZE", 1)
+    calls = MockSubsonicHandler.calls["/rest/getAlbumList"]
+    assert subsonic.get_all_albums() == ["Arrival", "High Voltage"]
+    # The last page is empty
+    assert MockSubsonicHandler.calls["/rest/getAlbumList"] == calls + 3
+    assert subsonic.get_songs_for_album("High Volt")[0] == "High Voltage"
+
+
 def test_wrong_credentials(subsonic_wrong_pwd: SubSonic):
     with pytest.raises(SubsonicApiError) as e:
         subsonic_wrong_pwd.get_all_albums()
@@ -183,3 +112,160 @@ def test_get_songs_for_album_fuzzy(subsonic: SubSonic, raw_title):
 def test_get_songs_for_album_unknown(subsonic: SubSonic, raw_title):
     with pytest.raises(AlbumNotFoundException):
         subsonic.get_songs_for_album(raw_title)
+
+
+def test_retry_on_server_error(subsonic: SubSonic):
+    subsonic.http.retry = RetryPolicy(attempts=3, base_delay=0.01)
+    result = subsonic.call_sonic("flaky", key="retry", failures=2)
+    assert result["subsonic-response"]["status"] == "ok"
+
+
+def test_retry_gives_up(subsonic: SubSonic):
+    subsonic.http.retry = RetryPolicy(attempts=2, base_delay=0.01)
+    with pytest.raises(HTTPError):
+        subsonic.call_sonic("flaky", key="give_up", failures=2)
+
+
+def test_no_retry_when_not_idempotent(subsonic: SubSonic):
+    subsonic.http.retry = RetryPolicy(attempts=3, base_delay=0.01)
+    url, params = subsonic.make_sonic_url("flaky", key="not_idempotent", failures=1)
+    response = subsonic.http.get(url, params, idempotent=False)
+    assert response.status_code == 503  # noqa: PLR2004
+
+
+def test_hedged_request_on_stall(mock_server):
+    http = ResilientHttp(hedge_delay=0.1)
+    subsonic = SubSonic(
+        CLIENT_NAME, USER, PWD, f"http://localhost:{mock_server}", http=http
+    )
+    start = time.monotonic()
+    result = subsonic.call_sonic("stall", key="hedge", delay=3)
+    elapsed = time.monotonic() - start
+    assert result["subsonic-response"]["status"] == "ok"
+    # Without hedging, we would have been waiting for the stalled request
+    assert elapsed < 1
+
+
+def test_circuit_breaker_fails_fast():
+    http = ResilientHttp(
+        retry=RetryPolicy(attempts=1),
+        breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60),
+    )
+    # Nothing is listening on that port
+    subsonic = SubSonic(CLIENT_NAME, USER, PWD, "http://localhost:1", http=http)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            subsonic.call_sonic("ping")
+    with pytest.raises(CircuitOpenException):
+        subsonic.call_sonic("ping")
+
+
+def test_streaming_parse_errors(subsonic_wrong_pwd: SubSonic):
+    with pytest.raises(SubsonicApiError) as e:
+        list(subsonic_wrong_pwd.iter_sonic("getAlbumList", "album"))
+    assert e.value.code == FAILED_AUTH_CODE
+
+
+def test_streaming_parse_empty(subsonic: SubSonic):
+    assert list(subsonic.iter_sonic("ping", "album")) == []
+
+
+def streaming_peak(subsonic: SubSonic, size: int) -> int:
+    """Peak memory used to stream a list of `size` albums"""
+    tracemalloc.start()
+    count = sum(1 for _ in subsonic.iter_sonic("getAlbumList2", "album", size=size))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert count == size
+    return peak
+
+
+def test_streaming_parse_memory(mock_server):
+    """The memory used by the streaming parse does not depend on the number of
+    albums, unlike the full parse"""
+    # No hedging: a duplicate request would skew the measurements
+    subsonic = SubSonic(
+        CLIENT_NAME,
+        USER,
+        PWD,
+        f"http://localhost:{mock_server}",
+        http=ResilientHttp(hedge_delay=60),
+    )
+    # The allocations made by the first call only are not measured
+    streaming_peak(subsonic, 1)
+
+    small = streaming_peak(subsonic, 2_000)
+    assert streaming_peak(subsonic, 20_000) < 1.5 * small
+
+
+def test_get_playlist_song_ids(subsonic: SubSonic):
+    name, song_ids = subsonic.get_playlist_song_ids("Best")
+    assert name == "Best of"
+    assert song_ids == ["71463", "71464", "0"]
+
+    with pytest.raises(PlaylistNotFoundException):
+        subsonic.get_playlist_song_ids("XXXXX")
+
+
+def test_playlist_lazy_loading(subsonic: SubSonic):
+    _, song_ids = subsonic.get_playlist_song_ids("Best")
+    queue = SongQueue(subsonic.get_songs_by_id, window=1)
+    queue.extend_pending(song_ids)
+    assert all(isinstance(s, PendingSong) for s in list(queue)[1:])
+
+    assert queue[0].title == "The Jack"
+    assert queue[0].id == "71463"
+    # Only the window was loaded
+    assert isinstance(list(queue)[1], PendingSong)
+
+    queue.pop(0)
+    assert queue[0].title == "Tnt"
+    queue.pop(0)
+    # The last song can't be loaded, and is removed from the queue
+    with pytest.raises(IndexError):
+        queue[0]
+    assert len(queue) == 0
+
+
+@pytest.mark.parametrize(
+    ("mode", "verb"),
+    [
+        ("random", "getRandomSongs"),
+        ("similar", "getSimilarSongs2"),
+        ("top", "getTopSongs"),
+    ],
+)
+def test_radio_refill(
+    subsonic: SubSonic, mode: str, verb: str, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(castme.radio, "POLL_INTERVAL", 0.01)
+    queue = SongQueue()
+    refills = []
+    with radio(FederatedSubSonic([subsonic]), queue, lookahead=5) as the_radio:
+        the_radio.start(mode, on_refill=lambda: refills.append(len(queue)))
+        wait_for(lambda: bool(refills))
+        # Let the radio try to top up the queue a few more times
+        calls = MockSubsonicHandler.calls[f"/rest/{verb}"]
+        wait_for(lambda: MockSubsonicHandler.calls[f"/rest/{verb}"] >= calls + 3)
+    # The server only knows 2 songs, the history prevents any duplicate
+    # Random songs are shuffled
+    assert sorted(queue[i].title for i in range(len(queue))) == ["The Jack", "Tnt"]
+    assert refills == [2]
+
+
+def test_radio_unexpected_error(subsonic: SubSonic, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(castme.radio, "POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(castme.radio, "ERROR_BACKOFF", 0.01)
+    federation = FederatedSubSonic([subsonic])
+    get_random_songs = federation.get_random_songs
+
+    def fail_once(count: int):
+        monkeypatch.setattr(federation, "get_random_songs", get_random_songs)
+        # e.g. a field missing from the answer
+        raise KeyError("song")
+
+    monkeypatch.setattr(federation, "get_random_songs", fail_once)
+    queue = SongQueue()
+    with radio(federation, queue, lookahead=5) as the_radio:
+        the_radio.start("random")
+        wait_for(lambda: len(queue) == 2)  # noqa: PLR2004